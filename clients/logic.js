@@ -112,9 +112,80 @@ function update_lab_state(newData){
   }
 }
 
+// Ask the master only for the labs and channels shown in this page
+function subscription_message(){
+  var labs = Object.keys(mainObj),
+      channels = [];
+  labs.forEach(function(ref){
+    mainObj[ref].analogchannels.concat(
+      mainObj[ref].conditions.map(function(condition){return condition.control;})
+    ).forEach(function(channel){
+      if(channels.indexOf(channel) < 0){
+        channels.push(channel);
+      }
+    })
+  })
+  var request = {labs:labs, channels:channels, backfill:n};
+  if(typeof max_rate !== "undefined"){
+    request.max_rate = max_rate;
+  }
+  return JSON.stringify({subscribe:request});
+}
+
+connection.onopen = function(){
+  connection.send(subscription_message());
+}
+
+// Last known state of each node, used when the master sends delta frames
+// (see servers/broadcaster.py)
+var labs_state = {};
+
+function apply_backfill(frame){
+  // Fill the graphs with the recent history kept by the master
+  Object.keys(frame.labs).forEach(function(ref){
+    if(!(ref in mainObj)){
+      return;
+    }
+    mainObj[ref].analogchannels.forEach(function(channel){
+      if(!(channel in frame.labs[ref])){
+        return;
+      }
+      var values = frame.labs[ref][channel].y.slice(-n),
+          buffer = mainObj[ref].data[channel];
+      mainObj[ref].data[channel] = buffer.slice(values.length).concat(values);
+      redrawWithoutAnimation(mainObj[ref].lines[channel],
+                             mainObj[ref].data[channel],
+                             mainObj[ref].representation[channel]||line);
+    })
+  })
+}
+
+function apply_frame(frame){
+  if(frame.frame === "backfill"){
+    apply_backfill(frame);
+    return;
+  }
+  // Keyframes replace the whole state, deltas only carry the changed values
+  if(frame.frame === "key"){
+    labs_state = {};
+  }
+  frame.removed.forEach(function(labUUID){
+    delete labs_state[labUUID];
+  })
+  Object.keys(frame.nodes).forEach(function(labUUID){
+    labs_state[labUUID] = Object.assign(labs_state[labUUID] || {},
+                                        frame.nodes[labUUID]);
+    update_lab_state(labs_state[labUUID]);
+  })
+}
+
 connection.onmessage = function(event) {
     var labs_dictionary = JSON.parse(event.data);
     //verbose output: // console.log(newMessage);
+    if("frame" in labs_dictionary){
+      apply_frame(labs_dictionary);
+      return;
+    }
     Object.keys(labs_dictionary).forEach(function(labUUID){
     update_lab_state(labs_dictionary[labUUID]);
     })
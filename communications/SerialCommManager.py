@@ -12,9 +12,11 @@ import serial
 from serial.serialutil import SerialTimeoutException, SerialException
 import numpy as np
 from serial.tools.list_ports import grep as port_grep
-from servers.server_master import TFORMAT
+from servers import logs
 import logging
 
+log = logs.get_logger('serial')
+
 X0E = serial.to_bytes([0x0e])
 NUM_CHANNELS = 9 # number of total channels (time axis + ADC channels 0-7)
 DATA_LEN = 1 # numbers in each array that serial.print does in arduino
@@ -26,20 +28,21 @@ def handshake_func(serialinst,verbose=False,command='A'):
     instance of a serial connection.
     The commands, as recognized by the arduino_firmware_io, are single bytes
     with a value near 65 ('A'), which turns ON/OFF a digital channel.
+
+    The details are logged at DEBUG level by the 'serial' logger (see
+    servers.logs); the verbose argument is kept for compatibility.
     """
     if serialinst.isOpen():
         nbytes = serialinst.write(command.encode()) # can write anything here, just a single byte (any ASCII char)
-        if verbose:
-            print('(HSK) Wrote bytes to serial port: {}'.format(nbytes))
+        log.debug('(HSK) Wrote bytes to serial port: %s', nbytes)
         #wait for byte to be received before returning
-        st = time.clock()
+        st = time.perf_counter()
         try:
             if (serialinst.inWaiting()>0):
                 byte_back = serialinst.readline()
-                et = time.clock()
-                if verbose:
-                    print('(HSK) Received handshake data from serial port: {}'.format(byte_back))
-                    print('(HSK) Time between send and receive: {}s'.format(et-st))
+                et = time.perf_counter()
+                log.debug('(HSK) Received handshake data from serial port: %s, after %.2es',
+                          byte_back, et-st)
                 return byte_back
         except SerialTimeoutException:
             serialinst.close()
@@ -72,19 +75,15 @@ class SerialCommManager:
             self.connection_settings['dsrdtr'] = True
             self.connection_settings['port'] = port
         elif arduino_port:
-            print('(SCM  {}) Given port: {}'\
-                  .format(time.strftime(TFORMAT),
-                          arduino_port))
+            log.info('Given port: %s', arduino_port)
             self.connection_settings['port']=arduino_port
         else:
             try:
                 port = self.get_arduino_port()
             except StopIteration:
-                print('Arduino not found')
+                log.error('Arduino not found')
                 raise KeyboardInterrupt
-            print('(SCM  {}) Trying port: {}'\
-                  .format(time.strftime(TFORMAT),
-                          port))
+            log.info('Trying port: %s', port)
             self.connection_settings['port'] = port
         self.init_arduino_connection()
 
@@ -93,16 +92,13 @@ class SerialCommManager:
 
     def init_arduino_connection(self):
         try:
-            if self.verbose:
-                print('(SCM  {}) Trying to connect to serial'\
-                      .format(time.strftime(TFORMAT)))
+            log.debug('Trying to connect to serial')
             self.ser = serial.Serial(**self.connection_settings)
             # After opening the serial port, we wait for a bit until it's ready.
             # Otherwise, we might block the serial reading (for example, sleep(0.5)
             # blocks the MEGA)
             time.sleep(1.5)
-            print('(SCM  {}) Connection Acquired'\
-                    .format(time.strftime(TFORMAT)))
+            log.info('Connection Acquired')
 
         except ValueError as err:
             raise ArduinoConnectionError
@@ -126,9 +122,7 @@ class SerialCommManager:
             firstPort = myPort_generator.next()  # .__next__() # for python3
         except AttributeError:
             firstPort = myPort_generator.__next__()
-        print('(SCM  {}) Arduino found in port {}'\
-              .format(time.strftime(TFORMAT),
-                      firstPort[0]))
+        log.info('Arduino found in port %s', firstPort[0])
         return firstPort[0]
 
 
@@ -149,16 +143,13 @@ class SerialCommManager:
         #self.connect_to_server()
         try:
             #ser = serial.Serial(**self.connection_settings)
-            st = time.clock()
+            st = time.perf_counter()
             byte_back = handshake_func(self.ser,verbose=self.verbose,**args)
-            if self.verbose:
-                print('(SCM) Byte back from handshake {}'.format(byte_back))
+            log.debug('Byte back from handshake %s', byte_back)
         #get data
             data = self.read_data_from_arduino()
-            et = time.clock() - st
-            if self.verbose:
-                print('(SCM) ------------------------\n(SCM) INIT POLLING ARDUINO:\n(SCM)------------------------')
-                print('(SCM) Time reading data (s): {0:.2e},  data: {1}'.format(et,repr(data)))
+            et = time.perf_counter() - st
+            log.debug('Time reading data (s): %.2e,  data: %r', et, data)
             #Fault conditions:
             # Empty data (just /r or /n)
             if (data is not None):
@@ -178,8 +169,8 @@ class SerialCommManager:
                     self.channels = data_array[1:]
                     self.time_axis = data_array[0]
 
-                    if self.verbose:
-                        print('(SCM) Data acquisition complete. Time spent {0:.2e}\n(SCM)------------------------'.format( time.clock() - st))
+                    log.debug('Data acquisition complete. Time spent %.2e',
+                              time.perf_counter() - st)
 
                     return self.time_axis, self.channels
                 else:
@@ -192,7 +183,7 @@ class SerialCommManager:
             raise ArduinoConnectionError
 
         except TypeError as err:  #If disconnected it may not get a data point
-            print(err.args)
+            log.warning('%s', err.args)
             self.ser.close()
             raise ArduinoConnectionError
         except IndexError as err:
@@ -218,8 +209,7 @@ class SerialCommManager:
         #     #port='COM6',   #look in the arduino software
 
     def cleanup(self):
-        if self.verbose:
-            print('(SCM) Cleaning up connection')
+        log.debug('Cleaning up connection')
         self.ser.close()
 
 class ArduinoConnectionError(Exception):
@@ -227,6 +217,7 @@ class ArduinoConnectionError(Exception):
 
 
 def main():
+    logs.setup_logging(verbose=True)
     try:
         fetcher = SerialCommManager(0.001, verbose=True)
         pinNumber = 'A'
@@ -236,9 +227,8 @@ def main():
 
         return True
     except Exception as err: #If the arduino is not connected
-        print(err.args)
-        print('(SCM  {}) Arduino not connected: please, connect the arduino and try running the node script again'\
-                      .format(time.strftime(TFORMAT)))
+        log.error('%s. Arduino not connected: please, connect the arduino and try running the node script again',
+                  err.args)
 
 
 
@@ -1,12 +1,28 @@
+import contextlib
 import sqlite3
 import time
 import json
+
+import numpy as np
+
 LAB_TABLE_COLNAMES = ['_id','labNAME']
 LAB_TABLE_COLTYPES = ['INTEGER PRIMARY KEY AUTOINCREMENT','TEXT']
 OBSERVATION_TABLE_COLNAMES = ['_id','labID']
 OBSERVATION_TABLE_COLTYPES = ['INTEGER PRIMARY KEY AUTOINCREMENT','INTEGER']
 METADATA_TABLE_COLNAMES = ['time','labID','metadata']
 METADATA_TABLE_COLTYPES = ['REAL','INTEGER','TEXT']
+# Rollup tables of each lab ('lab7_1m', 'lab7_1h', 'lab7_1d'): (resolution (s), suffix)
+ROLLUPS = ((60, '1m'), (3600, '1h'), (86400, '1d'))
+ROLLUP_TABLE_COLNAMES = ['bucket','channel','min','max','sum','count']
+ROLLUP_TABLE_COLTYPES = ['REAL','TEXT','REAL','REAL','REAL','INTEGER']
+RAW_RESOLUTION = 0
+# Maximum age (s) of the data kept at each resolution (None: forever)
+RETENTION = {RAW_RESOLUTION: 90*86400,
+             60: 400*86400,
+             3600: None,
+             86400: None}
+# Columns of the lab tables which are not channels
+NON_DATA_COLUMNS = ('user','error','x','ID')
 
 
 class DBHandler(object):
@@ -55,18 +71,67 @@ class DBHandler(object):
         NOTE: If the dictionaries used in the creation of the database and the
     addition of new data have a different set of keys, problems might occur!
 
-
-
-
+    Batched writes
+    --------------
+    The DBHandler.add_database_entries method adds the observations of all
+    the labs in a single transaction: the names of the tables and the ids of
+    the labs are cached in memory (the master server is the only writer of
+    the database), the observation ids are allocated in one query, and the
+    rows are inserted with executemany, using the same SQL string for each
+    table and set of keys (so sqlite3 reuses its prepared statements).
+
+    With wal=True, the database uses write-ahead logging: the readers are
+    not blocked by the writer, and a commit only appends to the log (the
+    log is synced at checkpoints, with synchronous=NORMAL).
+
+    The new tables and labs are not committed on their own: like the rows,
+    they are committed by the caller of add_database_entries (e.g. with the
+    rest of a group of batches, see database.DBWriter). DBHandler.atomic
+    makes a batch all-or-nothing within such a group.
+
+    Rollups and retention
+    ---------------------
+    Each lab table has an index on 'x', and three rollup tables ('<lab>_1m',
+    '<lab>_1h' and '<lab>_1d') with the minimum, maximum, sum and count of
+    each channel per minute, hour and day. They are updated with every batch
+    of observations (and built from the existing rows when they are
+    created). DBHandler.prune deletes the data older than the retention of
+    each resolution (see RETENTION), and DBHandler.query reads a time range
+    at the coarsest resolution which still gives the requested number of
+    points.
+
+    With rollups=False, the lab tables have no rollup tables (e.g. in the
+    partitions of a database.PartitionedDB, whose rollups are kept in another
+    file, see DBHandler.add_rollups).
+
+    With readonly=True, the database is opened in read-only mode (e.g. to
+    query it from other threads than the writer), and no table is created.
     """
-    def __init__(self, db_name='example.db',verbose=False):
-        self.db = sqlite3.connect(db_name)
+    def __init__(self, db_name='example.db',verbose=False, wal=False,
+                 retention=None, readonly=False, rollups=True):
+        if readonly:
+            self.db = sqlite3.connect('file:{}?mode=ro'.format(db_name), uri=True)
+        else:
+            self.db = sqlite3.connect(db_name)
         self.cursor = self.db.cursor()
+        if wal:
+            self.cursor.execute('PRAGMA journal_mode=WAL')
+            self.cursor.execute('PRAGMA synchronous=NORMAL')
         self.labs_tablename = 'laboratories'
         self.observations_tablename = 'observation_list'
         self.metadata_tablename = 'metadata_list'
 
         self.verbose=verbose
+        self.rollups = rollups
+        # Maximum age of the data at each resolution (see RETENTION)
+        self.retention = dict(RETENTION)
+        self.retention.update(retention or {})
+        # Caches of the batched writes (see add_database_entries)
+        self._tables = None        # set of table names
+        self._lab_ids = {}         # lab name -> id in the laboratories table
+        self._insert_sql = {}      # (table, keys) -> SQL string
+        if readonly:
+            return
 
         # Make sure that the three main tables (laboratories,
         # observations and metadata) are in the database.
@@ -83,7 +148,7 @@ class DBHandler(object):
         self.commit()
 
 
-    def _create_table(self,tablename,column_names,column_types):
+    def _create_table(self,tablename,column_names,column_types,constraints=()):
         ''' Creates a table with a given name, column names and types.
 
         It does not do anything if the table already exists.
@@ -91,6 +156,7 @@ class DBHandler(object):
         :param tablename:
         :param column_names:
         :param column_types:
+        :param constraints: table constraints, e.g. 'PRIMARY KEY (a, b)'
         :return:
         '''
         if not self.check_table_exists(tablename):
@@ -99,13 +165,16 @@ class DBHandler(object):
             for colname,coltype in zip(column_names, column_types):
                 sql_string = sql_string + '{colname} {coltype}, '\
                     .format(colname=colname, coltype=coltype)
+            for constraint in constraints:
+                sql_string = sql_string + constraint + ', '
             #We need to remove the last comma and space before closing the parenthesis
             sql_string = sql_string[:-2]+')'
 
             if self.verbose:
                 print('sql> '+sql_string)
             self.cursor.execute(sql_string)
-            self.commit()
+            if self._tables is not None:
+                self._tables.add(tablename)
 
 
     def _register_new_laboratory(self,labname):
@@ -121,7 +190,7 @@ class DBHandler(object):
         if self.verbose:
             print('sql> '+sql_string)
         self.cursor.execute(sql_string,(labname,))
-        self.commit()
+        self._lab_ids[labname] = self.cursor.lastrowid
         return self.cursor.lastrowid
 
     def _add_column(self,labname,columnname,datatype = 'REAL'):
@@ -143,10 +212,68 @@ class DBHandler(object):
     def check_table_exists(self,tablename):
         """ Check if a table with a given name exists in the current database.
 
+        The names of the tables are read once, and cached afterwards.
+
         :param tablename:
         """
-        table_names = self.tables_in_db()
-        return tablename in table_names
+        if self._tables is None:
+            self._tables = set(self.tables_in_db())
+        return tablename in self._tables
+
+    def lab_id(self, user, dictionary):
+        """ Returns the id of a lab, creating its table and registering it
+        if it is new.
+
+        :param user: name of the lab
+        :param dictionary: dictionary used to create the table of the lab
+        """
+        labID = self._lab_ids.get(user)
+        if labID is not None:
+            return labID
+        if not self.check_table_exists(user):
+            # Creates new table with suitable properties
+            # and adds an ID to the laboratories list
+            self.create_table_from_dict(dictionary)
+            labID = self._register_new_laboratory(user)
+        else:
+            labID = self.get_labID_by_name(user)
+        self._ensure_rollups(user)
+        self._lab_ids[user] = labID
+        return labID
+
+    def _ensure_rollups(self, lab):
+        """ Creates the index on 'x' and the rollup tables of a lab, if they
+        do not exist. New rollup tables are built from the existing rows."""
+        if self.check_table_exists(lab):
+            sql_string = 'CREATE INDEX IF NOT EXISTS {lab}_x ON {lab}(x)'.format(lab=lab)
+            if self.verbose:
+                print('sql> '+sql_string)
+            self.cursor.execute(sql_string)
+        if not self.rollups:
+            return
+        for resolution, suffix in ROLLUPS:
+            tablename = rollup_table(lab, suffix)
+            if self.check_table_exists(tablename):
+                continue
+            self._create_table(tablename, ROLLUP_TABLE_COLNAMES,
+                               ROLLUP_TABLE_COLTYPES,
+                               constraints=('PRIMARY KEY (channel, bucket)',))
+            for channel in self.data_columns(lab):
+                sql_string = ('INSERT OR REPLACE INTO {table}({key_list}) '
+                              'SELECT CAST(x/{res} AS INTEGER)*{res}, ?, MIN({ch}), '
+                              'MAX({ch}), SUM({ch}), COUNT({ch}) FROM {lab} '
+                              'WHERE error=0 AND {ch} IS NOT NULL GROUP BY 1')\
+                    .format(table=tablename, key_list=','.join(ROLLUP_TABLE_COLNAMES),
+                            res=resolution, ch=channel, lab=lab)
+                if self.verbose:
+                    print('sql> '+sql_string)
+                self.cursor.execute(sql_string, (channel,))
+
+    def data_columns(self, tablename):
+        """ Returns the names of the channels (REAL columns) of a lab table."""
+        self.cursor.execute('PRAGMA table_info({})'.format(tablename))
+        return [row[1] for row in self.cursor.fetchall()
+                if row[2] == 'REAL' and row[1] not in NON_DATA_COLUMNS]
 
     def tables_in_db(self):
         """ Enumerate the tables in the current db."""
@@ -216,7 +343,6 @@ class DBHandler(object):
         list_of_types.append('INTEGER')
 
         self._create_table(tablename, list_of_keys, list_of_types)
-        self.commit()
 
     def add_data_from_dict(self, data_dict,observationID=0):
         """ Adds data from a dictionary to a table.
@@ -259,37 +385,216 @@ class DBHandler(object):
         :param dictionary:
         :return:
         """
+        self.add_database_entries([dictionary])
 
-        # 1 - Check if lab has a corresponding table?  pass : add table
-        # 2 - Add entry to observation list
-        # 3 - Obtain observation_id from entry
-        # 4 - Add entry in table with suitable name
+    def add_database_entries(self, dictionaries, commit=True):
+        """ Adds the observations of several labs in a single transaction.
 
-        # 1: Check if table exists
-        user = dictionary["user"]
-        if not self.check_table_exists(user):
-            # Creates new table with suitable properties
-            # and adds an ID to the laboratories list
-            self.create_table_from_dict(dictionary)
-            labID = self._register_new_laboratory(user)
-        else:
-            labID = self.get_labID_by_name(user)
+        1 - Get the id of each lab (creating its table if it is new)
+        2 - Allocate consecutive observation ids, and add them to the
+            observation list
+        3 - Add the data of each lab to its table, grouped by table and keys
+        4 - Commit once (unless commit=False, e.g. if the caller groups
+            several batches in one commit)
 
-        # 2: Add entry to observation list
+        :param dictionaries: list of data dictionaries (with a 'user' key)
+        """
+        if not dictionaries:
+            # Commit the pending metadata, if any
+            if commit:
+                self.commit()
+            return
+        # 1: lab ids (only new labs cause queries)
+        labIDs = [self.lab_id(dictionary["user"], dictionary)
+                  for dictionary in dictionaries]
+
+        # 2: observation ids. Explicit ids above the last one allocated keep
+        # the AUTOINCREMENT sequence of the table up to date.
+        self.cursor.execute('SELECT seq FROM sqlite_sequence WHERE name=?',
+                            (self.observations_tablename,))
+        row = self.cursor.fetchone()
+        first_id = (row[0] if row else 0) + 1
+        observationIDs = range(first_id, first_id + len(dictionaries))
         key_list = ','.join(OBSERVATION_TABLE_COLNAMES)
-        sql_string = 'insert into {tablename}({key_list}) VALUES(NULL,?)'\
+        sql_string = 'insert into {tablename}({key_list}) VALUES(?,?)'\
             .format(tablename=self.observations_tablename,key_list=key_list)
         if self.verbose:
             print('sql> '+sql_string)
-        self.cursor.execute(sql_string,(labID,))
+        self.cursor.executemany(sql_string, zip(observationIDs, labIDs))
+
+        # 3: data, one executemany per table and set of keys
+        groups = {}
+        for observationID, dictionary in zip(observationIDs, dictionaries):
+            keys = tuple(dictionary)
+            groups.setdefault((dictionary["user"], keys), []).append(
+                [observationID] + list(dictionary.values()))
+        for (tablename, keys), rows in groups.items():
+            sql_string = self._insert_statement(tablename, keys)
+            if self.verbose:
+                print('sql> '+sql_string)
+            self.cursor.executemany(sql_string, rows)
 
-        # 3: obtain observation ID
-        observationID = self.cursor.lastrowid
-        if self.verbose:
-            print('observation id {}'.format(observationID))
+        # 4: rollups, and a single commit (and fsync) for the whole batch
+        if self.rollups:
+            self._update_rollups(dictionaries)
+        if commit:
+            self.commit()
 
-        # 4: Add entry in table with suitable name
-        self.add_data_from_dict(dictionary,observationID)
+    @contextlib.contextmanager
+    def atomic(self):
+        """ Context manager making the writes of a batch all-or-nothing,
+        without committing them.
+
+        The batch is written in a savepoint, inside the open transaction (a
+        transaction is started if needed, so releasing the savepoint never
+        commits). If the block raises, the writes of the batch are rolled
+        back, and the previous batches of the transaction are kept.
+        """
+        if not self.db.in_transaction:
+            self.cursor.execute('BEGIN')
+        self.cursor.execute('SAVEPOINT batch')
+        try:
+            yield self
+        except BaseException:
+            # The transaction is gone if sqlite rolled it back itself
+            if self.db.in_transaction:
+                self.cursor.execute('ROLLBACK TO batch')
+                self.cursor.execute('RELEASE batch')
+            # The tables and labs created by the batch were rolled back too
+            self._tables = None
+            self._lab_ids = {}
+            raise
+        self.cursor.execute('RELEASE batch')
+
+    def add_rollups(self, dictionaries):
+        """ Adds some observations to the rollup tables only, without their
+        rows (which are kept in another database, e.g. the partitions of a
+        database.PartitionedDB). The rollup tables are created if needed.
+        """
+        for lab in set(dictionary['user'] for dictionary in dictionaries):
+            if not self.check_table_exists(rollup_table(lab, ROLLUPS[0][1])):
+                self._ensure_rollups(lab)
+        self._update_rollups(dictionaries)
+
+    def _update_rollups(self, dictionaries):
+        """ Adds the values of some observations to the rollup tables."""
+        aggregates = {}   # table -> {(channel, bucket): [min, max, sum, count]}
+        for dictionary in dictionaries:
+            x = dictionary.get('x')
+            if dictionary.get('error', True) or x is None:
+                continue
+            lab = dictionary['user']
+            for channel, value in dictionary.items():
+                if channel in NON_DATA_COLUMNS or isinstance(value, bool) \
+                        or not isinstance(value, (int, float)):
+                    continue
+                for resolution, suffix in ROLLUPS:
+                    table = aggregates.setdefault(rollup_table(lab, suffix), {})
+                    key = (channel, (x//resolution)*resolution)
+                    aggregate = table.get(key)
+                    if aggregate is None:
+                        table[key] = [value, value, value, 1]
+                    else:
+                        aggregate[0] = min(aggregate[0], value)
+                        aggregate[1] = max(aggregate[1], value)
+                        aggregate[2] += value
+                        aggregate[3] += 1
+        for tablename, table in aggregates.items():
+            sql_string = ('INSERT INTO {table}({key_list}) VALUES (?,?,?,?,?,?) '
+                          'ON CONFLICT(channel, bucket) DO UPDATE SET '
+                          'min=MIN(min, excluded.min), max=MAX(max, excluded.max), '
+                          'sum=sum+excluded.sum, count=count+excluded.count')\
+                .format(table=tablename, key_list=','.join(ROLLUP_TABLE_COLNAMES))
+            self.cursor.executemany(sql_string,
+                                    [(bucket, channel) + tuple(aggregate)
+                                     for (channel, bucket), aggregate in table.items()])
+
+    def prune(self, now=None):
+        """ Deletes the data older than the retention of each resolution
+        (see RETENTION).
+
+        :return: number of raw rows deleted
+        """
+        now = time.time() if now is None else now
+        self.cursor.execute('SELECT labNAME FROM {}'.format(self.labs_tablename))
+        labs = [row[0] for row in self.cursor.fetchall()]
+        deleted = 0
+        raw_age = self.retention.get(RAW_RESOLUTION)
+        for lab in labs:
+            if not self.check_table_exists(lab):
+                continue
+            if raw_age:
+                cutoff = now - raw_age
+                self.cursor.execute('DELETE FROM {observations} WHERE _id IN '
+                                    '(SELECT ID FROM {lab} WHERE x<?)'
+                                    .format(observations=self.observations_tablename,
+                                            lab=lab), (cutoff,))
+                self.cursor.execute('DELETE FROM {lab} WHERE x<?'.format(lab=lab),
+                                    (cutoff,))
+                deleted += self.cursor.rowcount
+            self.prune_rollups(lab, now)
+        self.commit()
+        return deleted
+
+    def prune_rollups(self, lab, now=None):
+        """ Deletes the rollups of a lab older than the retention of their
+        resolution (without committing)."""
+        now = time.time() if now is None else now
+        for resolution, suffix in ROLLUPS:
+            age = self.retention.get(resolution)
+            tablename = rollup_table(lab, suffix)
+            if age and self.check_table_exists(tablename):
+                self.cursor.execute('DELETE FROM {} WHERE bucket<?'.format(tablename),
+                                    (now - age,))
+
+    def choose_resolution(self, start, end, points=None, now=None):
+        """ See choose_resolution (with the retention of this database)."""
+        return choose_resolution(self.retention, start, end, points, now)
+
+    def query(self, lab, channel, start=None, end=None, points=None,
+              resolution=None):
+        """ Reads the values of a channel in a time range.
+
+        :param points: number of points wanted (the resolution is chosen
+                       with choose_resolution, unless it is given)
+        :param resolution: RAW_RESOLUTION or one of the ROLLUPS resolutions
+        :return: dictionary with the resolution and the arrays 'x', 'min',
+                 'max', 'mean' and 'count' (for the raw rows, min, max and
+                 mean are the values, and count is 1)
+        """
+        start = 0 if start is None else start
+        end = time.time() if end is None else end
+        if resolution is None:
+            resolution = self.choose_resolution(start, end, points)
+        if resolution == RAW_RESOLUTION:
+            self.cursor.execute('SELECT x, {ch} FROM {lab} WHERE x BETWEEN ? AND ? '
+                                'AND error=0 AND {ch} IS NOT NULL ORDER BY x'
+                                .format(ch=channel, lab=lab), (start, end))
+            rows = np.array(self.cursor.fetchall(), dtype=float).reshape(-1, 2)
+            x, values = rows[:, 0], rows[:, 1]
+            return {'resolution': resolution, 'x': x, 'min': values,
+                    'max': values, 'mean': values,
+                    'count': np.ones(len(x), dtype=int)}
+        suffix = dict(ROLLUPS)[resolution]
+        self.cursor.execute('SELECT bucket, min, max, sum/count, count FROM {table} '
+                            'WHERE channel=? AND bucket BETWEEN ? AND ? ORDER BY bucket'
+                            .format(table=rollup_table(lab, suffix)),
+                            (channel, (start//resolution)*resolution, end))
+        rows = np.array(self.cursor.fetchall(), dtype=float).reshape(-1, 5)
+        return {'resolution': resolution, 'x': rows[:, 0], 'min': rows[:, 1],
+                'max': rows[:, 2], 'mean': rows[:, 3],
+                'count': rows[:, 4].astype(int)}
+
+    def _insert_statement(self, tablename, keys):
+        """ Returns the (cached) SQL string inserting a row with the given
+        keys (plus the observation ID) into a table."""
+        sql_string = self._insert_sql.get((tablename, keys))
+        if sql_string is None:
+            sql_string = 'insert into {tablename}(ID,{key_list}) VALUES ({values})'\
+                .format(tablename=tablename, key_list=','.join(keys),
+                        values=','.join('?'*(len(keys) + 1)))
+            self._insert_sql[(tablename, keys)] = sql_string
+        return sql_string
 
     def register_new_metadata(self, user, dictionary):
         """ Creates a new entry in the metadata table.
@@ -304,13 +609,7 @@ class DBHandler(object):
         :return:
         """
         # 1: Check if table exists
-        if not self.check_table_exists(user):
-            # Creates new table with suitable properties
-            # and adds an ID to the laboratories list
-            self.create_table_from_dict(dictionary)
-            labID = self._register_new_laboratory(user)
-        else:
-            labID = self.get_labID_by_name(user)
+        labID = self.lab_id(user, dictionary)
         # 2: Add entry to metadata list
         key_list = ','.join(METADATA_TABLE_COLNAMES)
         sql_string = 'insert into {tablename}({key_list}) VALUES(?,?,?)'\
@@ -333,6 +632,32 @@ class DBHandler(object):
         self.cursor.close()
         self.db.close()
 
+
+def choose_resolution(retention, start, end, points=None, now=None):
+    """ Returns the coarsest resolution (s, RAW_RESOLUTION for the raw
+    rows) which gives at least the requested number of points in
+    [start, end], amongst those whose data still covers start.
+
+    :param retention: dictionary {resolution: maximum age (s)}
+    """
+    now = time.time() if now is None else now
+    resolutions = [RAW_RESOLUTION] + [resolution for resolution, _ in ROLLUPS]
+    available = [resolution for resolution in resolutions
+                 if not retention.get(resolution)
+                 or start >= now - retention[resolution]]
+    if not points:
+        return available[0]
+    span = end - start
+    suitable = [resolution for resolution in available
+                if resolution == RAW_RESOLUTION or span/resolution >= points]
+    return max(suitable) if suitable else available[0]
+
+
+def rollup_table(lab, suffix):
+    """ Returns the name of a rollup table of a lab (e.g. 'lab7_1m')."""
+    return '{}_{}'.format(lab, suffix)
+
+
 def types_from_keys(list_of_keys):
     """ Generates a list of data types from a list of keys from a dictionary.
 
@@ -0,0 +1,249 @@
+"""Write-behind database writer for lab-nanny
+
+The sqlite inserts and commits of the master server are not run in its
+IOLoop: one slow fsync (e.g. on an SD card or an NFS share) would delay the
+polling of the nodes and the frames sent to the clients. Instead, the master
+hands the data to a DBWriter, which queues it and returns immediately; a
+dedicated thread owns the database connection (a DBHandler, in WAL mode) and
+writes the queued batches.
+
+The commits are grouped: once the thread starts writing, it keeps taking the
+batches queued within COMMIT_DELAY (up to COMMIT_MAX_BATCHES of them), and
+commits them together. Each batch is written in a savepoint, so a
+batch which fails is rolled back as a whole, without losing the others.
+
+The queue is bounded (DB_QUEUE_SIZE batches): if the disk cannot keep up,
+the new batches are dropped and counted, instead of growing the memory of the
+master without limit.
+
+The same thread deletes the data older than its retention (see
+DBHandler.prune) every PRUNE_INTERVAL.
+
+With a partition_period ('day' or 'week'), db_name is the directory of a
+time-partitioned database (see database.PartitionedDB) instead of a single
+file, and the retention deletes whole partition files.
+"""
+import queue
+import sqlite3
+import threading
+import time
+
+from database.DBHandler import DBHandler
+from database.PartitionedDB import PartitionedDB
+from servers import logs
+
+DB_QUEUE_SIZE      = 1000   # Batches waiting to be written before dropping
+COMMIT_DELAY       = 0.1    # (s) Wait for more batches before committing
+COMMIT_MAX_BATCHES = 100    # Batches written in a single commit, at most
+CLOSE_TIMEOUT      = 30     # (s) Time given to write the queue when closing
+PRUNE_INTERVAL     = 3600   # (s) Delete the old data every...
+
+log = logs.get_logger('database')
+
+_STOP = object()
+
+
+class DBWriter(object):
+    """ Writes to a DBHandler from a background thread.
+
+    :param db_name: name of the sqlite database
+    :param flush_histogram: servers.metrics.Histogram observing the
+                            duration of each commit (optional)
+    :param retention: dictionary {resolution: maximum age (s)} overriding
+                      database.DBHandler.RETENTION
+    :param partition_period: None for a single database file, or 'day' or
+                             'week' for a partitioned database in the
+                             directory db_name
+    """
+    def __init__(self, db_name='example.db', queue_size=DB_QUEUE_SIZE,
+                 commit_delay=COMMIT_DELAY, commit_max_batches=COMMIT_MAX_BATCHES,
+                 flush_histogram=None, retention=None,
+                 prune_interval=PRUNE_INTERVAL, partition_period=None):
+        self.db_name = db_name
+        self.partition_period = partition_period
+        self.retention = retention
+        self.prune_interval = prune_interval
+        self.commit_delay = commit_delay
+        self.commit_max_batches = commit_max_batches
+        self.flush_histogram = flush_histogram
+        self._queue = queue.Queue(queue_size)
+        # Counters, read by the metrics of the master server
+        self.dropped = 0     # batches dropped because the queue was full
+        self.written = 0     # batches written
+        self.commits = 0
+        self.errors = 0
+        self.pruned = 0      # raw rows (or partitions) deleted by the retention policy
+        self.rejected = 0    # late observations of a read-only partition
+        self.last_flush_duration = 0
+        self._ready = threading.Event()
+        self._open_error = None
+        self._thread = threading.Thread(target=self._run, name='db-writer')
+        self._thread.daemon = True
+        self._thread.start()
+        # The database (and its tables) exists once the constructor returns
+        self._ready.wait()
+        if self._open_error is not None:
+            raise self._open_error
+
+    @property
+    def depth(self):
+        """ Number of batches waiting to be written."""
+        return self._queue.qsize()
+
+    def add_database_entries(self, dictionaries):
+        """ Queues the observations of a db_tick (see
+        DBHandler.add_database_entries).
+
+        :return: False if the queue was full and the batch was dropped
+        """
+        return self._put(('entries', list(dictionaries)))
+
+    def register_new_metadata(self, user, dictionary):
+        """ Queues a metadata entry (see DBHandler.register_new_metadata)."""
+        return self._put(('metadata', user, dictionary))
+
+    def flush(self, timeout=None):
+        """ Waits until the batches queued so far are committed.
+
+        :return: False if the timeout expired
+        """
+        done = threading.Event()
+        self._queue.put(('flush', done), timeout=timeout)
+        return done.wait(timeout)
+
+    def close(self, timeout=CLOSE_TIMEOUT):
+        """ Writes the queued batches, and closes the database."""
+        if not self._thread.is_alive():
+            return
+        try:
+            self._queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            log.warning('Database queue full: %d batches lost', self.depth)
+            return
+        self._thread.join(timeout)
+
+    def _put(self, item):
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+            log.warning('Database queue full, batch dropped',
+                        extra={'sample': True})
+            return False
+        return True
+
+    def _run(self):
+        try:
+            if self.partition_period:
+                db_handler = PartitionedDB(self.db_name, self.partition_period,
+                                           retention=self.retention)
+            else:
+                db_handler = DBHandler(db_name=self.db_name, wal=True,
+                                       retention=self.retention)
+        except Exception as err:
+            # Raised by the constructor, instead of blocking it forever
+            self._open_error = err
+            return
+        finally:
+            self._ready.set()
+        next_prune = time.monotonic()
+        try:
+            while True:
+                try:
+                    item = self._queue.get(timeout=max(0, next_prune - time.monotonic()))
+                except queue.Empty:
+                    self._prune(db_handler)
+                    next_prune = time.monotonic() + self.prune_interval
+                    continue
+                if not self._write_group(db_handler, item):
+                    break
+        finally:
+            db_handler.close()
+
+    def _prune(self, db_handler):
+        start = time.perf_counter()
+        try:
+            pruned = db_handler.prune()
+        except sqlite3.Error as err:
+            self.errors += 1
+            log.warning('Could not delete the old data: %s', err)
+            return
+        self.pruned += pruned
+        if pruned:
+            log.info('Deleted %d old %s in %.1f s', pruned,
+                     'partitions' if self.partition_period else 'rows',
+                     time.perf_counter() - start)
+
+    def _write_group(self, db_handler, item):
+        """ Writes a batch, and those queued shortly after it, with a single
+        commit.
+
+        :return: False if the writer must stop
+        """
+        running = True
+        waiting = []      # flush events to set after the commit
+        batches = 0
+        deadline = time.monotonic() + self.commit_delay
+        while True:
+            if item is _STOP:
+                running = False
+                break
+            if item[0] == 'flush':
+                waiting.append(item[1])
+                break
+            self._write(db_handler, item)
+            batches += 1
+            if batches >= self.commit_max_batches:
+                break
+            try:
+                item = self._queue.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+        if not running:
+            # Write everything that is left before stopping
+            while True:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    continue
+                if item[0] == 'flush':
+                    waiting.append(item[1])
+                else:
+                    self._write(db_handler, item)
+                    batches += 1
+        start = time.perf_counter()
+        try:
+            db_handler.commit()
+        except sqlite3.Error as err:
+            self.errors += 1
+            log.warning('Database commit failed: %s', err, extra={'sample': True})
+        self.last_flush_duration = time.perf_counter() - start
+        if batches:
+            self.commits += 1
+            self.written += batches
+            if self.flush_histogram is not None:
+                self.flush_histogram.observe(self.last_flush_duration)
+        for done in waiting:
+            done.set()
+        return running
+
+    def _write(self, db_handler, item):
+        """ Writes a batch, which is discarded as a whole if it fails (see
+        DBHandler.atomic)."""
+        try:
+            with db_handler.atomic():
+                if item[0] == 'entries':
+                    rejected = db_handler.add_database_entries(item[1], commit=False)
+                    if rejected:
+                        self.rejected += rejected
+                        log.warning('%d late observations rejected: their partition '
+                                    'is read-only or expired', rejected,
+                                    extra={'sample': True})
+                else:
+                    db_handler.register_new_metadata(item[1], item[2])
+        except (sqlite3.Error, KeyError, TypeError) as err:
+            self.errors += 1
+            log.warning('Could not write to the database, batch discarded: %s',
+                        err, extra={'sample': True})
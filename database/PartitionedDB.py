@@ -0,0 +1,370 @@
+"""Time-partitioned database storage for lab-nanny
+
+In the partitioned mode, the observations are not written to a single
+database file, but to one sqlite file per lab and period (day or week):
+
+    db_partitions/catalog.db
+                 /lab7/lab7_rollups.db
+                 /lab7/lab7_2019-05-13.db
+                 /lab7/lab7_2019-05-20.db
+                 ...
+
+Each partition is a regular lab-nanny database (see database.DBHandler),
+with the raw rows and metadata of its lab for its period, starting at
+midnight (UTC), or on Mondays for the weekly ones. The catalog keeps the
+lab, time range, file and state of each partition, so a range query of the
+raw data only opens the partitions overlapping it.
+
+Instead of deleting rows (and vacuuming the file to get the space back), the
+retention of the raw data is applied by deleting whole partitions once they
+end before the retention limit. The partitions which ended more than
+COMPACT_DELAY ago are no longer written: they are compacted (VACUUM, without
+write-ahead log) and made read-only, so they can be backed up once. Late
+observations (e.g. from a node with a wrong clock) whose partition was
+compacted, or already deleted, are rejected before writing anything, and
+counted (PartitionedDB.rejected).
+
+The rollups of a lab (see DBHandler.add_rollups) are not kept in the
+partitions, which they would not outlive, but in a long-lived file per lab
+(<lab>_rollups.db), pruned with the retention of each resolution (see
+database.DBHandler.RETENTION).
+
+A PartitionedDB has the methods of a DBHandler used by the database writer
+(see database.DBWriter) and by the history queries (see servers.queries).
+"""
+import collections
+import contextlib
+import os
+import sqlite3
+import stat
+import time
+
+import numpy as np
+
+from database.DBHandler import DBHandler, RETENTION, RAW_RESOLUTION, \
+                               choose_resolution
+
+PARTITION_DIR   = 'db_partitions'
+CATALOG_FILE    = 'catalog.db'
+PERIODS         = {'day': 86400, 'week': 7*86400}
+OPEN_PARTITIONS = 256     # Partitions kept open (and uncommitted), at most
+COMPACT_DELAY   = 86400   # (s) Compact the partitions which ended before...
+ROLLUP_FILE     = '{}_rollups.db'
+# 1970-01-01 was a Thursday: the weeks start 4 days later, on Mondays
+_WEEK_OFFSET = 4*86400
+# The rows of a partition are only deleted with the partition
+_KEEP_EVERYTHING = dict((resolution, None) for resolution in RETENTION)
+
+
+def partition_start(t, period):
+    """ Returns the start (s) of the partition containing the time t."""
+    length = PERIODS[period]
+    offset = _WEEK_OFFSET if period == 'week' else 0
+    return ((t - offset)//length)*length + offset
+
+
+class PartitionedDB(object):
+    """ Database split in one sqlite file per lab and period.
+
+    :param directory: directory of the partitions and the catalog
+    :param period: 'day' or 'week'
+    :param retention: dictionary {resolution: maximum age (s)} overriding
+                      database.DBHandler.RETENTION; the partitions are
+                      deleted with the retention of the raw data
+    :param readonly: open the catalog and the partitions read-only (to
+                     query them from other threads than the writer)
+    """
+    def __init__(self, directory=PARTITION_DIR, period='day', retention=None,
+                 readonly=False, verbose=False):
+        if period not in PERIODS:
+            raise ValueError('Unknown partition period {}'.format(period))
+        self.directory = directory
+        self.period = period
+        self.length = PERIODS[period]
+        self.readonly = readonly
+        self.verbose = verbose
+        self.retention = dict(RETENTION)
+        self.retention.update(retention or {})
+        self._handlers = collections.OrderedDict()   # path -> DBHandler
+        self._paths = {}                             # (lab, start) -> path
+        self._rollups = {}                           # lab -> DBHandler
+        self._batch = None         # ExitStack of the savepoints of a batch
+        self._batch_paths = set()  # handlers in the batch (never evicted)
+        self.rejected = 0          # late observations, see add_database_entries
+        catalog_name = os.path.join(directory, CATALOG_FILE)
+        if readonly:
+            self.catalog = sqlite3.connect('file:{}?mode=ro'.format(catalog_name),
+                                           uri=True)
+            return
+        os.makedirs(directory, exist_ok=True)
+        self.catalog = sqlite3.connect(catalog_name)
+        self.catalog.execute('PRAGMA journal_mode=WAL')
+        self.catalog.execute('CREATE TABLE IF NOT EXISTS partitions '
+                             '(lab TEXT, start REAL, end REAL, path TEXT, '
+                             'readonly INTEGER, PRIMARY KEY (lab, start))')
+        self.catalog.commit()
+
+    def partitions(self, lab, start=None, end=None):
+        """ Returns the (path, start, end, readonly) of the partitions of a
+        lab overlapping [start, end], in chronological order."""
+        start = float('-inf') if start is None else start
+        end = float('inf') if end is None else end
+        rows = self.catalog.execute('SELECT path, start, end, readonly FROM partitions '
+                                    'WHERE lab=? AND end>? AND start<=? ORDER BY start',
+                                    (lab, start, end)).fetchall()
+        return [(os.path.join(self.directory, path), first, last, readonly)
+                for path, first, last, readonly in rows]
+
+    def partition(self, lab, t):
+        """ Returns the DBHandler of the partition of a lab containing the
+        time t, creating the partition if needed."""
+        return self._writer(self._partition_path(lab, t))
+
+    def _writer(self, path):
+        """ Returns the handler of a partition to write to it (in the
+        savepoint of the current batch, if any)."""
+        handler = self._open(path)
+        if self._batch is not None and path not in self._batch_paths:
+            self._batch.enter_context(handler.atomic())
+            self._batch_paths.add(path)
+        return handler
+
+    @contextlib.contextmanager
+    def atomic(self):
+        """ See DBHandler.atomic: each partition written in the block is
+        written in a savepoint, and all of them are rolled back if the block
+        raises."""
+        with contextlib.ExitStack() as stack:
+            self._batch = stack
+            try:
+                yield self
+            finally:
+                self._batch = None
+                self._batch_paths = set()
+
+    def rollup_path(self, lab):
+        """ Returns the name of the rollup file of a lab."""
+        return os.path.join(self.directory, lab, ROLLUP_FILE.format(lab))
+
+    def _rollup_handler(self, lab):
+        """ Returns the handler of the rollup file of a lab (None if it does
+        not exist, in the read-only mode)."""
+        handler = self._rollups.get(lab)
+        if handler is None:
+            path = self.rollup_path(lab)
+            if self.readonly and not os.path.exists(path):
+                return None
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            handler = self._rollups[lab] = DBHandler(
+                db_name=path, verbose=self.verbose, wal=not self.readonly,
+                retention=self.retention, readonly=self.readonly)
+        path = self.rollup_path(lab)
+        if self._batch is not None and path not in self._batch_paths:
+            self._batch.enter_context(handler.atomic())
+            self._batch_paths.add(path)
+        return handler
+
+    def _partition_path(self, lab, t):
+        """ Returns the file of the partition of a lab containing the time t,
+        creating the partition if needed.
+
+        :return: None if that partition cannot be written any more: it was
+                 compacted (read-only), or is older than the retention of
+                 the raw data (deleted)
+        """
+        start = partition_start(t, self.period)
+        path = self._paths.get((lab, start))
+        if path is not None:
+            return path
+        raw_age = self.retention.get(RAW_RESOLUTION)
+        if raw_age and start + self.length < time.time() - raw_age:
+            return None
+        row = self.catalog.execute('SELECT path, readonly FROM partitions '
+                                   'WHERE lab=? AND start=?', (lab, start)).fetchone()
+        if row is not None and row[1]:
+            return None
+        if row is None:
+            name = '{}_{}.db'.format(lab, time.strftime('%Y-%m-%d', time.gmtime(start)))
+            relative = os.path.join(lab, name)
+            self.catalog.execute('INSERT INTO partitions VALUES (?,?,?,?,0)',
+                                 (lab, start, start + self.length, relative))
+            self.catalog.commit()
+        else:
+            relative = row[0]
+        os.makedirs(os.path.join(self.directory, lab), exist_ok=True)
+        path = self._paths[(lab, start)] = os.path.join(self.directory, relative)
+        return path
+
+    def _open(self, path, readonly=None):
+        """ Returns the (cached) DBHandler of a partition file."""
+        handler = self._handlers.get(path)
+        if handler is not None:
+            self._handlers.move_to_end(path)
+            return handler
+        readonly = self.readonly if readonly is None else readonly
+        handler = DBHandler(db_name=path, verbose=self.verbose,
+                            wal=not readonly, retention=_KEEP_EVERYTHING,
+                            readonly=readonly, rollups=False)
+        self._handlers[path] = handler
+        # Closing a handler commits its pending writes, so the handlers of the
+        # current batch are kept open
+        for oldest in list(self._handlers):
+            if len(self._handlers) <= OPEN_PARTITIONS:
+                break
+            if oldest not in self._batch_paths:
+                self._handlers.pop(oldest).close()
+        return handler
+
+    def _close(self, path):
+        handler = self._handlers.pop(path, None)
+        if handler is not None:
+            handler.close()
+
+    def add_database_entries(self, dictionaries, commit=True):
+        """ See DBHandler.add_database_entries: the observations are grouped
+        by partition (lab, and period of their 'x'), and added to the
+        rollups of their lab.
+
+        The observations whose partition cannot be written any more (see
+        _partition_path) are rejected, and neither stored nor added to the
+        rollups.
+
+        :return: number of observations rejected
+        """
+        groups = collections.OrderedDict()     # path -> dictionaries
+        labs = collections.OrderedDict()       # lab -> dictionaries
+        now = time.time()
+        rejected = 0
+        for dictionary in dictionaries:
+            path = self._partition_path(dictionary['user'], dictionary.get('x', now))
+            if path is None:
+                rejected += 1
+                continue
+            groups.setdefault(path, []).append(dictionary)
+            labs.setdefault(dictionary['user'], []).append(dictionary)
+        for path, group in groups.items():
+            self._writer(path).add_database_entries(group, commit=commit)
+        for lab, group in labs.items():
+            rollups = self._rollup_handler(lab)
+            rollups.add_rollups(group)
+            if commit:
+                rollups.commit()
+        self.rejected += rejected
+        return rejected
+
+    def register_new_metadata(self, user, dictionary):
+        """ See DBHandler.register_new_metadata (in the current partition)."""
+        self.partition(user, time.time()).register_new_metadata(user, dictionary)
+
+    def commit(self):
+        for handler in list(self._handlers.values()) + list(self._rollups.values()):
+            handler.commit()
+
+    def close(self):
+        for handler in list(self._handlers.values()) + list(self._rollups.values()):
+            handler.close()
+        self._handlers.clear()
+        self._rollups.clear()
+        self.catalog.close()
+
+    def prune(self, now=None):
+        """ Deletes the partitions which ended before the retention limit of
+        the raw data, compacts those which ended before COMPACT_DELAY, and
+        deletes the rollups older than their retention.
+
+        :return: number of partitions deleted
+        """
+        now = time.time() if now is None else now
+        deleted = 0
+        raw_age = self.retention.get(RAW_RESOLUTION)
+        if raw_age:
+            rows = self.catalog.execute('SELECT lab, start, path FROM partitions '
+                                        'WHERE end<?', (now - raw_age,)).fetchall()
+            for lab, start, path in rows:
+                self.remove_partition(lab, start, path)
+                deleted += 1
+        rows = self.catalog.execute('SELECT lab, start, path FROM partitions '
+                                    'WHERE end<? AND readonly=0',
+                                    (now - COMPACT_DELAY,)).fetchall()
+        for lab, start, path in rows:
+            self.compact_partition(lab, start, path)
+        for lab in sorted(os.listdir(self.directory)):
+            if os.path.exists(self.rollup_path(lab)):
+                rollups = self._rollup_handler(lab)
+                rollups.prune_rollups(lab, now)
+                rollups.commit()
+        return deleted
+
+    def remove_partition(self, lab, start, path):
+        """ Deletes a partition file, and its entry in the catalog."""
+        full_path = os.path.join(self.directory, path)
+        self._close(full_path)
+        self._paths.pop((lab, start), None)
+        for name in (full_path, full_path + '-wal', full_path + '-shm'):
+            if os.path.exists(name):
+                os.remove(name)
+        self.catalog.execute('DELETE FROM partitions WHERE lab=? AND start=?',
+                             (lab, start))
+        self.catalog.commit()
+
+    def compact_partition(self, lab, start, path):
+        """ Compacts a partition which is no longer written, and makes it
+        read-only."""
+        full_path = os.path.join(self.directory, path)
+        self._close(full_path)
+        self._paths.pop((lab, start), None)
+        if os.path.exists(full_path):
+            db = sqlite3.connect(full_path)
+            db.execute('PRAGMA journal_mode=DELETE')
+            db.execute('VACUUM')
+            db.close()
+            mode = os.stat(full_path).st_mode
+            os.chmod(full_path, mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+        self.catalog.execute('UPDATE partitions SET readonly=1 WHERE lab=? AND start=?',
+                             (lab, start))
+        self.catalog.commit()
+
+    def choose_resolution(self, start, end, points=None, now=None):
+        """ See database.DBHandler.choose_resolution (the raw data is kept
+        in the partitions, and the rollups in the rollup files, each with
+        their own retention)."""
+        return choose_resolution(self.retention, start, end, points, now)
+
+    def query(self, lab, channel, start=None, end=None, points=None,
+              resolution=None):
+        """ See DBHandler.query: the raw data is read from the partitions
+        overlapping the range only, and the rollups from the rollup file
+        of the lab."""
+        start = 0 if start is None else start
+        end = time.time() if end is None else end
+        if resolution is None:
+            resolution = self.choose_resolution(start, end, points)
+        if resolution == RAW_RESOLUTION:
+            parts = self._query_partitions(lab, channel, start, end)
+        else:
+            rollups = self._rollup_handler(lab)
+            parts = [] if rollups is None else \
+                [rollups.query(lab, channel, start, end, resolution=resolution)]
+        keys = ('x', 'min', 'max', 'mean', 'count')
+        result = {'resolution': resolution}
+        for key in keys:
+            arrays = [part[key] for part in parts]
+            result[key] = np.concatenate(arrays) if arrays else \
+                np.zeros(0, dtype=int if key == 'count' else float)
+        return result
+
+    def _query_partitions(self, lab, channel, start, end):
+        """ Returns the raw data of a channel in each partition overlapping
+        [start, end] (see DBHandler.query)."""
+        parts = []
+        for path, _, _, readonly in self.partitions(lab, start, end):
+            if not os.path.exists(path):
+                continue
+            handler = self._open(path, readonly=bool(readonly) or self.readonly)
+            try:
+                parts.append(handler.query(lab, channel, start, end,
+                                           resolution=RAW_RESOLUTION))
+            except sqlite3.OperationalError:
+                # The channel did not exist in that partition
+                continue
+        return parts
@@ -0,0 +1,364 @@
+"""Full-rate columnar sample store for lab-nanny
+
+The database (see database.DBHandler) only keeps one observation per lab
+every DB_PERIODICITY. In the full-rate recording mode, the master also
+appends every sample received from the nodes to a SampleStore, so that short
+events (e.g. a laser unlocking for two seconds) can be investigated later.
+
+The samples are stored in columnar chunk files, one directory per lab and
+(UTC) day:
+
+    samples/lab7/2019-05-17/x.f64      times (float64, little endian)
+                           /ch0.f64    values of ch0 (float64, NaN if missing)
+                           ...
+                           /index.bin  one entry per block (see below)
+
+All the column files of a day have the same number of rows. The samples are
+buffered in memory per lab (BLOCK_ROWS rows, or FLUSH_INTERVAL seconds), and
+each full buffer is written by a background thread as one sequential block
+per column. After the columns, a (first time, last time, first row, number
+of rows) entry (4 float64) is appended to the index of the day, so a time
+range is found by reading the (small) index only, and the rows of the
+blocks overlapping it. Rows without an index entry (e.g. after a crash
+while writing a block) are discarded when the day is written again.
+
+Use read_samples to load a time range:
+
+    data = read_samples('samples', 'lab7', start, end, ['ch2'])
+    data['x'], data['ch2']   # NumPy arrays
+"""
+import os
+import queue
+import re
+import threading
+import time
+
+import numpy as np
+
+from servers import logs
+
+SAMPLES_DIR    = 'samples'
+BLOCK_ROWS     = 4096   # Rows buffered per lab before writing a block
+FLUSH_INTERVAL = 10     # (s) Write the partial blocks at least every...
+WRITE_QUEUE_SIZE = 1000  # Blocks waiting to be written before dropping
+DTYPE      = np.dtype('<f8')
+TIME_COLUMN = 'x'
+INDEX_FILE  = 'index.bin'
+INDEX_COLUMNS = 4       # first time, last time, first row, rows
+DAY_FORMAT = '%Y-%m-%d'
+
+# Keys of the node dictionaries which are not channels
+NON_CHANNEL_KEYS = ('user', 'error', 'x')
+# The lab and channel names sent by the nodes become file names
+_NAME = re.compile(r'^\w+$')
+
+log = logs.get_logger('database')
+
+_STOP = object()
+
+
+def day_of(t):
+    """ Returns the name of the (UTC) day of a timestamp."""
+    return time.strftime(DAY_FORMAT, time.gmtime(t))
+
+
+def column_file(directory, column):
+    return os.path.join(directory, '{}.f64'.format(column))
+
+
+class LabBuffer(object):
+    """ Samples of a lab (and day) waiting to be written.
+
+    :param columns: names of the channels, in the order of the rows of
+                    self.values
+    """
+    def __init__(self, lab, day, columns, rows=BLOCK_ROWS):
+        self.lab = lab
+        self.day = day
+        self.columns = {column: i for i, column in enumerate(columns)}
+        self.times = np.empty(rows, dtype=DTYPE)
+        self.values = np.full((len(columns), rows), np.nan, dtype=DTYPE)
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def full(self):
+        return self.count == len(self.times)
+
+    def add_column(self, column):
+        self.columns[column] = len(self.columns)
+        self.values = np.vstack([self.values,
+                                 np.full((1, len(self.times)), np.nan)])
+
+    def append(self, t, data_dict):
+        row = self.count
+        self.times[row] = t
+        values = self.values
+        for column, i in self.columns.items():
+            value = data_dict.get(column)
+            if value is not None:
+                values[i, row] = value
+        self.count += 1
+
+    def block(self):
+        """ Returns (lab, day, columns, times, values) with the buffered rows."""
+        columns = sorted(self.columns, key=self.columns.get)
+        return (self.lab, self.day, columns,
+                self.times[:self.count], self.values[:, :self.count])
+
+
+class SampleStore(object):
+    """ Appends every sample of the nodes to the chunk files.
+
+    SampleStore.append is called in the IOLoop, and only copies the values
+    to the buffer of the lab; the full buffers are handed to a background
+    thread, which writes them.
+
+    :param directory: root directory of the chunk files
+    """
+    def __init__(self, directory=SAMPLES_DIR, block_rows=BLOCK_ROWS,
+                 queue_size=WRITE_QUEUE_SIZE):
+        self.directory = directory
+        self.block_rows = block_rows
+        self._buffers = {}     # lab -> LabBuffer
+        self._queue = queue.Queue(queue_size)
+        # Counters, read by the metrics of the master server
+        self.samples = 0       # samples appended
+        self.blocks = 0        # blocks written
+        self.bytes = 0         # bytes written
+        self.dropped = 0       # blocks dropped because the queue was full
+        self.rejected = 0      # samples of a lab with an invalid name
+        self.errors = 0
+        os.makedirs(directory, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name='sample-writer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def depth(self):
+        """ Number of blocks waiting to be written."""
+        return self._queue.qsize()
+
+    def append(self, data_dict):
+        """ Adds the values of a node dictionary (see
+        servers.server_node.SlaveNode.convert_data).
+
+        Dictionaries flagged with an error carry no values, and are skipped,
+        as are the labs and channels whose names are not identifiers.
+        """
+        if data_dict.get('error', True):
+            return
+        lab = data_dict['user']
+        if not valid_name(lab):
+            self.rejected += 1
+            return
+        t = data_dict['x']
+        day = day_of(t)
+        buffer = self._buffers.get(lab)
+        if buffer is not None and buffer.day != day:
+            self._write(buffer)
+            buffer = None
+        if buffer is None:
+            buffer = self._buffers[lab] = LabBuffer(lab, day,
+                                                    channels_of(data_dict),
+                                                    self.block_rows)
+        else:
+            for channel in channels_of(data_dict):
+                if channel not in buffer.columns:
+                    buffer.add_column(channel)
+        buffer.append(t, data_dict)
+        self.samples += 1
+        if buffer.full:
+            self._write(buffer)
+            del self._buffers[lab]
+
+    def flush(self):
+        """ Hands the partial blocks to the writer thread (called every
+        FLUSH_INTERVAL by the master)."""
+        buffers, self._buffers = self._buffers, {}
+        for buffer in buffers.values():
+            if len(buffer):
+                self._write(buffer)
+
+    def close(self, timeout=30):
+        """ Writes the buffered samples, and stops the writer thread."""
+        self.flush()
+        if not self._thread.is_alive():
+            return
+        self._queue.put(_STOP, timeout=timeout)
+        self._thread.join(timeout)
+
+    def read(self, lab, start=None, end=None, channels=None):
+        """ See read_samples (only the samples already written are read)."""
+        return read_samples(self.directory, lab, start, end, channels)
+
+    def _write(self, buffer):
+        try:
+            self._queue.put_nowait(buffer.block())
+        except queue.Full:
+            self.dropped += 1
+            log.warning('Sample queue full, %d samples of %s dropped',
+                        len(buffer), buffer.lab, extra={'sample': True})
+
+    def _run(self):
+        while True:
+            block = self._queue.get()
+            if block is _STOP:
+                return
+            try:
+                self.bytes += write_block(self.directory, *block)
+                self.blocks += 1
+            except OSError as err:
+                self.errors += 1
+                log.warning('Could not write the samples of %s: %s', block[0],
+                            err, extra={'sample': True})
+
+
+def valid_name(name):
+    """ Whether a lab or channel name can be used as a file name (only
+    letters, digits and underscores)."""
+    return isinstance(name, str) and _NAME.match(name) is not None
+
+
+def channels_of(data_dict):
+    """ Returns the names of the numeric channels of a node dictionary
+    (skipping the invalid names, see valid_name)."""
+    return [key for key, value in data_dict.items()
+            if key not in NON_CHANNEL_KEYS and isinstance(value, (int, float))
+            and valid_name(key)]
+
+
+def write_block(directory, lab, day, columns, times, values):
+    """ Appends a block of rows to the chunk files of a lab and day.
+
+    :param columns: names of the rows of values
+    :param times: array with the times of the rows
+    :param values: 2D array (columns x rows)
+    :return: number of bytes written
+    """
+    day_directory = os.path.join(directory, lab, day)
+    os.makedirs(day_directory, exist_ok=True)
+    index_name = os.path.join(day_directory, INDEX_FILE)
+    index = read_index(day_directory)
+    first_row = int(index[-1, 2] + index[-1, 3]) if len(index) else 0
+    # Crash recovery: rows written without their index entry are discarded
+    if os.path.exists(index_name) \
+            and os.path.getsize(index_name) != index.nbytes:
+        truncate(index_name, index.nbytes)
+    size = first_row*DTYPE.itemsize
+    rows = len(times)
+    written = 0
+    existing = [name[:-4] for name in os.listdir(day_directory)
+                if name.endswith('.f64')]
+    missing = np.full(rows, np.nan, dtype=DTYPE)
+    for column in [TIME_COLUMN] + columns + \
+            [name for name in existing if name != TIME_COLUMN and name not in columns]:
+        if column == TIME_COLUMN:
+            data = times
+        elif column in columns:
+            data = values[columns.index(column)]
+        else:
+            data = missing
+        name = column_file(day_directory, column)
+        with open(name, 'ab') as f:
+            current = f.tell()
+            if current > size:
+                f.truncate(size)
+                f.seek(size)
+            elif current < size:
+                # New column (or interrupted write): missing rows are NaN
+                f.write(np.full((size - current)//DTYPE.itemsize, np.nan,
+                                dtype=DTYPE).tobytes())
+            f.write(np.ascontiguousarray(data, dtype=DTYPE).tobytes())
+        written += rows*DTYPE.itemsize
+    entry = np.array([times[0], times[-1], first_row, rows], dtype=DTYPE)
+    with open(index_name, 'ab') as f:
+        f.write(entry.tobytes())
+    return written + entry.nbytes
+
+
+def truncate(name, size):
+    with open(name, 'r+b') as f:
+        f.truncate(size)
+
+
+def read_index(day_directory):
+    """ Returns the index of a day as an array (blocks x INDEX_COLUMNS)."""
+    name = os.path.join(day_directory, INDEX_FILE)
+    if not os.path.exists(name):
+        return np.zeros((0, INDEX_COLUMNS), dtype=DTYPE)
+    index = np.fromfile(name, dtype=DTYPE)
+    # A partially written entry is ignored
+    entries = len(index)//INDEX_COLUMNS
+    return index[:entries*INDEX_COLUMNS].reshape(entries, INDEX_COLUMNS)
+
+
+def days_in_range(lab_directory, start=None, end=None):
+    """ Returns the (sorted) days of a lab overlapping [start, end]."""
+    if not os.path.isdir(lab_directory):
+        return []
+    days = sorted(name for name in os.listdir(lab_directory)
+                  if os.path.isdir(os.path.join(lab_directory, name)))
+    first = day_of(start) if start is not None else None
+    last = day_of(end) if end is not None else None
+    return [day for day in days
+            if (first is None or day >= first) and (last is None or day <= last)]
+
+
+def read_samples(directory, lab, start=None, end=None, channels=None):
+    """ Loads the samples of a lab in a time range.
+
+    Only the blocks overlapping the range (according to the index of each
+    day) are read from disk.
+
+    :param directory: root directory of the chunk files
+    :param start, end: time range (s), None for no limit
+    :param channels: list of channels (all of them by default)
+    :return: dictionary {'x': times, channel: values} of NumPy arrays
+    """
+    lab_directory = os.path.join(directory, lab)
+    days = days_in_range(lab_directory, start, end)
+    if channels is None:
+        channels = sorted(set(name[:-4] for day in days
+                              for name in os.listdir(os.path.join(lab_directory, day))
+                              if name.endswith('.f64') and name[:-4] != TIME_COLUMN))
+    parts = {column: [] for column in [TIME_COLUMN] + list(channels)}
+    for day in days:
+        day_directory = os.path.join(lab_directory, day)
+        index = read_index(day_directory)
+        selected = np.ones(len(index), dtype=bool)
+        if start is not None:
+            selected &= index[:, 1] >= start
+        if end is not None:
+            selected &= index[:, 0] <= end
+        if not selected.any():
+            continue
+        blocks = index[selected]
+        first_row = int(blocks[0, 2])
+        rows = int(blocks[-1, 2] + blocks[-1, 3]) - first_row
+        times = read_column(day_directory, TIME_COLUMN, first_row, rows)
+        mask = np.ones(rows, dtype=bool)
+        if start is not None:
+            mask &= times >= start
+        if end is not None:
+            mask &= times <= end
+        parts[TIME_COLUMN].append(times[mask])
+        for channel in channels:
+            parts[channel].append(read_column(day_directory, channel,
+                                              first_row, rows)[mask])
+    return {column: np.concatenate(arrays) if arrays else np.zeros(0, dtype=DTYPE)
+            for column, arrays in parts.items()}
+
+
+def read_column(day_directory, column, first_row, rows):
+    """ Reads some rows of a column (NaN if the column does not exist)."""
+    name = column_file(day_directory, column)
+    values = np.full(rows, np.nan, dtype=DTYPE)
+    if not os.path.exists(name):
+        return values
+    data = np.fromfile(name, dtype=DTYPE, count=rows,
+                       offset=first_row*DTYPE.itemsize)
+    values[:len(data)] = data
+    return values
@@ -1,69 +1,275 @@
-import matplotlib.pyplot as plt
-import sqlite3 as sql
-import datetime
+"""Loading the historical data of lab-nanny into NumPy arrays
+
+The rows of a lab table are fetched in chunks of CHUNK_ROWS (fetchmany), and
+each chunk is converted to arrays at once, so loading months of data never
+builds a Python list per row. load_lab counts the rows first and fills
+preallocated arrays, so the memory used is that of the result plus one
+chunk; iter_lab yields the chunks themselves, for data which does not fit in
+memory:
+
+    from database.database_reading import load_lab, load_events, to_datetime64
+
+    data = load_lab('example.db', 'lab7', ['ch2', 'ch3'], start=time.time()-604800)
+    data['x'], data['ch2']                 # NumPy arrays (NaN where missing)
+    events = load_events('example.db', 'lab7', start=time.time()-604800)
+    events['connect'], events['disconnect']
+    to_datetime64(data['x'])               # e.g. to plot with matplotlib
+
+The source is the name of a database file, or the directory of a
+partitioned database (see database.PartitionedDB), in which case only the
+partitions overlapping the time range are read. The databases are opened
+read-only, so they can be read while the master writes them.
+
+Run as a script (python -m database.database_reading), it plots the last
+week of data of a lab, as the original analysis script did.
+"""
+import argparse
+import os
+import sqlite3
 import time
-from matplotlib import dates
-
-def time_from_timestamps(timestamps):
-    dts = map(datetime.datetime.fromtimestamp,timestamps)
-    return dates.date2num(dts)
-
-DBNAME = '../example.db'
-
-# Import sql data
-
-MAXTIME = time.time()-604800
-
-
-conn = sql.connect(DBNAME)
-cur = conn.cursor()
-
-cur.execute('select x,ch2,ch3,ch4 from lab7 where error=? and x>?',(0,MAXTIME,))
-myvals = cur.fetchall()
-
-cur.execute("SELECT time FROM metadata_list where metadata LIKE '%closed%' and time>?",(MAXTIME,))
-disconnect_vals = cur.fetchall()
-cur.execute("SELECT time FROM metadata_list where metadata NOT LIKE '%closed%' and time>?",(MAXTIME,))
-reconnect_vals = cur.fetchall()
-
-timestamps = []
-temperatures = []
-trap_volt = []
-repump_volt = []
-
-for item in myvals:
-    timestamps.append(item[0])
-    temperatures.append(item[1])
-    trap_volt.append(item[2])
-    repump_volt.append(item[3])
-disconnect_times = [val[0] for val in disconnect_vals]
-reconnect_times = [val[0] for val in reconnect_vals]
-fds = time_from_timestamps(timestamps)
-d_times = time_from_timestamps(disconnect_times)
-c_times = time_from_timestamps(reconnect_times)
-
-fig = plt.figure()
-ax = fig.add_subplot(111)
-temp_line = ax.plot(fds,temperatures,'+', markersize = 3,color='dodgerblue')
-for ii in c_times:
-    plt.axvline(x=ii,ls='--',color='dimgray')
-for ii in d_times:
-    plt.axvline(x=ii,ls='--',color='lightcoral')
-plt.ylabel('Temperature [Celsius]',color='dodgerblue')
-
-#Format
-hfmt = dates.DateFormatter('%d/%m %H:%M')
-ax.xaxis.set_major_formatter(hfmt)
-plt.xticks(rotation='vertical')
-ax.xaxis.grid(True)
-plt.subplots_adjust(bottom=.2   )
-
-
-bx = ax.twinx()
-trap_line = bx.plot(fds, trap_volt, 'o--', color='orange', markersize=3,
-                    label='trap')
-repumper_line = bx.plot(fds, repump_volt, '<--', color='indianred', markersize=3,
-                        label='repumper')
-plt.legend()
-plt.ylabel('Voltage [V]', color='orange')
-plt.show()
\ No newline at end of file
+
+import numpy as np
+
+from database.DBHandler import NON_DATA_COLUMNS
+from database.PartitionedDB import PartitionedDB, CATALOG_FILE
+
+DBNAME     = 'example.db'
+CHUNK_ROWS = 65536    # Rows fetched from sqlite at once
+CONNCLOSEDSTR = 'Connection closed'   # see servers.server_master
+
+
+def to_datetime64(timestamps):
+    """ Converts an array of timestamps (s) to datetime64 (UTC, us)."""
+    timestamps = np.asarray(timestamps, dtype=float)
+    return (timestamps*1e6).round().astype('int64').astype('datetime64[us]')
+
+
+def database_files(source, lab=None, start=None, end=None):
+    """ Returns the database files of a source overlapping [start, end].
+
+    :param source: database file, or directory of a partitioned database
+    """
+    if not os.path.isdir(source):
+        return [source]
+    catalog = os.path.join(source, CATALOG_FILE)
+    if not os.path.exists(catalog):
+        raise ValueError('{} is not a partitioned database'.format(source))
+    partitioned = PartitionedDB(source, readonly=True)
+    try:
+        if lab is not None:
+            return [path for path, _, _, _ in partitioned.partitions(lab, start, end)]
+        labs = [row[0] for row in partitioned.catalog.execute(
+            'SELECT DISTINCT lab FROM partitions ORDER BY lab')]
+        return sorted(set(path for name in labs for path, _, _, _ in
+                          partitioned.partitions(name, start, end)))
+    finally:
+        partitioned.close()
+
+
+def _connect(name):
+    return sqlite3.connect('file:{}?mode=ro'.format(name), uri=True)
+
+
+def _table_columns(cursor, table):
+    """ Returns the names of the REAL columns of a table ([] if missing)."""
+    cursor.execute('PRAGMA table_info({})'.format(table))
+    return [row[1] for row in cursor.fetchall() if row[2] == 'REAL']
+
+
+def channels_of_lab(source, lab):
+    """ Returns the names of the channels recorded for a lab."""
+    channels = []
+    for name in database_files(source, lab):
+        db = _connect(name)
+        try:
+            for column in _table_columns(db.cursor(), lab):
+                if column not in NON_DATA_COLUMNS and column not in channels:
+                    channels.append(column)
+        finally:
+            db.close()
+    return channels
+
+
+def _range_clause(start, end):
+    clause = 'error=0'
+    parameters = []
+    if start is not None:
+        clause += ' AND x>=?'
+        parameters.append(start)
+    if end is not None:
+        clause += ' AND x<=?'
+        parameters.append(end)
+    return clause, parameters
+
+
+def _select(cursor, lab, channels, start, end, what):
+    """ Runs a query on the rows of a lab in [start, end].
+
+    The channels missing from the table are selected as NULL.
+
+    :return: False if the lab has no table in this database
+    """
+    existing = _table_columns(cursor, lab)
+    if not existing:
+        return False
+    columns = ','.join(channel if channel in existing else 'NULL'
+                       for channel in channels)
+    clause, parameters = _range_clause(start, end)
+    cursor.execute(what.format(columns=columns, lab=lab, clause=clause),
+                   parameters)
+    return True
+
+
+def iter_lab(source, lab, channels=None, start=None, end=None,
+             chunk_rows=CHUNK_ROWS):
+    """ Yields the data of a lab in [start, end], chunk by chunk.
+
+    :param source: database file, or directory of a partitioned database
+    :param channels: list of channels (all of them by default)
+    :param start, end: time range (s), None for no limit
+    :return: iterator of (x, values) arrays, x with the times of the rows
+             and values with one column per channel (NaN where missing)
+    """
+    if channels is None:
+        channels = channels_of_lab(source, lab)
+    channels = list(channels)
+    for name in database_files(source, lab, start, end):
+        db = _connect(name)
+        try:
+            cursor = db.cursor()
+            if not _select(cursor, lab, ['x'] + channels, start, end,
+                           'SELECT {columns} FROM {lab} WHERE {clause} ORDER BY x'):
+                continue
+            while True:
+                rows = cursor.fetchmany(chunk_rows)
+                if not rows:
+                    break
+                # None (NULL) becomes NaN
+                chunk = np.array(rows, dtype=float).reshape(-1, len(channels) + 1)
+                yield chunk[:, 0], chunk[:, 1:]
+        finally:
+            db.close()
+
+
+def count_rows(source, lab, start=None, end=None):
+    """ Returns the number of rows (without errors) of a lab in [start, end]."""
+    count = 0
+    for name in database_files(source, lab, start, end):
+        db = _connect(name)
+        try:
+            cursor = db.cursor()
+            if _select(cursor, lab, [], start, end,
+                       'SELECT count(*) FROM {lab} WHERE {clause}'):
+                count += cursor.fetchone()[0]
+        finally:
+            db.close()
+    return count
+
+
+def load_lab(source, lab, channels=None, start=None, end=None,
+             chunk_rows=CHUNK_ROWS):
+    """ Loads the data of a lab in [start, end] into NumPy arrays.
+
+    :param source: database file, or directory of a partitioned database
+    :param channels: list of channels (all of them by default)
+    :param start, end: time range (s), None for no limit
+    :return: dictionary {'x': times, channel: values} of float arrays
+    """
+    if channels is None:
+        channels = channels_of_lab(source, lab)
+    channels = list(channels)
+    rows = count_rows(source, lab, start, end)
+    x = np.empty(rows)
+    values = np.empty((rows, len(channels)))
+    filled = 0
+    for times, chunk in iter_lab(source, lab, channels, start, end, chunk_rows):
+        # Rows written after the count are left out
+        n = min(len(times), rows - filled)
+        x[filled:filled + n] = times[:n]
+        values[filled:filled + n] = chunk[:n]
+        filled += n
+    data = {'x': x[:filled]}
+    for i, channel in enumerate(channels):
+        data[channel] = values[:filled, i]
+    return data
+
+
+def load_events(source, lab=None, start=None, end=None):
+    """ Loads the connections and disconnections of the nodes, from the
+    metadata table.
+
+    :param lab: name of a lab, or None for all of them
+    :return: dictionary {'connect': times, 'disconnect': times} of arrays
+    """
+    events = {'connect': [], 'disconnect': []}
+    for name in database_files(source, lab, start, end):
+        db = _connect(name)
+        try:
+            sql_string = 'SELECT time, metadata LIKE ? FROM metadata_list'
+            parameters = ['%{}%'.format(CONNCLOSEDSTR)]
+            conditions = []
+            if lab is not None:
+                conditions.append('labID IN (SELECT _id FROM laboratories '
+                                  'WHERE labNAME=?)')
+                parameters.append(lab)
+            if start is not None:
+                conditions.append('time>=?')
+                parameters.append(start)
+            if end is not None:
+                conditions.append('time<=?')
+                parameters.append(end)
+            if conditions:
+                sql_string += ' WHERE ' + ' AND '.join(conditions)
+            try:
+                rows = db.execute(sql_string + ' ORDER BY time',
+                                  parameters).fetchall()
+            except sqlite3.OperationalError:
+                # Database without metadata
+                continue
+        finally:
+            db.close()
+        rows = np.array(rows, dtype=float).reshape(-1, 2)
+        closed = rows[:, 1].astype(bool)
+        events['disconnect'].append(rows[closed, 0])
+        events['connect'].append(rows[~closed, 0])
+    return {kind: np.sort(np.concatenate(arrays)) if arrays else np.zeros(0)
+            for kind, arrays in events.items()}
+
+
+def plot_lab(source, lab, channels, start=None, end=None):
+    """ Plots some channels of a lab, with the connections (gray) and
+    disconnections (red) of its node."""
+    import matplotlib.pyplot as plt
+
+    data = load_lab(source, lab, channels, start, end)
+    events = load_events(source, lab, start, end)
+    fig = plt.figure()
+    ax = fig.add_subplot(111)
+    times = to_datetime64(data['x'])
+    for channel in channels:
+        ax.plot(times, data[channel], '+', markersize=3, label=channel)
+    for t in to_datetime64(events['connect']):
+        ax.axvline(x=t, ls='--', color='dimgray')
+    for t in to_datetime64(events['disconnect']):
+        ax.axvline(x=t, ls='--', color='lightcoral')
+    ax.xaxis.grid(True)
+    plt.xticks(rotation='vertical')
+    plt.subplots_adjust(bottom=.2)
+    plt.legend()
+    plt.show()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-db","--database",
+                        help="database file, or directory of a partitioned database",
+                        default=DBNAME)
+    parser.add_argument("-l","--lab",help="name of the lab",default='lab7')
+    parser.add_argument("-ch","--channels",
+                        help="channels to plot, e.g. 'ch2,ch3,ch4'",
+                        default='ch2,ch3,ch4')
+    parser.add_argument("-d","--days",help="days of data to plot",
+                        type=float,default=7)
+    args = parser.parse_args()
+    plot_lab(args.database, args.lab, args.channels.split(','),
+             start=time.time() - args.days*86400)
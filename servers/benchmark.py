@@ -0,0 +1,432 @@
+#!/usr/bin/python
+"""Load and benchmark harness for lab-nanny
+
+Runs a real MasterServer on localhost against a virtual fleet of nodes and
+browser clients, and reports how the master copes with the load:
+-- the nodes are SlaveNode instances whose arduino is replaced by a
+   VirtualArduino (no serial port nor pty is opened), so hundreds of them
+   can be run as coroutines inside a few processes.
+-- the clients are websocket connections to the client socket, which
+   decode every frame (full or delta) and measure the end-to-end latency as
+   the time between the acquisition of a sample in a node (its 'x' value)
+   and its reception in the client.
+The master statistics (ticks, overruns, node messages) are read from its
+'/metrics' address (see servers.metrics), and its CPU time and memory from
+/proc (Linux only).
+
+After a warm-up period, the harness measures during a fixed time and writes
+the results to a JSON file, e.g.
+    {'config':  {...},
+     'nodes':   {'replies':..., 'replies_per_s':..., 'connected':...},
+     'master':  {'ticks':..., 'tick_overrun_rate':..., 'cpu_percent':...,
+                 'rss_kb':..., 'max_rss_kb':...},
+     'clients': {'frames_per_s':..., 'bytes_per_s':...,
+                 'latency_ms': {'p50':..., 'p90':..., 'p99':..., 'max':...}}}
+
+Run from the root folder using 'python -m servers.benchmark', e.g.
+    python -m servers.benchmark -n 300 -c 20 -d 60 -o results.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import signal
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+import numpy as np
+import tornado.ioloop as ioloop
+import tornado.websocket
+from tornado import gen
+
+from servers.header import TFORMAT
+from servers.server_master import MasterServer, signal_handler, \
+                                  PERIODICITY, PUBLISH_TICK, PUBLISH_EVENT, \
+                                  SLAVE_SOCKETNAME, CLIENT_SOCKETNAME, \
+                                  METRICS_ADDR
+from servers.server_node import SlaveNode
+
+BENCH_PORT       = 8101    # Port of the master server under test
+BENCH_SHARD_PORT = 8102    # Port of its shards (if any)
+NUM_NODES        = 100
+NUM_CLIENTS      = 10
+NODE_PROCESSES   = 2
+CLIENT_PROCESSES = 1
+DURATION         = 30      # (s) Measurement time
+WARMUP           = 5       # (s) Time given to the fleet to connect
+STARTUP_TIMEOUT  = 20      # (s) Time given to the master to start listening
+RESULTS_FILE     = 'benchmark.json'
+NUM_ANALOG       = 8       # Analog values returned by a virtual arduino
+ADC_RANGE        = 1023
+
+
+class VirtualArduino(object):
+    """ Replaces SerialCommManager in the virtual nodes: each poll returns
+    random analog readings immediately."""
+    def __init__(self):
+        self.polls = 0
+
+    def is_arduino_connected(self):
+        return True
+
+    def poll_arduino(self, handshake_func=None, command=None):
+        self.polls += 1
+        return time.time(), [random.randint(0, ADC_RANGE) for _ in range(NUM_ANALOG)]
+
+    def init_arduino_connection(self):
+        pass
+
+    def cleanup(self):
+        pass
+
+
+class VirtualNode(SlaveNode):
+    """ SlaveNode connected to a VirtualArduino."""
+    def connect_to_arduino(self):
+        self.is_arduino_connected = True
+        return VirtualArduino()
+
+
+def run_nodes(references, master_location, binary, end_time, results):
+    """ Entry point of the node processes: runs a virtual node for each
+    reference until end_time, and reports the number of polls answered."""
+    sys.stdout = open(os.devnull, 'w')
+    nodes = [VirtualNode(verbose=False,
+                         masterWSlocation=master_location,
+                         reference=reference,
+                         binary=binary) for reference in references]
+    loop = ioloop.IOLoop.current()
+    for node in nodes:
+        loop.add_callback(keep_node_alive, node)
+    loop.call_at(loop.time() + end_time - time.time(), loop.stop)
+    loop.start()
+    results.put({'polls': sum(node.arduino_COMS.polls for node in nodes),
+                 'connected': sum(node.is_master_connected for node in nodes)})
+
+
+@gen.coroutine
+def keep_node_alive(node):
+    """ Runs the keepalive_ws loop of a node, reconnecting if needed."""
+    while True:
+        try:
+            yield node.keepalive_ws()
+        except Exception:
+            pass
+        node.is_master_connected = False
+        node.metadata_registered = False
+        yield gen.sleep(1)
+
+
+def run_clients(num_clients, client_location, subscription, start_time,
+                end_time, results):
+    """ Entry point of the client processes: opens num_clients websockets,
+    and reports the frames, bytes and latencies measured between start_time
+    and end_time."""
+    stats = {'frames': 0, 'bytes': 0, 'latencies': []}
+    loop = ioloop.IOLoop.current()
+    for _ in range(num_clients):
+        loop.add_callback(virtual_client, client_location, subscription,
+                          start_time, end_time, stats)
+    loop.call_at(loop.time() + end_time - time.time(), loop.stop)
+    loop.start()
+    results.put(stats)
+
+
+@gen.coroutine
+def virtual_client(client_location, subscription, start_time, end_time, stats):
+    """ Client that decodes the frames sent by the master and measures the
+    latency of every new sample."""
+    try:
+        connection = yield tornado.websocket.websocket_connect(client_location)
+    except IOError:
+        return
+    if subscription:
+        connection.write_message(subscription)
+    last_x = {}    # lab -> time of the last sample received
+    while True:
+        message = yield connection.read_message()
+        if message is None:
+            return
+        now = time.time()
+        if now < start_time or now > end_time:
+            continue
+        stats['frames'] += 1
+        stats['bytes'] += len(message)
+        contents = json.loads(message)
+        if 'frame' in contents:
+            node_data = contents.get('nodes', {})
+        else:
+            node_data = contents
+        for data in node_data.values():
+            x = data.get('x') if isinstance(data, dict) else None
+            lab = data.get('user') if isinstance(data, dict) else None
+            if x is None or last_x.get(lab) == x:
+                continue
+            last_x[lab] = x
+            stats['latencies'].append(now - x)
+
+
+def run_master(workdir, master_kwargs):
+    """ Entry point of the master process. The database and the log are
+    written to workdir."""
+    os.chdir(workdir)
+    sys.stdout = open('master.log', 'w')
+    sys.stderr = sys.stdout
+    signal.signal(signal.SIGINT, signal_handler)
+    MasterServer(**master_kwargs)
+
+
+def read_metrics(port):
+    """ Returns the metrics of the master as a dictionary {name: value},
+    adding up the values of the samples with different labels."""
+    url = 'http://127.0.0.1:{}{}'.format(port, METRICS_ADDR)
+    with urllib.request.urlopen(url, timeout=5) as response:
+        text = response.read().decode()
+    metrics = {}
+    for line in text.splitlines():
+        if not line or line.startswith('#'):
+            continue
+        sample, value = line.rsplit(' ', 1)
+        name = sample.split('{', 1)[0]
+        metrics[name] = metrics.get(name, 0) + float(value)
+    return metrics
+
+
+def wait_for_master(port, timeout=STARTUP_TIMEOUT):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            return read_metrics(port)
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.2)
+    raise RuntimeError('The master server did not start in {} s'.format(timeout))
+
+
+def process_tree(pid):
+    """ Returns the pid of a process and those of its children (e.g. the
+    shards of the master)."""
+    pids = [pid]
+    try:
+        with open('/proc/{0}/task/{0}/children'.format(pid)) as children:
+            pids.extend(int(child) for child in children.read().split())
+    except IOError:
+        pass
+    return pids
+
+
+def cpu_time(pids):
+    """ Returns the CPU time (s, user+system) used by a list of processes."""
+    total = 0
+    for pid in pids:
+        try:
+            with open('/proc/{}/stat'.format(pid)) as stat:
+                fields = stat.read().rsplit(')', 1)[1].split()
+        except IOError:
+            continue
+        total += int(fields[11]) + int(fields[12])   # utime, stime
+    return total/float(os.sysconf('SC_CLK_TCK'))
+
+
+def memory(pids):
+    """ Returns the (current, peak) resident memory (kB) of a list of
+    processes."""
+    rss, max_rss = 0, 0
+    for pid in pids:
+        try:
+            with open('/proc/{}/status'.format(pid)) as status:
+                for line in status:
+                    if line.startswith('VmRSS:'):
+                        rss += int(line.split()[1])
+                    elif line.startswith('VmHWM:'):
+                        max_rss += int(line.split()[1])
+        except IOError:
+            continue
+    return rss, max_rss
+
+
+def percentiles(values):
+    if not len(values):
+        return None
+    values = np.asarray(values)*1000
+    return {'p50': float(np.percentile(values, 50)),
+            'p90': float(np.percentile(values, 90)),
+            'p99': float(np.percentile(values, 99)),
+            'max': float(values.max()),
+            'mean': float(values.mean())}
+
+
+def split(items, parts):
+    """ Splits a list in (at most) parts chunks of similar length."""
+    return [chunk for chunk in (items[ii::parts] for ii in range(parts)) if chunk]
+
+
+def run_benchmark(num_nodes=NUM_NODES,
+                  num_clients=NUM_CLIENTS,
+                  node_processes=NODE_PROCESSES,
+                  client_processes=CLIENT_PROCESSES,
+                  duration=DURATION,
+                  warmup=WARMUP,
+                  port=BENCH_PORT,
+                  shard_port=BENCH_SHARD_PORT,
+                  periodicity=PERIODICITY,
+                  publish_mode=PUBLISH_TICK,
+                  delta_frames=False,
+                  shards=0,
+                  binary=False,
+                  subscription=None):
+    """ Runs the benchmark and returns the results as a dictionary."""
+    config = dict(locals())
+    workdir = tempfile.mkdtemp(prefix='nanny-bench-')
+    master_kwargs = {'socketport': port,
+                     'periodicity': periodicity,
+                     'publish_mode': publish_mode,
+                     'delta_frames': delta_frames,
+                     'shards': shards,
+                     'shard_port': shard_port,
+                     'verbose': False}
+    master = multiprocessing.Process(target=run_master,
+                                     args=(workdir, master_kwargs))
+    master.start()
+    processes = []
+    try:
+        wait_for_master(port)
+        print('(BCH  {}) Master running (pid {}), logs in {}'\
+              .format(time.strftime(TFORMAT), master.pid, workdir))
+
+        node_port = shard_port if shards else port
+        master_location = 'ws://127.0.0.1:{}{}'.format(node_port, SLAVE_SOCKETNAME)
+        client_location = 'ws://127.0.0.1:{}{}'.format(port, CLIENT_SOCKETNAME)
+        start_time = time.time() + warmup
+        end_time = start_time + duration
+
+        node_results = multiprocessing.Queue()
+        client_results = multiprocessing.Queue()
+        references = ['bench{:04d}'.format(ii) for ii in range(num_nodes)]
+        for chunk in split(references, node_processes):
+            processes.append(multiprocessing.Process(
+                target=run_nodes,
+                args=(chunk, master_location, binary, end_time, node_results)))
+        client_chunks = split(list(range(num_clients)), client_processes)
+        for chunk in client_chunks:
+            processes.append(multiprocessing.Process(
+                target=run_clients,
+                args=(len(chunk), client_location, subscription,
+                      start_time, end_time, client_results)))
+        for process in processes:
+            process.start()
+        print('(BCH  {}) {} nodes and {} clients started, measuring for {} s'\
+              .format(time.strftime(TFORMAT), num_nodes, num_clients, duration))
+
+        time.sleep(max(0, start_time - time.time()))
+        metrics_start = read_metrics(port)
+        cpu_start = cpu_time(process_tree(master.pid))
+        time.sleep(max(0, end_time - time.time()))
+        metrics_end = read_metrics(port)
+        pids = process_tree(master.pid)
+        cpu_end = cpu_time(pids)
+        rss, max_rss = memory(pids)
+
+        nodes = [node_results.get(timeout=warmup + 30)
+                 for _ in split(references, node_processes)]
+        clients = [client_results.get(timeout=warmup + 30)
+                   for _ in client_chunks]
+    finally:
+        for process in processes:
+            process.join(5)
+            if process.is_alive():
+                process.terminate()
+        if master.is_alive():
+            os.kill(master.pid, signal.SIGINT)
+            master.join(10)
+            if master.is_alive():
+                master.terminate()
+
+    def delta(name):
+        return metrics_end.get(name, 0) - metrics_start.get(name, 0)
+
+    ticks = delta('nanny_tick_duration_seconds_count')
+    replies = delta('nanny_node_messages_total')
+    frames = sum(stats['frames'] for stats in clients)
+    sent_bytes = sum(stats['bytes'] for stats in clients)
+    latencies = [latency for stats in clients for latency in stats['latencies']]
+    return {'config': config,
+            'nodes': {'connected': int(metrics_end.get('nanny_connected_nodes', 0)),
+                      'replies': int(replies),
+                      'replies_per_s': replies/duration,
+                      'polls_answered': sum(stats['polls'] for stats in nodes)},
+            'master': {'ticks': int(ticks),
+                       'ticks_per_s': ticks/duration,
+                       'tick_overruns': int(delta('nanny_tick_overruns_total')),
+                       'tick_overrun_rate': delta('nanny_tick_overruns_total')/ticks
+                                            if ticks else None,
+                       'tick_duration_mean_ms': 1000*delta('nanny_tick_duration_seconds_sum')/ticks
+                                                if ticks else None,
+                       'cpu_percent': 100*(cpu_end - cpu_start)/duration,
+                       'rss_kb': rss,
+                       'max_rss_kb': max_rss,
+                       'processes': len(pids)},
+            'clients': {'connected': int(metrics_end.get('nanny_connected_clients', 0)),
+                        'frames': frames,
+                        'frames_per_s': frames/duration,
+                        'bytes': sent_bytes,
+                        'bytes_per_s': sent_bytes/duration,
+                        'samples': len(latencies),
+                        'latency_ms': percentiles(latencies)}}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n","--nodes",help="number of virtual nodes",
+                        type=int,default=NUM_NODES)
+    parser.add_argument("-c","--clients",help="number of virtual clients",
+                        type=int,default=NUM_CLIENTS)
+    parser.add_argument("-np","--node_processes",help="processes running the virtual nodes",
+                        type=int,default=NODE_PROCESSES)
+    parser.add_argument("-cp","--client_processes",help="processes running the virtual clients",
+                        type=int,default=CLIENT_PROCESSES)
+    parser.add_argument("-d","--duration",help="measurement time (s)",
+                        type=float,default=DURATION)
+    parser.add_argument("-w","--warmup",help="time (s) given to the fleet to connect",
+                        type=float,default=WARMUP)
+    parser.add_argument("-p","--port",help="port of the master server under test",
+                        type=int,default=BENCH_PORT)
+    parser.add_argument("-pr","--periodicity",help="periodicity to poll nodes (ms)",
+                        type=int,default=PERIODICITY)
+    parser.add_argument("-pm","--publish_mode",help="publication mode of the master",
+                        choices=(PUBLISH_TICK,PUBLISH_EVENT),default=PUBLISH_TICK)
+    parser.add_argument("-df","--delta_frames",help="send delta frames to the clients",
+                        type=int,default=0)
+    parser.add_argument("-sh","--shards",help="number of shards of the master",
+                        type=int,default=0)
+    parser.add_argument("-sp","--shard_port",help="port of the shards",
+                        type=int,default=BENCH_SHARD_PORT)
+    parser.add_argument("-b","--binary",help="nodes send binary frames",
+                        type=int,default=0)
+    parser.add_argument("-s","--subscription",help="subscription message sent by the clients (JSON)",
+                        default=None)
+    parser.add_argument("-o","--output",help="file where the results are written (JSON)",
+                        default=RESULTS_FILE)
+    args = parser.parse_args()
+
+    results = run_benchmark(num_nodes=args.nodes,
+                            num_clients=args.clients,
+                            node_processes=args.node_processes,
+                            client_processes=args.client_processes,
+                            duration=args.duration,
+                            warmup=args.warmup,
+                            port=args.port,
+                            shard_port=args.shard_port,
+                            periodicity=args.periodicity,
+                            publish_mode=args.publish_mode,
+                            delta_frames=bool(args.delta_frames),
+                            shards=args.shards,
+                            binary=bool(args.binary),
+                            subscription=args.subscription)
+    with open(args.output, 'w') as output:
+        json.dump(results, output, indent=2)
+    print(json.dumps(results, indent=2))
+    print('(BCH  {}) Results written to {}'.format(time.strftime(TFORMAT), args.output))
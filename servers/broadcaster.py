@@ -0,0 +1,508 @@
+"""Frame encoding for the master -> client broadcasts of lab-nanny
+
+The MasterServer sends the contents of CommsHandler.last_data to every
+connected client on each tick. Instead of handing the dictionary to each
+websocket (which would serialize it once per client), the FrameEncoder
+serializes each frame exactly once and the resulting bytes are written to
+all the clients.
+
+Two kinds of frames are produced:
+-- full frames (default): the JSON representation of the last_data
+   dictionary, {node_id: data_dict, ...}, as the clients have always
+   received it.
+-- delta frames (delta=True): JSON objects with the keys
+       'frame'   : 'key' or 'delta'
+       'seq'     : frame counter
+       'nodes'   : {node_id: data_dict}  (only changed keys for deltas)
+       'removed' : list of node ids that disconnected since the last frame
+   Delta frames only contain the nodes (and the channels within them) whose
+   values changed since the previous frame. Every keyframe_interval frames
+   a full keyframe is sent, so that clients recover from any lost state.
+
+Clients can also subscribe to a subset of the data by sending a JSON
+message through their websocket, e.g.
+    {"subscribe": {"labs": ["lab7"], "channels": ["ch2", "ch4"], "max_rate": 2}}
+where every field is optional ("max_rate" is given in Hz; an additional
+"backfill" field gives the number of past samples that the client wants to
+receive upon subscription, see servers.history; on connection, clients
+get the whole history). Clients with
+identical subscriptions are grouped (SubscriptionGroup), and the
+ClientBroadcaster builds one filtered and decimated frame per group and tick,
+instead of one per client.
+
+The frames are not written directly to the websockets: each client has a
+bounded ClientQueue, and a new frame is only written once the previous write
+has been flushed. If a client cannot keep up, the oldest frames are dropped
+(the latest frame wins; in delta mode the queue is replaced by a keyframe),
+and clients that lag too far behind are downgraded to half their update
+rate, or disconnected. A failing client never affects the rest.
+"""
+import collections
+import json
+
+from tornado.iostream import StreamClosedError
+from tornado.websocket import WebSocketClosedError
+
+from servers.logs import get_logger
+
+KEYFRAME_INTERVAL = 50   # In delta mode, send a full frame every ... frames
+
+FRAME_KEY   = 'key'
+FRAME_DELTA = 'delta'
+
+# Keys that are always kept in a node delta, so that the client knows which
+# laboratory the values belong to.
+ALWAYS_SENT_KEYS = ('user',)
+# Keys that are kept in the node dictionaries regardless of the channels
+# requested in a subscription
+ALWAYS_KEPT_KEYS = ('user', 'error', 'x')
+
+SUBSCRIBE_KEYWORD = 'subscribe'
+SCHEDULE_TOLERANCE = 0.005  # (s) Tolerance to the jitter of the ticks
+
+MAX_QUEUE_DEPTH = 4     # Frames waiting to be written to each client
+MAX_LAG         = 20    # Dropped frames before downgrading a client
+MIN_CLIENT_RATE = 0.2   # (Hz) Clients slower than this are disconnected
+
+_MISSING = object()
+
+log = get_logger('broadcast')
+
+
+class FrameEncoder(object):
+    """ Serializes the node data into frames ready to be written to the
+    client websockets.
+
+    The encoder keeps a reference to the node dictionaries sent in the
+    previous frame. Since NodeHandler.on_message replaces (instead of
+    updating) the dictionary of a node in CommsHandler.last_data, a node
+    without new data is detected with a cheap identity check.
+    """
+    def __init__(self, delta=False, keyframe_interval=KEYFRAME_INTERVAL):
+        self.delta = delta
+        self.keyframe_interval = keyframe_interval
+        self.seq = 0
+        self._sent = {}              # node id -> data dictionary last sent
+        self._frames_since_key = 0
+        self._cached_version = None
+        self._cached_frame = None
+
+    def encode(self, last_data, version=None):
+        """ Returns the next frame (bytes) to broadcast, or None if there
+        is nothing new to send.
+
+        :param last_data: dictionary {node_id: data_dict}
+        :param version: counter that changes whenever last_data changes
+                        (see CommsHandler.data_version). If given, full
+                        frames are only re-serialized when it changes.
+        :return: bytes or None
+        """
+        if not self.delta:
+            return self.full_frame(last_data, version)
+
+        self._frames_since_key += 1
+        if self._frames_since_key >= self.keyframe_interval:
+            return self.keyframe(last_data, reset=True)
+
+        nodes = {}
+        for node_id, data in last_data.items():
+            previous = self._sent.get(node_id)
+            if data is previous:
+                continue
+            changes = node_delta(previous, data)
+            if changes:
+                nodes[node_id] = changes
+        removed = [node_id for node_id in self._sent
+                   if node_id not in last_data]
+        self._sent = dict(last_data)
+        if not nodes and not removed:
+            return None
+        self.seq += 1
+        return dump_frame({'frame': FRAME_DELTA,
+                           'seq': self.seq,
+                           'nodes': nodes,
+                           'removed': removed})
+
+    def full_frame(self, last_data, version=None):
+        """ Returns the whole last_data dictionary in the legacy format.
+
+        The serialized frame is cached, and only rebuilt when the version
+        changes (or when no version is given).
+        """
+        if version is None or version != self._cached_version \
+                or self._cached_frame is None:
+            self._cached_frame = dump_frame(last_data)
+            self._cached_version = version
+        return self._cached_frame
+
+    def keyframe(self, last_data, reset=False):
+        """ Returns a frame with the full state of the nodes.
+
+        In full mode this is the same as a full frame. In delta mode, the
+        frame is wrapped as a keyframe. If reset is True, the following
+        deltas are computed with respect to this keyframe; otherwise (e.g.
+        when sending a keyframe to a newly connected client) the state of
+        the encoder is not modified.
+        """
+        if not self.delta:
+            return self.full_frame(last_data)
+        if reset:
+            self._sent = dict(last_data)
+            self._frames_since_key = 0
+            self.seq += 1
+        return dump_frame({'frame': FRAME_KEY,
+                           'seq': self.seq,
+                           'nodes': last_data,
+                           'removed': []})
+
+
+def node_delta(previous, data):
+    """ Returns a dictionary with the keys of "data" whose values differ from
+    those in "previous" (or all of "data" if there is no previous value).
+
+    The ALWAYS_SENT_KEYS are added to any non-empty delta.
+    """
+    if previous is None:
+        return dict(data)
+    changes = {}
+    for key, value in data.items():
+        if previous.get(key, _MISSING) != value:
+            changes[key] = value
+    if changes:
+        for key in ALWAYS_SENT_KEYS:
+            if key in data:
+                changes[key] = data[key]
+    return changes
+
+
+def dump_frame(contents):
+    """ Serializes a frame to bytes (UTF-8 encoded JSON).
+
+    Writing bytes to a websocket (with binary=False) avoids re-encoding the
+    frame for each of the clients.
+    """
+    return json.dumps(contents, separators=(',', ':')).encode('utf-8')
+
+
+class Subscription(object):
+    """ Selection of laboratories, channels and maximum update rate requested
+    by a client.
+
+    A None value in labs or channels means "all of them", and a None
+    max_rate means that the client receives a frame on every tick. The
+    backfill (number of past samples sent upon subscription, None for the
+    server's default) is not part of the key of the subscription.
+    """
+    def __init__(self, labs=None, channels=None, max_rate=None, backfill=None):
+        self.labs = frozenset(labs) if labs is not None else None
+        self.channels = frozenset(channels) if channels is not None else None
+        if max_rate is not None and max_rate <= 0:
+            raise ValueError('max_rate should be a positive number')
+        self.max_rate = max_rate
+        if backfill is not None and backfill < 0:
+            raise ValueError('backfill should be a positive number')
+        self.backfill = backfill
+
+    @property
+    def key(self):
+        """ Hashable identification of the subscription, used to group the
+        clients with the same subscription."""
+        return (self.labs, self.channels, self.max_rate)
+
+    @property
+    def min_interval(self):
+        """ Minimum time (s) between two frames, or 0 for no limit."""
+        if self.max_rate is None:
+            return 0
+        return 1.0/self.max_rate
+
+    @classmethod
+    def from_message(cls, message):
+        """ Parses a subscription message sent by a client.
+
+        :param message: string sent by a client through its websocket
+        :return: a Subscription instance, or None if the message is not a
+                 subscription (e.g. an actuation command 'lab7,13,1').
+        :raises ValueError: if the subscription is malformed.
+        """
+        try:
+            contents = json.loads(message)
+        except ValueError:
+            return None
+        if not isinstance(contents, dict) or SUBSCRIBE_KEYWORD not in contents:
+            return None
+        request = contents[SUBSCRIBE_KEYWORD] or {}
+        if not isinstance(request, dict):
+            raise ValueError('The subscription should be a dictionary')
+        return cls(labs=request.get('labs'),
+                   channels=request.get('channels'),
+                   max_rate=request.get('max_rate'),
+                   backfill=request.get('backfill'))
+
+    def filter_node(self, data):
+        """ Returns the data dictionary of a node restricted to the
+        subscribed channels, or None if the laboratory is not subscribed.
+        """
+        if self.labs is not None and data.get('user') not in self.labs:
+            return None
+        if self.channels is None:
+            return data
+        return {key: value for key, value in data.items()
+                if key in self.channels or key in ALWAYS_KEPT_KEYS}
+
+
+class SubscriptionGroup(object):
+    """ Set of clients sharing the same subscription.
+
+    Each group has its own FrameEncoder, so the (filtered) frame of a group
+    is serialized once per tick, and the deltas are computed with respect
+    to the frames that this group received.
+    """
+    def __init__(self, subscription, delta=False,
+                 keyframe_interval=KEYFRAME_INTERVAL):
+        self.subscription = subscription
+        self.encoder = FrameEncoder(delta=delta,
+                                    keyframe_interval=keyframe_interval)
+        self.clients = []
+        self.next_due = 0
+        # Cache of the filtered dictionaries: node id -> (source, filtered).
+        # Reusing the filtered dictionary when the source did not change
+        # keeps the identity checks of the FrameEncoder cheap.
+        self._filtered = {}
+
+    def is_due(self, now):
+        return now + SCHEDULE_TOLERANCE >= self.next_due
+
+    def filter(self, last_data):
+        """ Returns the last_data dictionary restricted to the subscription."""
+        subscription = self.subscription
+        if subscription.labs is None and subscription.channels is None:
+            return last_data
+        filtered_data = {}
+        cache = {}
+        for node_id, data in last_data.items():
+            cached = self._filtered.get(node_id)
+            if cached is not None and cached[0] is data:
+                filtered = cached[1]
+            else:
+                filtered = subscription.filter_node(data)
+            cache[node_id] = (data, filtered)
+            if filtered is not None:
+                filtered_data[node_id] = filtered
+        self._filtered = cache
+        return filtered_data
+
+    def frame(self, last_data, version, now):
+        """ Returns the frame to send to the clients of the group in this
+        tick, or None if there is nothing to send (or it is not due yet).
+        """
+        if not self.is_due(now):
+            return None
+        interval = self.subscription.min_interval
+        self.next_due += interval
+        if self.next_due < now:
+            # Do not try to catch up on the frames that were not sent
+            self.next_due = now + interval
+        return self.encoder.encode(self.filter(last_data), version)
+
+    def keyframe(self, last_data):
+        return self.encoder.keyframe(self.filter(last_data))
+
+
+class ClientQueue(object):
+    """ Bounded queue of frames waiting to be written to a client.
+
+    Only one frame is handed to the websocket at a time, so the write buffer
+    of tornado holds at most one frame per client. The queue counts the
+    frames dropped since the last completed write, which measures how far
+    behind the client is.
+    """
+    def __init__(self, client, max_depth=MAX_QUEUE_DEPTH):
+        self.client = client
+        self.max_depth = max_depth
+        self.frames = collections.deque()
+        self.writing = False
+        self.closed = False
+        self.dropped = 0
+        self.needs_keyframe = False
+        # Totals, read by the metrics of the master server
+        self.sent_frames = 0
+        self.sent_bytes = 0
+        self.dropped_frames = 0
+
+    def push(self, frame, delta=False):
+        """ Adds a frame to the queue and tries to write it.
+
+        When the queue is full, the oldest frame is dropped. If the frames
+        are deltas, dropping one of them invalidates the ones after it, so
+        the queue is emptied and flagged as needing a keyframe instead.
+        """
+        if self.closed:
+            return
+        if len(self.frames) >= self.max_depth:
+            self.dropped += 1
+            self.dropped_frames += 1
+            if delta:
+                self.dropped += len(self.frames)
+                self.dropped_frames += len(self.frames)
+                self.frames.clear()
+                self.needs_keyframe = True
+                return
+            self.frames.popleft()
+        self.frames.append(frame)
+        self.flush()
+
+    def replace(self, frame):
+        """ Replaces the contents of the queue by a single (key)frame."""
+        self.frames.clear()
+        self.needs_keyframe = False
+        self.push(frame)
+
+    def flush(self):
+        """ Writes the next frame, unless a write is already in progress."""
+        if self.writing or self.closed or not self.frames:
+            return
+        frame = self.frames.popleft()
+        try:
+            future = self.client.write_message(frame)
+        except WebSocketClosedError:
+            self.closed = True
+            return
+        self.writing = True
+        self.sent_frames += 1
+        self.sent_bytes += len(frame)
+        future.add_done_callback(self._on_written)
+
+    def _on_written(self, future):
+        self.writing = False
+        try:
+            future.result()
+        except (WebSocketClosedError, StreamClosedError):
+            self.closed = True
+            return
+        self.dropped = 0
+        self.flush()
+
+
+class ClientBroadcaster(object):
+    """ Keeps the subscription groups of the clients and publishes the
+    frames of each group through the queues of the clients.
+
+    :param base_rate: (Hz) rate of the ticks, used as the starting point to
+                      downgrade the clients subscribed at full rate.
+    """
+    def __init__(self, delta=False, keyframe_interval=KEYFRAME_INTERVAL,
+                 base_rate=10, max_queue_depth=MAX_QUEUE_DEPTH,
+                 max_lag=MAX_LAG):
+        self.delta = delta
+        self.keyframe_interval = keyframe_interval
+        self.base_rate = base_rate
+        self.max_queue_depth = max_queue_depth
+        self.max_lag = max_lag
+        self.groups = {}           # subscription key -> SubscriptionGroup
+        self._client_groups = {}   # client -> SubscriptionGroup
+        self._queues = {}          # client -> ClientQueue
+
+    def subscribe(self, client, subscription=None):
+        """ Moves a client to the group of the given subscription (by
+        default, all the data at full rate).
+
+        :return: the SubscriptionGroup of the client
+        """
+        if subscription is None:
+            subscription = Subscription()
+        self.unsubscribe(client)
+        group = self.groups.get(subscription.key)
+        if group is None:
+            group = SubscriptionGroup(subscription,
+                                      delta=self.delta,
+                                      keyframe_interval=self.keyframe_interval)
+            self.groups[subscription.key] = group
+        group.clients.append(client)
+        self._client_groups[client] = group
+        return group
+
+    def unsubscribe(self, client):
+        """ Removes a client from its group (if any). Empty groups are
+        discarded."""
+        group = self._client_groups.pop(client, None)
+        if group is None:
+            return
+        group.clients.remove(client)
+        if not group.clients:
+            self.groups.pop(group.subscription.key, None)
+
+    def remove(self, client):
+        """ Forgets a client completely (e.g. when its connection closes)."""
+        self.unsubscribe(client)
+        self._queues.pop(client, None)
+
+    def group_of(self, client):
+        return self._client_groups.get(client)
+
+    def queues(self):
+        """ Returns the list of the ClientQueue instances."""
+        return list(self._queues.values())
+
+    def queue_of(self, client):
+        """ Returns the ClientQueue of a client, creating it if needed."""
+        queue = self._queues.get(client)
+        if queue is None:
+            queue = ClientQueue(client, max_depth=self.max_queue_depth)
+            self._queues[client] = queue
+        return queue
+
+    def send(self, client, frame, replace=True):
+        """ Sends a single frame (e.g. a keyframe) to a client through its
+        queue. By default, the frame replaces any frame still waiting
+        there."""
+        if replace:
+            self.queue_of(client).replace(frame)
+        else:
+            self.queue_of(client).push(frame)
+
+    def publish(self, last_data, version, now):
+        """ Builds the frames of the groups that are due and pushes them to
+        the queues of their clients.
+
+        Clients whose connection is closed are skipped, and clients that
+        lag behind more than max_lag frames are downgraded.
+        """
+        lagging = []
+        for group in list(self.groups.values()):
+            frame = group.frame(last_data, version, now)
+            if frame is None:
+                continue
+            for client in group.clients:
+                queue = self.queue_of(client)
+                if queue.needs_keyframe:
+                    queue.replace(group.keyframe(last_data))
+                else:
+                    queue.push(frame, delta=self.delta)
+                if queue.dropped > self.max_lag:
+                    lagging.append(client)
+        for client in lagging:
+            self.downgrade(client, last_data)
+
+    def downgrade(self, client, last_data):
+        """ Halves the update rate of a client which cannot keep up with its
+        subscription, or disconnects it if the rate becomes too low.
+        """
+        group = self._client_groups.get(client)
+        if group is None:
+            return
+        subscription = group.subscription
+        rate = (subscription.max_rate or self.base_rate)/2.0
+        if rate < MIN_CLIENT_RATE:
+            log.warning('Client too slow, closing the connection')
+            self.remove(client)
+            client.close()
+            return
+        log.warning('Client lagging behind, downgrading to %s Hz', rate)
+        group = self.subscribe(client, Subscription(labs=subscription.labs,
+                                                    channels=subscription.channels,
+                                                    max_rate=rate))
+        queue = self.queue_of(client)
+        queue.dropped = 0
+        if self.delta:
+            queue.replace(group.keyframe(last_data))
@@ -0,0 +1,443 @@
+"""Condition engine for the feedback system of the lab-nanny master server
+
+A condition is a dictionary such as
+
+    {'name':'Temperature changes',
+     'obs_lab':'lab7',            # laboratory observed
+     'obs_ch':'ch2',              # channel observed
+     'obs_range':(19,23),         # allowed range of values
+     'target_lab':'lab7',         # laboratory to act on
+     'target_ch':13,              # digital channel to change
+     'target_val':1,              # value to write in that channel
+     'message':'Temperature outside of bounds',
+     'hold':1.0,                  # (s) optional, see below
+     'hysteresis':0.5,            # optional
+     'min_interval':10}           # (s) optional
+
+which means "if lab7's ch2 falls outside (19,23), set lab7's pin 13 HIGH".
+
+The actuation only happens on state transitions, not on every sample:
+-- the value must stay outside the range for 'hold' seconds (of the node's
+   clock, 'x') before the condition becomes active (debouncing).
+-- an active condition only clears once the value is back inside the range
+   narrowed by 'hysteresis' on both sides, e.g. (19.5,22.5), so a value
+   hovering near a boundary does not make it flap.
+-- a condition is not actuated again until 'min_interval' seconds after
+   its previous actuation.
+The three keys default to 0.
+
+Instead of the latest value of the channel, a condition can observe a
+statistic of its values over the last 'window' seconds:
+
+    {...,
+     'obs_ch':'ch2',
+     'obs_stat':'mean',           # 'value' (default), 'mean', 'min', 'max',
+                                  # 'std' or 'rate' (change per second)
+     'window':30,                 # (s)
+     'obs_range':(19,23),
+     ...}
+
+The statistics are kept by a RollingWindow for each (lab, channel, window),
+shared by all the conditions using it, and updated incrementally with each
+sample (O(1) amortized per sample).
+
+Instead of checking every condition on every tick, the ConditionEngine
+indexes the conditions by the (lab, channel) they observe, and keeps the
+boundaries of their ranges sorted (ThresholdIndex). Whenever a node sends new
+data, only the channels whose values changed are looked up, and the
+violated conditions are found with two binary searches. Only the
+conditions that are pending (outside the range, waiting for their hold
+time) or active are tracked on every sample.
+"""
+import collections
+import math
+import time
+from bisect import bisect_left, bisect_right, insort
+
+STATISTICS = ('value', 'mean', 'min', 'max', 'std', 'rate')
+
+# Event returned by ConditionEngine.update: the condition became active
+# (active=True, its command must be sent) or cleared (active=False)
+ConditionEvent = collections.namedtuple('ConditionEvent',
+                                        ['condition', 'value', 'active'])
+
+
+class Condition(object):
+    """ Wrapper around a condition dictionary (see the module docstring)."""
+    def __init__(self, condition_dict):
+        self.contents = condition_dict
+        self.name     = condition_dict['name']
+        self.lab      = condition_dict['obs_lab']
+        self.channel  = condition_dict['obs_ch']
+        self.low, self.high = condition_dict['obs_range']
+        self.target_lab     = condition_dict['target_lab']
+        self.target_channel = condition_dict['target_ch']
+        self.target_value   = condition_dict['target_val']
+        self.message  = condition_dict.get('message', self.name)
+        self.hold         = condition_dict.get('hold', 0)
+        self.hysteresis   = condition_dict.get('hysteresis', 0)
+        self.min_interval = condition_dict.get('min_interval', 0)
+        self.statistic = condition_dict.get('obs_stat', 'value')
+        self.window    = condition_dict.get('window')
+        if self.statistic not in STATISTICS:
+            raise ValueError('Unknown statistic {}'.format(self.statistic))
+        if self.statistic == 'value':
+            self.window = None
+        elif not self.window or self.window <= 0:
+            raise ValueError('Condition {} needs a window'.format(self.name))
+        # State
+        self.active = False
+        self.pending_since = None   # time when the value left the range
+        self.last_actuation = None
+
+    @property
+    def signal(self):
+        """ Key of the signal observed by the condition:
+        (lab, channel, statistic, window)."""
+        return (self.lab, self.channel, self.statistic, self.window)
+
+    @property
+    def command(self):
+        """ Message that the target node must receive when the condition
+        is violated ('user,pin_number,pin_value')."""
+        return '{},{},{}'.format(self.target_lab,
+                                 self.target_channel,
+                                 self.target_value)
+
+    def is_violated(self, value):
+        return not self.low <= value <= self.high
+
+    def is_clear(self, value):
+        """ Whether an active condition can be cleared with a value."""
+        return self.low + self.hysteresis <= value <= self.high - self.hysteresis
+
+    def step(self, value, violated, t):
+        """ Advances the state of the condition with a new value.
+
+        :param violated: whether the value is outside the range
+        :param t: time of the value (s)
+        :return: True if the condition became active, False if it cleared,
+                 None otherwise
+        """
+        if violated:
+            if self.active:
+                return None
+            if self.pending_since is None:
+                self.pending_since = t
+            if t - self.pending_since < self.hold:
+                return None
+            if self.last_actuation is not None \
+                    and t - self.last_actuation < self.min_interval:
+                return None
+            self.active = True
+            self.pending_since = None
+            self.last_actuation = t
+            return True
+        self.pending_since = None
+        if self.active and self.is_clear(value):
+            self.active = False
+            return False
+        return None
+
+    @property
+    def tracked(self):
+        """ Whether the condition must be evaluated on every sample."""
+        return self.active or self.pending_since is not None
+
+    def get_state(self):
+        """ Returns the state of the condition as a dictionary."""
+        return {'active': self.active,
+                'pending_since': self.pending_since,
+                'last_actuation': self.last_actuation}
+
+    def set_state(self, state):
+        """ Restores a state given by get_state."""
+        self.active = state.get('active', False)
+        self.pending_since = state.get('pending_since')
+        self.last_actuation = state.get('last_actuation')
+
+
+class RollingWindow(object):
+    """ Statistics of the samples of a channel received in the last window
+    seconds.
+
+    Every sample is added and evicted once: the sums (for the mean and the
+    standard deviation) are updated on both occasions, and the minimum and
+    maximum are kept in monotonic deques (the samples that can never become
+    the minimum/maximum of the window are discarded as soon as a lower/higher
+    sample arrives).
+
+    :param window: length of the window (s)
+    """
+    def __init__(self, window):
+        self.window = window
+        self._samples = collections.deque()   # (time, value)
+        self._mins = collections.deque()      # increasing values
+        self._maxs = collections.deque()      # decreasing values
+        self._shift = None  # the sums are of value-shift, for the precision
+        self._sum = 0.0
+        self._sum_squares = 0.0
+
+    def __len__(self):
+        return len(self._samples)
+
+    def add(self, t, value):
+        """ Adds a sample, and evicts those older than the window."""
+        if self._samples and t < self._samples[-1][0]:
+            # Out of order (e.g. the clock of the node went back): restart
+            self.clear()
+        if self._shift is None:
+            self._shift = value
+        self._samples.append((t, value))
+        shifted = value - self._shift
+        self._sum += shifted
+        self._sum_squares += shifted*shifted
+        while self._mins and self._mins[-1] > value:
+            self._mins.pop()
+        self._mins.append(value)
+        while self._maxs and self._maxs[-1] < value:
+            self._maxs.pop()
+        self._maxs.append(value)
+        limit = t - self.window
+        while self._samples[0][0] < limit:
+            self._evict()
+
+    def _evict(self):
+        _, value = self._samples.popleft()
+        shifted = value - self._shift
+        self._sum -= shifted
+        self._sum_squares -= shifted*shifted
+        if self._mins[0] == value:
+            self._mins.popleft()
+        if self._maxs[0] == value:
+            self._maxs.popleft()
+
+    def samples(self):
+        """ Returns the samples of the window as a list of (time, value)."""
+        return list(self._samples)
+
+    def clear(self):
+        self._samples.clear()
+        self._mins.clear()
+        self._maxs.clear()
+        self._shift = None
+        self._sum = self._sum_squares = 0.0
+
+    def statistic(self, name):
+        """ Returns a statistic of the window ('mean', 'min', 'max', 'std' or
+        'rate'), or None if there are not enough samples."""
+        count = len(self._samples)
+        if not count:
+            return None
+        if name == 'mean':
+            return self._shift + self._sum/count
+        if name == 'min':
+            return self._mins[0]
+        if name == 'max':
+            return self._maxs[0]
+        if count < 2:
+            return None
+        if name == 'std':
+            mean = self._sum/count
+            return math.sqrt(max(0.0, self._sum_squares/count - mean*mean))
+        if name == 'rate':
+            (t0, v0), (t1, v1) = self._samples[0], self._samples[-1]
+            if t1 == t0:
+                return None
+            return (v1 - v0)/(t1 - t0)
+        raise ValueError('Unknown statistic {}'.format(name))
+
+
+class ThresholdIndex(object):
+    """ Sorted boundaries of the ranges of the conditions observing a signal.
+
+    The conditions violated by a value v are those with a lower boundary
+    above v, plus those with an upper boundary below v. Keeping both lists of
+    boundaries sorted, each of these groups is a slice found by bisection.
+    """
+    def __init__(self):
+        self._lows  = []   # sorted list of (low, id(condition))
+        self._highs = []   # sorted list of (high, id(condition))
+        self._conditions = {}
+
+    def __len__(self):
+        return len(self._conditions)
+
+    def add(self, condition):
+        key = id(condition)
+        self._conditions[key] = condition
+        insort(self._lows, (condition.low, key))
+        insort(self._highs, (condition.high, key))
+
+    def remove(self, condition):
+        key = id(condition)
+        if self._conditions.pop(key, None) is None:
+            return
+        self._lows.remove((condition.low, key))
+        self._highs.remove((condition.high, key))
+
+    def violated(self, value):
+        """ Returns the list of conditions violated by a given value."""
+        # (value, inf) sorts after every (value, key) pair, and (value, -1)
+        # before them, since the keys are positive integers.
+        first_low_above = bisect_right(self._lows, (value, float('inf')))
+        first_high_not_below = bisect_left(self._highs, (value, -1))
+        keys = [key for _, key in self._lows[first_low_above:]]
+        keys.extend(key for _, key in self._highs[:first_high_not_below])
+        return [self._conditions[key] for key in keys]
+
+
+class ConditionEngine(object):
+    """ Evaluates the conditions incrementally, as data arrives.
+
+    The engine keeps the last value of each observed signal (see
+    Condition.signal), so that the conditions are only evaluated when the
+    value of their signal changes (or while some of them are pending or
+    active).
+    """
+    def __init__(self, conditions=()):
+        self.conditions = []
+        self._index = {}        # signal -> ThresholdIndex
+        self._channels = {}     # lab -> {channel: set of observed signals}
+        self._windows = {}      # (lab, channel, window) -> RollingWindow
+        self._last_values = {}  # signal -> last value
+        self._tracked = {}      # signal -> pending or active conditions
+        # Counters, read by the metrics of the master server
+        self.evaluations = 0    # values checked against the conditions
+        self.firings = 0        # conditions that became active
+        for condition in conditions:
+            self.add_condition(condition)
+
+    def add_condition(self, condition_dict):
+        """ Adds a condition (given as a dictionary) to the engine.
+
+        :return: the Condition instance
+        """
+        condition = Condition(condition_dict)
+        self.conditions.append(condition)
+        index = self._index.get(condition.signal)
+        if index is None:
+            index = self._index[condition.signal] = ThresholdIndex()
+            self._channels.setdefault(condition.lab, {})\
+                          .setdefault(condition.channel, set())\
+                          .add(condition.signal)
+            if condition.window is not None:
+                key = (condition.lab, condition.channel, condition.window)
+                if key not in self._windows:
+                    self._windows[key] = RollingWindow(condition.window)
+        index.add(condition)
+        # Make sure the new condition is checked with the next value
+        self._last_values.pop(condition.signal, None)
+        return condition
+
+    def remove_condition(self, condition):
+        """ Removes a Condition instance (as given by add_condition)."""
+        self.conditions.remove(condition)
+        index = self._index[condition.signal]
+        index.remove(condition)
+        self._tracked.get(condition.signal, set()).discard(condition)
+        if not len(index):
+            del self._index[condition.signal]
+            self._last_values.pop(condition.signal, None)
+            self._tracked.pop(condition.signal, None)
+            channels = self._channels[condition.lab]
+            channels[condition.channel].discard(condition.signal)
+            if not channels[condition.channel]:
+                del channels[condition.channel]
+            if not channels:
+                del self._channels[condition.lab]
+            if condition.window is not None and not any(
+                    signal[3] == condition.window
+                    for signal in channels.get(condition.channel, ())):
+                del self._windows[(condition.lab, condition.channel,
+                                   condition.window)]
+
+    def update(self, data_dict):
+        """ Evaluates the conditions affected by the data sent by a node.
+
+        :param data_dict: dictionary sent by a node (see
+                          servers.server_node.SlaveNode.convert_data)
+        :return: list of ConditionEvent, with the conditions that became
+                 active (whose command must be sent) or cleared
+        """
+        if data_dict.get('error', True):
+            return []
+        lab = data_dict.get('user')
+        channels = self._channels.get(lab)
+        if not channels:
+            return []
+        t = data_dict.get('x', time.time())
+        events = []
+        for channel, signals in channels.items():
+            sample = data_dict.get(channel)
+            if sample is None:
+                continue
+            windows = set()
+            for signal in signals:
+                window = signal[3]
+                if window is not None and window not in windows:
+                    self._windows[(lab, channel, window)].add(t, sample)
+                    windows.add(window)
+            for signal in signals:
+                if signal[3] is None:
+                    value = sample
+                else:
+                    value = self._windows[(lab, channel, signal[3])]\
+                                .statistic(signal[2])
+                    if value is None:
+                        continue
+                events.extend(self._evaluate(signal, value, t))
+        self.firings += sum(1 for event in events if event.active)
+        return events
+
+    def get_state(self):
+        """ Returns the state of the conditions (by name) and the samples of
+        the rolling windows, as a JSON-serializable dictionary."""
+        return {'conditions': {condition.name: condition.get_state()
+                               for condition in self.conditions},
+                'windows': [[lab, channel, window, rolling.samples()]
+                            for (lab, channel, window), rolling
+                            in self._windows.items()]}
+
+    def set_state(self, state):
+        """ Restores a state given by get_state (e.g. after a restart of the
+        master), so that the active conditions are not actuated again.
+
+        The conditions and windows that no longer exist are ignored.
+        """
+        states = state.get('conditions', {})
+        self._tracked = {}
+        self._last_values = {}
+        for condition in self.conditions:
+            if condition.name in states:
+                condition.set_state(states[condition.name])
+            if condition.tracked:
+                self._tracked.setdefault(condition.signal, set()).add(condition)
+        for lab, channel, window, samples in state.get('windows', ()):
+            rolling = self._windows.get((lab, channel, window))
+            if rolling is None:
+                continue
+            rolling.clear()
+            for t, value in samples:
+                rolling.add(t, value)
+
+    def _evaluate(self, signal, value, t):
+        """ Evaluates the conditions of a signal with a new value.
+
+        :return: list of ConditionEvent
+        """
+        tracked = self._tracked.get(signal)
+        if self._last_values.get(signal) == value and not tracked:
+            return []
+        self._last_values[signal] = value
+        self.evaluations += 1
+        violated = set(self._index[signal].violated(value))
+        candidates = violated.union(tracked) if tracked else violated
+        events = []
+        for condition in candidates:
+            transition = condition.step(value, condition in violated, t)
+            if transition is not None:
+                events.append(ConditionEvent(condition, value, transition))
+        self._tracked[signal] = set(condition for condition in candidates
+                                    if condition.tracked)
+        return events
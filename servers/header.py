@@ -1,3 +1,6 @@
+# Time format used in the console output of the servers
+TFORMAT = '%y/%m/%d %H:%M:%S'
+
 # Text art made using http://patorjk.com/software/taag/
 MST_HEADER=("""\n
   _       _
@@ -0,0 +1,124 @@
+"""In-memory history of the node data for the lab-nanny master server
+
+The master keeps the last HISTORY_LENGTH samples of every (lab, channel) in
+a fixed-size ring buffer backed by NumPy arrays, so the memory used is
+bounded and known in advance. When a client connects (and whenever it
+subscribes), it receives a backfill frame with the recent history, and its
+graphs are full from the start instead of scrolling in from a default value.
+
+The backfill frame has the form
+    {'frame': 'backfill',
+     'labs': {lab: {channel: {'x': [times], 'y': [values]}, ...}, ...}}
+"""
+import numpy as np
+
+from servers.broadcaster import dump_frame
+
+HISTORY_LENGTH = 1000   # Samples kept per (lab, channel)
+FRAME_BACKFILL = 'backfill'
+
+# Keys of the node dictionaries which are not channels
+NON_CHANNEL_KEYS = ('user', 'error', 'x')
+
+
+class RingBuffer(object):
+    """ Fixed-size buffer of (time, value) pairs.
+
+    Once the buffer is full, each new sample overwrites the oldest one.
+    """
+    def __init__(self, capacity=HISTORY_LENGTH):
+        self.capacity = capacity
+        self.times = np.zeros(capacity, dtype=np.float64)
+        self.values = np.zeros(capacity, dtype=np.float64)
+        self.index = 0   # position of the next sample
+        self.count = 0   # number of valid samples
+
+    def __len__(self):
+        return self.count
+
+    def append(self, t, value):
+        self.times[self.index] = t
+        self.values[self.index] = value
+        self.index = (self.index + 1) % self.capacity
+        if self.count < self.capacity:
+            self.count += 1
+
+    def extend(self, times, values):
+        """ Appends arrays of samples (only the last capacity are kept)."""
+        times = np.asarray(times, dtype=np.float64)[-self.capacity:]
+        values = np.asarray(values, dtype=np.float64)[-self.capacity:]
+        indices = (self.index + np.arange(len(times))) % self.capacity
+        self.times[indices] = times
+        self.values[indices] = values
+        self.index = (self.index + len(times)) % self.capacity
+        self.count = min(self.capacity, self.count + len(times))
+
+    def last(self, n=None):
+        """ Returns the last n samples (all of them by default) as two arrays
+        (times, values) in chronological order."""
+        if n is None or n > self.count:
+            n = self.count
+        start = (self.index - n) % self.capacity
+        if start + n <= self.capacity:
+            return (self.times[start:start + n].copy(),
+                    self.values[start:start + n].copy())
+        indices = np.arange(start, start + n) % self.capacity
+        return self.times[indices], self.values[indices]
+
+
+class HistoryStore(object):
+    """ Ring buffers of the recent data of every (lab, channel).
+
+    The store is fed with the dictionaries sent by the nodes (see
+    CommsHandler.bind_to_data_change).
+    """
+    def __init__(self, capacity=HISTORY_LENGTH):
+        self.capacity = capacity
+        self.buffers = {}   # (lab, channel) -> RingBuffer
+
+    def append(self, data_dict):
+        """ Adds the values of a node dictionary to the buffers.
+
+        Dictionaries flagged with an error carry no values, and are skipped.
+        """
+        if data_dict.get('error', True):
+            return
+        lab = data_dict['user']
+        t = data_dict['x']
+        for channel, value in data_dict.items():
+            if channel in NON_CHANNEL_KEYS or not isinstance(value, (int, float)):
+                continue
+            buffer = self.buffers.get((lab, channel))
+            if buffer is None:
+                buffer = self.buffers[(lab, channel)] = RingBuffer(self.capacity)
+            buffer.append(t, value)
+
+    def restore(self, lab, channel, times, values):
+        """ Loads the samples of a channel (e.g. from a snapshot)."""
+        buffer = self.buffers.get((lab, channel))
+        if buffer is None:
+            buffer = self.buffers[(lab, channel)] = RingBuffer(self.capacity)
+        buffer.extend(times, values)
+
+    def series(self, lab, channel, n=None):
+        """ Returns the last n samples of a channel as (times, values)."""
+        buffer = self.buffers.get((lab, channel))
+        if buffer is None:
+            empty = np.zeros(0)
+            return empty, empty
+        return buffer.last(n)
+
+    def backfill(self, labs=None, channels=None, n=None):
+        """ Returns a backfill frame (bytes) with the last n samples of the
+        given labs and channels (all of them by default).
+        """
+        contents = {}
+        for (lab, channel), buffer in self.buffers.items():
+            if labs is not None and lab not in labs:
+                continue
+            if channels is not None and channel not in channels:
+                continue
+            times, values = buffer.last(n)
+            contents.setdefault(lab, {})[channel] = {'x': times.tolist(),
+                                                     'y': values.tolist()}
+        return dump_frame({'frame': FRAME_BACKFILL, 'labs': contents})
@@ -0,0 +1,51 @@
+"""Non-blocking cache of host names for the lab-nanny master server
+
+Resolving the name of a host (socket.getfqdn) may take seconds if the DNS
+server is slow, which would stall the IOLoop that polls the nodes. The
+HostnameCache resolves the names in a thread of the IOLoop's executor when a
+connection opens (HostnameCache.lookup), and keeps them for HOSTNAME_TTL
+seconds. Until a name is
+resolved, the IP address is used instead.
+"""
+import socket
+import time
+
+import tornado.ioloop as ioloop
+
+HOSTNAME_TTL = 3600   # (s) Time to keep a resolved host name
+
+
+class HostnameCache(object):
+    def __init__(self, ttl=HOSTNAME_TTL):
+        self.ttl = ttl
+        self._names = {}        # ip -> (name, expiry time)
+        self._pending = set()   # ips being resolved
+
+    def lookup(self, ip):
+        """ Returns the cached name of a host, or its IP address if the name
+        is not known (yet). Expired names trigger a new resolution.
+        """
+        entry = self._names.get(ip)
+        if entry is None or entry[1] < time.time():
+            self.resolve(ip)
+        if entry is None:
+            return ip
+        return entry[0]
+
+    def resolve(self, ip):
+        """ Starts the resolution of the name of a host in the background,
+        unless it is being resolved or its name is still fresh."""
+        entry = self._names.get(ip)
+        if ip in self._pending or (entry is not None and entry[1] >= time.time()):
+            return
+        self._pending.add(ip)
+        future = ioloop.IOLoop.current().run_in_executor(None, socket.getfqdn, ip)
+        future.add_done_callback(lambda f: self._store(ip, f))
+
+    def _store(self, ip, future):
+        self._pending.discard(ip)
+        try:
+            name = future.result()
+        except (socket.error, UnicodeError):
+            name = ip
+        self._names[ip] = (name, time.time() + self.ttl)
@@ -0,0 +1,246 @@
+"""Logging for lab-nanny
+
+The servers log through the standard logging module, with one logger per
+subsystem (see SUBSYSTEMS), instead of printing to the console. Since some
+messages are issued for every sample (e.g. with verbose output), the
+logging is built to cost as little as possible in the hot paths:
+-- the records are formatted lazily: the callers pass a format string and
+   its arguments (log.debug('time: %.3f', x)), and the message is only built
+   if the level of the subsystem is enabled.
+-- the records are handed to a queue (AsyncQueueHandler), and written by a
+   background thread (a logging.handlers.QueueListener), so a slow console or
+   journal never blocks the IOLoop. If the queue is full, the records are
+   dropped and counted.
+-- repeated per-sample messages (DEBUG records, or records logged with
+   extra={'sample': True}) are rate-limited per call site (RateLimitFilter);
+   the next message that gets through says how many were suppressed.
+-- the level of each subsystem can be changed at runtime: in the master
+   through its LOGGING_ADDR address (see servers.server_master.LoggingHandler),
+   and in the nodes by sending them a SIGUSR1 signal (see
+   install_signal_toggle).
+
+The messages keep the layout of the previous prints, e.g.
+    (MST  17/05/19 12:00:00) Adding 2 entries to DB
+"""
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+
+from servers.header import TFORMAT
+
+LOGGER_NAME    = 'nanny'
+LOG_QUEUE_SIZE = 10000   # Records waiting to be written before dropping
+SAMPLE_LOG_RATE  = 1.0   # (Hz) Per-sample messages allowed per call site...
+SAMPLE_LOG_BURST = 5     # ...after an initial burst of...
+
+# Subsystems (loggers 'nanny.<subsystem>') and the tags shown in the console
+SUBSYSTEMS = {'master':    'MST',
+              'nodes':     'NDH',
+              'clients':   'CLH',
+              'shards':    'SHD',
+              'broadcast': 'BRC',
+              'node':      'node',
+              'serial':    'SCM',
+              'database':  'DBW'}
+NODE_SUBSYSTEMS = ('node', 'serial')
+
+_listener = None
+_queue_handler = None
+_fork_hook_registered = False
+
+
+def get_logger(subsystem):
+    """ Returns the logger of a subsystem (see SUBSYSTEMS)."""
+    return logging.getLogger('{}.{}'.format(LOGGER_NAME, subsystem))
+
+
+class TagFormatter(logging.Formatter):
+    """ Formats the records as '(TAG  time) message'."""
+    def __init__(self):
+        super(TagFormatter, self).__init__('(%(tag)-4s %(asctime)s) %(message)s',
+                                           datefmt=TFORMAT)
+
+    def format(self, record):
+        subsystem = record.name.rsplit('.', 1)[-1]
+        record.tag = SUBSYSTEMS.get(subsystem, subsystem)
+        message = super(TagFormatter, self).format(record)
+        suppressed = getattr(record, 'suppressed', 0)
+        if suppressed:
+            message += ' [{} similar messages suppressed]'.format(suppressed)
+        return message
+
+
+class RateLimitFilter(logging.Filter):
+    """ Limits the per-sample messages of each call site to rate messages
+    per second, after an initial burst (token bucket).
+
+    :param max_level: records up to this level are rate-limited (records
+                      with a 'sample' attribute are always rate-limited)
+    """
+    def __init__(self, rate=SAMPLE_LOG_RATE, burst=SAMPLE_LOG_BURST,
+                 max_level=logging.DEBUG):
+        super(RateLimitFilter, self).__init__()
+        self.rate = rate
+        self.burst = burst
+        self.max_level = max_level
+        self.suppressed = 0          # total of records suppressed
+        self._buckets = {}           # call site -> [tokens, time, suppressed]
+
+    def filter(self, record):
+        if record.levelno > self.max_level and not getattr(record, 'sample', False):
+            return True
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [self.burst, now, 0]
+        bucket[0] = min(self.burst, bucket[0] + (now - bucket[1])*self.rate)
+        bucket[1] = now
+        if bucket[0] < 1:
+            bucket[2] += 1
+            self.suppressed += 1
+            return False
+        bucket[0] -= 1
+        if bucket[2]:
+            record.suppressed = bucket[2]
+            bucket[2] = 0
+        return True
+
+
+class AsyncQueueHandler(logging.handlers.QueueHandler):
+    """ Hands the records to the writer thread without formatting them.
+
+    The stock QueueHandler formats each record in the calling thread; here
+    the record is queued as is, and formatted by the QueueListener. The
+    arguments of the records must therefore not be modified after logging
+    (the data dictionaries of the nodes are replaced, never updated).
+    """
+    def __init__(self, log_queue):
+        super(AsyncQueueHandler, self).__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging(verbose=False, stream=None, levels=None):
+    """ Starts the background writer of the lab-nanny loggers.
+
+    It can be called more than once: the writer is only started the first
+    time, and the levels are updated.
+
+    :param verbose: if True, all the subsystems log at DEBUG level
+    :param stream: where the records are written (sys.stdout by default)
+    :param levels: dictionary {subsystem: level} overriding the default
+    """
+    global _listener, _queue_handler, _fork_hook_registered
+    root = logging.getLogger(LOGGER_NAME)
+    root.setLevel(logging.DEBUG if verbose else logging.INFO)
+    for subsystem, level in (levels or {}).items():
+        set_level(subsystem, level)
+    if _listener is not None:
+        return _listener
+
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    _queue_handler = AsyncQueueHandler(log_queue)
+    _queue_handler.addFilter(RateLimitFilter())
+    writer = logging.StreamHandler(stream if stream is not None else sys.stdout)
+    writer.setFormatter(TagFormatter())
+    root.addHandler(_queue_handler)
+    root.propagate = False
+    _listener = logging.handlers.QueueListener(log_queue, writer)
+    _listener.start()
+    if not _fork_hook_registered:
+        atexit.register(stop_logging)
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=_restart_after_fork)
+        _fork_hook_registered = True
+    return _listener
+
+
+def _restart_after_fork():
+    """ The writer thread does not survive a fork (e.g. the shard workers
+    of the master): the child process starts its own queue and writer."""
+    global _listener, _queue_handler
+    if _listener is None:
+        return
+    stream = _listener.handlers[0].stream
+    logging.getLogger(LOGGER_NAME).removeHandler(_queue_handler)
+    _listener = None
+    _queue_handler = None
+    setup_logging(verbose=logging.getLogger(LOGGER_NAME).level <= logging.DEBUG,
+                  stream=stream)
+
+
+def stop_logging():
+    """ Writes the queued records and stops the writer thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def statistics():
+    """ Returns (records dropped, records suppressed) since the start."""
+    if _queue_handler is None:
+        return 0, 0
+    suppressed = sum(log_filter.suppressed for log_filter in _queue_handler.filters
+                     if isinstance(log_filter, RateLimitFilter))
+    return _queue_handler.dropped, suppressed
+
+
+def set_level(subsystem, level):
+    """ Changes the level of a subsystem (or of all of them, if subsystem is
+    None) at runtime.
+
+    :param level: level name ('DEBUG', 'INFO',...) or number
+    :raises ValueError: if the subsystem or the level are unknown
+    """
+    if isinstance(level, str):
+        level_number = logging.getLevelName(level.upper())
+        if not isinstance(level_number, int):
+            raise ValueError('Unknown level {}'.format(level))
+        level = level_number
+    if subsystem is None:
+        logging.getLogger(LOGGER_NAME).setLevel(level)
+        for name in SUBSYSTEMS:
+            get_logger(name).setLevel(logging.NOTSET)
+        return
+    if subsystem not in SUBSYSTEMS:
+        raise ValueError('Unknown subsystem {}'.format(subsystem))
+    get_logger(subsystem).setLevel(level)
+
+
+def levels():
+    """ Returns the effective level name of each subsystem."""
+    return {subsystem: logging.getLevelName(get_logger(subsystem).getEffectiveLevel())
+            for subsystem in SUBSYSTEMS}
+
+
+def install_signal_toggle(subsystems=NODE_SUBSYSTEMS):
+    """ Makes SIGUSR1 toggle the given subsystems between DEBUG and INFO
+    (*nix only)."""
+    if not hasattr(signal, 'SIGUSR1') \
+            or threading.current_thread() is not threading.main_thread():
+        return
+
+    def toggle(signum, frame):
+        debug = get_logger(subsystems[0]).getEffectiveLevel() > logging.DEBUG
+        for subsystem in subsystems:
+            set_level(subsystem, logging.DEBUG if debug else logging.INFO)
+        get_logger(subsystems[0]).info('Verbose output %s',
+                                       'enabled' if debug else 'disabled')
+
+    signal.signal(signal.SIGUSR1, toggle)
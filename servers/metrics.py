@@ -0,0 +1,157 @@
+"""Metrics of the lab-nanny master server
+
+Small, dependency-free implementation of counters, gauges and histograms,
+exposed in the Prometheus text format through the '/metrics' address of the
+master server (see servers.server_master.MetricsHandler).
+
+Updating a metric only costs a dictionary lookup and an addition (plus a
+bisection for histograms), so they can be used in the hot paths of the
+server. Values that are already counted elsewhere (e.g. the frames sent by
+each client queue) are read only when the metrics are requested, using a
+CallbackMetric.
+
+Labels are given as tuples of values, in the order of the labelnames of the
+metric, e.g.
+    messages = Counter('nanny_node_messages_total', 'Messages', ('lab',))
+    messages.inc(labels=('lab7',))
+"""
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+
+# Default buckets (in seconds) for the duration histograms
+DURATION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                    0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+class Metric(ABC):
+    """ Base class of the metrics, which only have to implement samples."""
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    @abstractmethod
+    def samples(self):
+        """ Yields (name, labels, value), where labels is a tuple of
+        (labelname, labelvalue) pairs."""
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} {}'.format(self.name, self.kind)]
+        for name, labels, value in self.samples():
+            lines.append('{}{} {}'.format(name, format_labels(labels),
+                                          format_value(value)))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super(Counter, self).__init__(name, documentation, labelnames)
+        self.values = {}
+
+    def inc(self, amount=1, labels=()):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def remove(self, labels):
+        self.values.pop(labels, None)
+
+    def samples(self):
+        for labels, value in self.values.items():
+            yield self.name, tuple(zip(self.labelnames, labels)), value
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value, labels=()):
+        self.values[labels] = value
+
+
+class Histogram(Metric):
+    """ Histogram with fixed buckets (upper boundaries)."""
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=DURATION_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.values = {}   # labels -> [bucket counts..., sum, count]
+
+    def observe(self, value, labels=()):
+        state = self.values.get(labels)
+        if state is None:
+            state = self.values[labels] = [0]*(len(self.buckets) + 3)
+        state[bisect_left(self.buckets, value)] += 1
+        state[-2] += value
+        state[-1] += 1
+
+    def remove(self, labels):
+        self.values.pop(labels, None)
+
+    def samples(self):
+        for labels, state in self.values.items():
+            labels = tuple(zip(self.labelnames, labels))
+            cumulative = 0
+            for boundary, count in zip(self.buckets, state):
+                cumulative += count
+                yield (self.name + '_bucket',
+                       labels + (('le', format_value(boundary)),),
+                       cumulative)
+            yield (self.name + '_bucket', labels + (('le', '+Inf'),), state[-1])
+            yield self.name + '_sum', labels, state[-2]
+            yield self.name + '_count', labels, state[-1]
+
+
+class CallbackMetric(Metric):
+    """ Metric whose values are obtained from a function when the metrics
+    are rendered.
+
+    :param function: returns an iterable of (labels, value) pairs
+    :param kind: 'counter' or 'gauge'
+    """
+    def __init__(self, name, documentation, function, labelnames=(),
+                 kind='gauge'):
+        super(CallbackMetric, self).__init__(name, documentation, labelnames)
+        self.function = function
+        self.kind = kind
+
+    def samples(self):
+        for labels, value in self.function():
+            yield self.name, tuple(zip(self.labelnames, labels)), value
+
+
+class MetricsRegistry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """ Returns all the metrics in the Prometheus text format."""
+        return '\n'.join(metric.render() for metric in self.metrics) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, escape_label(value))
+                          for name, value in labels) + '}'
+
+
+def escape_label(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"')\
+                     .replace('\n', r'\n')
+
+
+def format_value(value):
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
@@ -0,0 +1,162 @@
+"""Binary node -> master protocol for lab-nanny
+
+By default, the nodes send their data as JSON dictionaries with the keys
+'user', 'error', 'ch0',... 'ch6' and 'x'. Since the keys are the same for
+every sample, a node can instead announce its channels once (in the metadata
+dictionary, under the SCHEMA_KEYWORD key) and then send positional binary
+frames:
+
+    header (little-endian):
+        uint16   schema id
+        uint32   sequence number of the request answered (0 if none)
+        float64  time ('x')
+        uint8    error flag
+    payload:
+        float32  value of each channel, in the order given by the schema
+
+The master (servers.server_master.NodeHandler) decodes these frames into the
+same dictionaries that the JSON messages produce, using a MessageDecoder per
+connection. Messages sent as text are still interpreted as JSON, so both
+kinds of nodes can coexist.
+
+The requests of the master ('user,pin_number,pin_value,seq') carry a
+sequence number, which the nodes echo in their replies: in the header of the
+binary frames, or under the REQUEST_KEYWORD key of the JSON dictionaries
+(the decoder removes it, so the data dictionaries keep the same keys).
+"""
+import json
+import struct
+
+METAKEYWORD    = 'meta'
+SCHEMA_KEYWORD = 'schema'
+REQUEST_KEYWORD = 'req'
+NO_REQUEST     = 0        # Sequence number of the frames that answer no request
+HEADER_FORMAT  = '<HIdB'
+VALUE_FORMAT   = 'f'
+DEFAULT_SCHEMA_ID = 1
+MAX_SEQUENCE   = 2**32
+
+
+class SchemaError(ValueError):
+    """ Raised when a message of a node cannot be decoded (e.g. a binary
+    frame which does not match the announced schema, or invalid JSON)."""
+    pass
+
+
+class FrameSchema(object):
+    """ Positional layout of the binary frames sent by a node.
+
+    :param channels: list with the names of the channels ('ch0', 'ch1',...)
+    :param schema_id: identifier of the schema, written in every frame
+    """
+    def __init__(self, channels, schema_id=DEFAULT_SCHEMA_ID):
+        self.id = schema_id
+        self.channels = list(channels)
+        self.format = HEADER_FORMAT + VALUE_FORMAT*len(self.channels)
+        self._struct = struct.Struct(self.format)
+
+    @property
+    def size(self):
+        """ Size (in bytes) of each frame."""
+        return self._struct.size
+
+    def describe(self):
+        """ Returns the description of the schema sent in the metadata."""
+        return {'id': self.id,
+                'channels': self.channels,
+                'format': self.format}
+
+    @classmethod
+    def from_description(cls, description):
+        """ Creates a FrameSchema from the description sent by a node."""
+        schema = cls(description['channels'], schema_id=description['id'])
+        if schema.format != description.get('format', schema.format):
+            raise SchemaError('Unsupported frame format {}'\
+                              .format(description['format']))
+        return schema
+
+    def pack(self, seq, x, error, values):
+        """ Encodes a sample into a binary frame.
+
+        :param seq: sequence number of the request answered (NO_REQUEST
+                    if none)
+        :param x: time of the sample
+        :param error: True if the node could not read the arduino
+        :param values: values of the channels, in the order of the schema
+        :return: bytes
+        """
+        if error:
+            values = [float('nan')]*len(self.channels)
+        return self._struct.pack(self.id, seq % MAX_SEQUENCE, x,
+                                 bool(error), *values)
+
+    def unpack(self, frame, user):
+        """ Decodes a binary frame.
+
+        :param frame: bytes received from the node
+        :param user: user name of the node (not included in the frames)
+        :return: (request sequence number, data dictionary), where the
+                 dictionary is identical to the one a node sends in JSON form.
+        """
+        if len(frame) != self._struct.size:
+            raise SchemaError('Frame of {} bytes, expected {}'\
+                              .format(len(frame), self._struct.size))
+        fields = self._struct.unpack(frame)
+        schema_id, seq, x, error = fields[:4]
+        if schema_id != self.id:
+            raise SchemaError('Frame with schema {}, expected {}'\
+                              .format(schema_id, self.id))
+        data_dict = {'user': user, 'error': bool(error), 'x': x}
+        if not error:
+            data_dict.update(zip(self.channels, fields[4:]))
+        return seq, data_dict
+
+
+class MessageDecoder(object):
+    """ Decodes the messages sent by a node through its websocket.
+
+    The decoder remembers the user name and the schema of the node (both
+    announced in the metadata), which are needed to decode binary frames.
+    The sequence number of the request answered by the last message is kept
+    in last_request (None if the node did not give one).
+    """
+    def __init__(self):
+        self.user = None
+        self.schema = None
+        self.last_request = None
+
+    def decode(self, message):
+        """ Converts a message from a node into a dictionary.
+
+        :param message: JSON string or binary frame
+        :return: the data or metadata dictionary (metadata dictionaries
+                 contain the METAKEYWORD key)
+        :raises SchemaError: if the message cannot be decoded
+        """
+        if isinstance(message, bytes):
+            if self.schema is None:
+                raise SchemaError('Binary frame received before the schema')
+            seq, message_dict = self.schema.unpack(message, self.user)
+            self.last_request = seq if seq != NO_REQUEST else None
+            return message_dict
+
+        try:
+            message_dict = json.loads(message)
+        except ValueError as err:
+            raise SchemaError('Invalid JSON message: {}'.format(err))
+        if not isinstance(message_dict, dict):
+            raise SchemaError('The message is not a dictionary')
+        self.last_request = message_dict.pop(REQUEST_KEYWORD, None)
+        if METAKEYWORD in message_dict:
+            self.user = message_dict['user']
+            self.schema = None
+            if SCHEMA_KEYWORD in message_dict:
+                try:
+                    self.schema = FrameSchema.from_description(message_dict[SCHEMA_KEYWORD])
+                except (KeyError, TypeError) as err:
+                    raise SchemaError('Invalid schema: {}'.format(err))
+        elif self.user is None:
+            # The node did not send its metadata: learn its user name
+            # from the data instead
+            self.user = message_dict['user']
+        return message_dict
@@ -0,0 +1,262 @@
+"""Historical data queries of the lab-nanny master server
+
+The HISTORY_ADDR address of the master (see
+servers.server_master.HistoryHandler) serves the history of the channels of
+a lab, e.g.
+
+    GET /history?lab=lab7&channels=ch2,ch4&start=1557900000&end=1558500000
+                &points=1000&method=lttb
+
+The data is read from the database (see database.DBHandler.query) at the
+coarsest resolution which still gives the requested number of points (or,
+in the full-rate mode, from the sample store when the raw data is needed),
+and downsampled to that number of points:
+-- 'lttb' (Largest-Triangle-Three-Buckets): keeps the points which preserve
+   the visual shape of the series, {'x': [...], 'y': [...]}
+-- 'minmax': the minimum and maximum of each bucket, so the spikes are never
+   lost, {'x': [...], 'min': [...], 'max': [...]}
+
+The queries run in a pool of worker threads (each one with its own
+read-only connection to the database), so a long query never blocks the
+IOLoop. Each channel is read, downsampled and serialized by a worker
+(HistoryQuery.channel), so the channels of a query are computed in
+parallel. The handler only starts the response once every chunk is ready
+(so a failed query is answered with an error status, not a truncated
+body), and then writes and flushes it one channel at a time. The last
+responses (up to HISTORY_CACHE_BYTES each) are kept in a bounded LRU cache
+for HISTORY_CACHE_TTL seconds.
+
+With a time-partitioned database (see database.PartitionedDB), a query only
+opens the partitions overlapping its time range.
+"""
+import collections
+import json
+import math
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from database.DBHandler import DBHandler, RAW_RESOLUTION
+from database.PartitionedDB import PartitionedDB
+from database.SampleStore import read_samples
+
+HISTORY_WORKERS    = 2
+HISTORY_CACHE_SIZE = 64     # Responses kept in the cache
+HISTORY_CACHE_TTL  = 30     # (s) Time a response is kept in the cache
+HISTORY_CACHE_BYTES = 1 << 20   # Larger responses are not cached
+HISTORY_SPAN       = 86400  # (s) Default time range (until now)
+HISTORY_POINTS     = 1000   # Default number of points per channel
+MAX_POINTS         = 20000
+METHODS = ('lttb', 'minmax')
+FOOTER  = b'}}'     # Last chunk of a response
+
+# Lab and channel names are used as table and column names
+_NAME = re.compile(r'^\w+$')
+
+
+def lttb(x, y, points):
+    """ Downsamples a series with the Largest-Triangle-Three-Buckets
+    algorithm.
+
+    The first and last points are kept; from each of the points-2 buckets in
+    between, the point forming the largest triangle with the point selected
+    in the previous bucket and the average of the next bucket is kept.
+
+    :return: (x, y) arrays with (at most) points samples
+    """
+    n = len(x)
+    if points >= n or points < 3:
+        return x, y
+    every = (n - 2)/(points - 2)
+    selected = np.empty(points, dtype=np.intp)
+    selected[0] = 0
+    selected[-1] = n - 1
+    a = 0
+    for i in range(points - 2):
+        start = int(i*every) + 1
+        end = int((i + 1)*every) + 1
+        next_end = min(int((i + 2)*every) + 1, n)
+        if end >= next_end:
+            avg_x, avg_y = x[-1], y[-1]
+        else:
+            avg_x = x[end:next_end].mean()
+            avg_y = y[end:next_end].mean()
+        area = np.abs((x[a] - avg_x)*(y[start:end] - y[a]) -
+                      (x[a] - x[start:end])*(avg_y - y[a]))
+        a = start + int(np.argmax(area))
+        selected[i + 1] = a
+    return x[selected], y[selected]
+
+
+def minmax(x, low, high, points):
+    """ Downsamples a series to points/2 buckets, keeping the minimum of low
+    and the maximum of high in each bucket.
+
+    :return: (x, min, max) arrays, x being the start of each bucket
+    """
+    buckets = max(1, points//2)
+    n = len(x)
+    if buckets >= n:
+        return x, low, high
+    edges = np.linspace(0, n, buckets + 1).astype(np.intp)[:-1]
+    return (x[edges], np.minimum.reduceat(low, edges),
+            np.maximum.reduceat(high, edges))
+
+
+def check_name(name):
+    """ Raises ValueError if a lab or channel name is not an identifier."""
+    if not _NAME.match(name):
+        raise ValueError('Invalid name {!r}'.format(name))
+    return name
+
+
+class HistoryQuery(object):
+    """ Runs the history queries in a pool of worker threads.
+
+    :param db_name: name of the sqlite database
+    :param samples_dir: directory of the sample store (full-rate mode), or
+                        None
+    :param partition_period: 'day' or 'week' if db_name is the directory of
+                             a partitioned database, or None
+    :param retention: retention of the database (see DBWriter), so the
+                      resolution of a query is one whose data is still kept
+    """
+    def __init__(self, db_name, samples_dir=None, workers=HISTORY_WORKERS,
+                 cache_size=HISTORY_CACHE_SIZE, cache_ttl=HISTORY_CACHE_TTL,
+                 cache_bytes=HISTORY_CACHE_BYTES, partition_period=None,
+                 retention=None):
+        self.db_name = db_name
+        self.partition_period = partition_period
+        self.retention = retention
+        self.samples_dir = samples_dir
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='history')
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.cache_bytes = cache_bytes
+        self._cache = collections.OrderedDict()   # key -> (expiry, chunks)
+        self._local = threading.local()
+        # Counters, read by the metrics of the master server
+        self.hits = 0
+        self.misses = 0
+
+    def cached(self, key, now):
+        """ Returns the chunks of a cached response, or None.
+
+        The cache is only used from the IOLoop, so it needs no lock.
+        """
+        entry = self._cache.get(key)
+        if entry is None or entry[0] < now:
+            self.misses += 1
+            return None
+        self._cache.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def store(self, key, chunks, now):
+        self._cache[key] = (now + self.cache_ttl, chunks)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+    def _database(self):
+        """ Returns the read-only connection of the current worker."""
+        db = getattr(self._local, 'db', None)
+        if db is None and self.partition_period:
+            db = self._local.db = PartitionedDB(self.db_name, self.partition_period,
+                                                retention=self.retention,
+                                                readonly=True)
+        elif db is None:
+            db = self._local.db = DBHandler(db_name=self.db_name, readonly=True,
+                                            retention=self.retention)
+        return db
+
+    def header(self, lab, start, end, points, method):
+        """ Chooses the resolution of a query (in a worker thread).
+
+        :return: (resolution, first chunk of the response)
+        """
+        resolution = self._database().choose_resolution(start, end, points)
+        header = {'lab': lab, 'start': start, 'end': end, 'points': points,
+                  'method': method, 'resolution': resolution}
+        return resolution, json.dumps(header)[:-1].encode() + b', "channels": {'
+
+    def channel(self, lab, channel, first, start, end, points, method,
+                resolution):
+        """ Reads, downsamples and serializes a channel (in a worker thread).
+
+        :param first: True for the first channel of the response
+        :return: chunk (bytes) of the response
+        """
+        x, low, high, mean = self.series(self._database(), lab, channel,
+                                         start, end, resolution)
+        if method == 'lttb':
+            x, mean = lttb(x, mean, points)
+            series = {'x': x.tolist(), 'y': mean.tolist()}
+        else:
+            x, low, high = minmax(x, low, high, points)
+            series = {'x': x.tolist(), 'min': low.tolist(),
+                      'max': high.tolist()}
+        return '{}{}: {}'.format('' if first else ', ', json.dumps(channel),
+                                 json.dumps(series)).encode()
+
+    def run(self, lab, channels, start, end, points, method):
+        """ Yields the chunks of the response to a query, computed in the
+        current thread (servers.server_master.HistoryHandler runs each step
+        in a worker instead)."""
+        resolution, chunk = self.header(lab, start, end, points, method)
+        yield chunk
+        for i, channel in enumerate(channels):
+            yield self.channel(lab, channel, i == 0, start, end, points,
+                               method, resolution)
+        yield FOOTER
+
+    def series(self, db, lab, channel, start, end, resolution):
+        """ Returns the (x, min, max, mean) arrays of a channel."""
+        if resolution == RAW_RESOLUTION and self.samples_dir:
+            data = read_samples(self.samples_dir, lab, start, end, [channel])
+            valid = ~np.isnan(data[channel])
+            values = data[channel][valid]
+            return data['x'][valid], values, values, values
+        try:
+            data = db.query(lab, channel, start, end, resolution=resolution)
+        except sqlite3.OperationalError:
+            # Unknown lab or channel
+            empty = np.zeros(0)
+            return empty, empty, empty, empty
+        return data['x'], data['min'], data['max'], data['mean']
+
+
+def parse_query(arguments, now=None):
+    """ Parses the arguments of a history request.
+
+    :param arguments: function returning the value of an argument (or a
+                      default), e.g. RequestHandler.get_argument
+    :return: (lab, channels, start, end, points, method)
+    :raises ValueError: if an argument is not valid
+    """
+    now = time.time() if now is None else now
+    lab = check_name(arguments('lab', ''))
+    channels = [check_name(channel) for channel in
+                arguments('channels', '').split(',') if channel]
+    if not channels:
+        raise ValueError('No channels given')
+    end = float(arguments('end', now))
+    start = float(arguments('start', end - HISTORY_SPAN))
+    if not (math.isfinite(start) and math.isfinite(end)):
+        raise ValueError('start and end must be finite')
+    if start >= end:
+        raise ValueError('Empty time range')
+    points = int(arguments('points', HISTORY_POINTS))
+    if not 3 <= points <= MAX_POINTS:
+        raise ValueError('points must be between 3 and {}'.format(MAX_POINTS))
+    method = arguments('method', 'lttb')
+    if method not in METHODS:
+        raise ValueError('method must be one of {}'.format(', '.join(METHODS)))
+    return lab, channels, start, end, points, method
@@ -0,0 +1,286 @@
+"""Polling scheduler and request tracking for the lab-nanny master server
+
+Instead of broadcasting a request to all the nodes at the same instant, the
+master polls each node on its own schedule:
+-- every laboratory has its own poll rate (e.g. 1 Hz for a slow temperature
+   log, 20 Hz for a laser lock); labs without an explicit rate are polled
+   with the period of the master (PERIODICITY).
+-- the first poll of each node is delayed by a fraction of its period, so
+   that the requests (and the replies) are spread across the period instead
+   of arriving in a burst.
+-- a node that has not replied to its previous request when the next one is
+   due is not polled again (the requests do not pile up, see
+   RequestTracker). After MISSED_POLLS_LIMIT consecutive misses its period
+   is doubled (up to MAX_POLL_PERIOD), and it recovers its rate step by
+   step once it replies on time again.
+-- if the master falls behind (e.g. a tick that takes longer than its
+   period), the missed polls are not sent in a burst: the schedule of the
+   late nodes restarts from the current time.
+
+Every request sent to a node (polls and actuation commands) carries a
+sequence number, 'user,pin_number,pin_value,seq', which the node echoes in
+its reply. The RequestTracker keeps the requests in flight of each node,
+measures the round-trip time of each reply, and rejects the replies older
+than the last one accepted (a late reply must not overwrite newer data).
+The sequence numbers wrap around (they are sent as uint32, 0 meaning no
+request), so they are compared with serial-number arithmetic: a number is
+newer than another if it follows it by less than half the sequence space.
+Nodes that do not echo the sequence numbers are still supported: their
+replies answer all the requests in flight.
+"""
+from servers.protocol import MAX_SEQUENCE
+
+MAX_POLL_PERIOD    = 10.0   # (s) Slowest period of a backed-off node
+MISSED_POLLS_LIMIT = 3      # Consecutive missed polls before backing off
+BACKOFF_FACTOR     = 2      # The period is multiplied by... when backing off
+RECOVERY_POLLS     = 10     # Polls answered on time before speeding up again
+REQUEST_TIMEOUT    = 5      # (periods) A request without reply is lost after...
+
+# Sequence numbers go from 1 to _SEQUENCE_SPACE (0 is NO_REQUEST)
+_SEQUENCE_SPACE = MAX_SEQUENCE - 1
+
+# Fractional part of the golden ratio: successive multiples are spread
+# evenly over [0, 1), whatever the number of nodes.
+_STAGGER_STEP = 0.6180339887498949
+
+
+class NodeSchedule(object):
+    """ Polling state of a node."""
+    __slots__ = ('node_id', 'lab', 'base_period', 'period', 'next_due',
+                 'misses', 'on_time', 'polls', 'skipped',
+                 'lost', 'backoffs')
+
+    def __init__(self, node_id, lab, period, next_due):
+        self.node_id = node_id
+        self.lab = lab
+        self.base_period = period   # period requested for the lab
+        self.period = period        # current period (after back-off)
+        self.next_due = next_due
+        self.misses = 0             # consecutive polls skipped
+        self.on_time = 0            # consecutive requests answered on time
+        self.polls = 0
+        self.skipped = 0
+        self.lost = 0
+        self.backoffs = 0
+
+
+class PollScheduler(object):
+    """ Decides which nodes must be polled at a given time.
+
+    The polls must be sent through the RequestTracker given (e.g. with
+    CommsHandler.send_request), which tells whether a node is still
+    processing a previous request.
+
+    :param default_period: (s) period of the labs without an explicit rate
+    :param rates: dictionary {lab: poll rate (Hz)}
+    :param requests: RequestTracker of the requests sent to the nodes
+    """
+    def __init__(self, default_period, rates=None, requests=None,
+                 max_period=MAX_POLL_PERIOD):
+        self.default_period = default_period
+        self.rates = dict(rates or {})
+        self.requests = requests if requests is not None else RequestTracker()
+        self.max_period = max_period
+        self.schedules = {}    # node id -> NodeSchedule
+        self._added = 0
+
+    def __len__(self):
+        return len(self.schedules)
+
+    def period_of(self, lab):
+        """ Returns the requested poll period (s) of a lab."""
+        rate = self.rates.get(lab)
+        if not rate:
+            return self.default_period
+        return 1.0/rate
+
+    def set_rate(self, lab, rate):
+        """ Changes the poll rate (Hz) of a lab (None for the default)."""
+        if rate:
+            self.rates[lab] = rate
+        else:
+            self.rates.pop(lab, None)
+        for schedule in self.schedules.values():
+            if schedule.lab == lab:
+                schedule.base_period = schedule.period = self.period_of(lab)
+
+    def add(self, node_id, lab, now):
+        """ Adds a node, with its first poll staggered within its period."""
+        period = self.period_of(lab)
+        phase = (self._added*_STAGGER_STEP) % 1
+        self._added += 1
+        schedule = NodeSchedule(node_id, lab, period, now + phase*period)
+        self.schedules[node_id] = schedule
+        return schedule
+
+    def due(self, now, nodes, horizon=0):
+        """ Returns the ids of the nodes that must be polled now.
+
+        The schedule is kept in sync with the connected nodes: new nodes are
+        added, and the nodes that disconnected are forgotten.
+
+        :param now: current time (s)
+        :param nodes: dictionary {node_id: handler} of the connected nodes
+                      (the handlers may have a 'user' attribute)
+        :param horizon: (s) also return the nodes due before now+horizon
+        :return: list of node ids
+        """
+        polled = []
+        for node_id, node in nodes.items():
+            lab = getattr(node, 'user', None)
+            schedule = self.schedules.get(node_id)
+            if schedule is None:
+                schedule = self.add(node_id, lab, now)
+            elif schedule.lab != lab:
+                # The lab of a node is known once it sends its metadata
+                schedule.lab = lab
+                schedule.base_period = schedule.period = self.period_of(lab)
+            if schedule.next_due > now + horizon:
+                continue
+            if self._is_waiting(schedule, now):
+                self._skip(schedule)
+            else:
+                schedule.polls += 1
+                polled.append(node_id)
+            schedule.next_due += schedule.period
+            if schedule.next_due < now:
+                # The master fell behind: do not try to catch up
+                schedule.next_due = now + schedule.period
+        if len(self.schedules) > len(nodes):
+            for node_id in [node_id for node_id in self.schedules
+                            if node_id not in nodes]:
+                del self.schedules[node_id]
+        return polled
+
+    def replied(self, node_id):
+        """ Records the (accepted) reply of a node."""
+        schedule = self.schedules.get(node_id)
+        if schedule is None:
+            return
+        schedule.misses = 0
+        schedule.on_time += 1
+        if schedule.period > schedule.base_period \
+                and schedule.on_time >= RECOVERY_POLLS:
+            schedule.period = max(schedule.base_period,
+                                  schedule.period/BACKOFF_FACTOR)
+            schedule.on_time = 0
+
+    def _is_waiting(self, schedule, now):
+        """ Whether a node is still processing a previous request."""
+        sent = self.requests.oldest(schedule.node_id)
+        if sent is None:
+            return False
+        if now - sent > REQUEST_TIMEOUT*schedule.period:
+            # The requests (or their replies) were lost: poll again
+            schedule.lost += self.requests.expire(schedule.node_id)
+            return False
+        return True
+
+    def _skip(self, schedule):
+        """ Skips the poll of a node that did not reply to the previous one,
+        and backs off if it keeps falling behind."""
+        schedule.skipped += 1
+        schedule.misses += 1
+        schedule.on_time = 0
+        if schedule.misses >= MISSED_POLLS_LIMIT:
+            schedule.misses = 0
+            if schedule.period < self.max_period:
+                schedule.period = min(self.max_period,
+                                      schedule.period*BACKOFF_FACTOR)
+                schedule.backoffs += 1
+
+
+class RequestTracker(object):
+    """ Sequence numbers and requests in flight of every node."""
+    def __init__(self):
+        self._next_seq = {}     # node id -> last sequence number issued
+        self._in_flight = {}    # node id -> {seq: time sent}, in order
+        self._last_reply = {}   # node id -> last sequence number accepted
+        self.rtt = {}           # node id -> last round-trip time (s)
+        self.stale_replies = 0  # replies rejected for arriving out of order
+
+    def issue(self, node_id, now):
+        """ Returns the sequence number of a new request to a node."""
+        seq = self._next_seq.get(node_id, 0) % _SEQUENCE_SPACE + 1
+        self._next_seq[node_id] = seq
+        self._in_flight.setdefault(node_id, {})[seq] = now
+        return seq
+
+    def reply(self, node_id, seq, now):
+        """ Records the reply of a node to the request seq.
+
+        The nodes process their requests in order, so a reply also answers
+        (or makes obsolete) the earlier requests still in flight.
+
+        :param seq: sequence number echoed by the node (None if the node
+                    does not echo them)
+        :return: False if the reply is older than the last one accepted,
+                 and must be discarded
+        """
+        in_flight = self._in_flight.get(node_id)
+        if seq is None:
+            if in_flight:
+                self.rtt[node_id] = now - max(in_flight.values())
+                in_flight.clear()
+            return True
+        last = self._last_reply.get(node_id)
+        if last is not None and not is_newer(seq, last):
+            self.stale_replies += 1
+            return False
+        self._last_reply[node_id] = seq
+        if in_flight:
+            sent = in_flight.get(seq)
+            if sent is not None:
+                self.rtt[node_id] = now - sent
+            for answered in [key for key in in_flight
+                             if not is_newer(key, seq)]:
+                del in_flight[answered]
+        return True
+
+    def pending(self, node_id):
+        """ Returns the number of requests in flight to a node."""
+        return len(self._in_flight.get(node_id, ()))
+
+    def oldest(self, node_id):
+        """ Returns the time when the oldest request in flight to a node
+        was sent, or None."""
+        in_flight = self._in_flight.get(node_id)
+        if not in_flight:
+            return None
+        return next(iter(in_flight.values()))
+
+    def expire(self, node_id):
+        """ Forgets the requests in flight to a node (considered lost).
+
+        :return: the number of requests forgotten
+        """
+        in_flight = self._in_flight.get(node_id)
+        if not in_flight:
+            return 0
+        lost = len(in_flight)
+        in_flight.clear()
+        return lost
+
+    def forget(self, node_id):
+        """ Removes a node whose connection closed."""
+        self._next_seq.pop(node_id, None)
+        self._in_flight.pop(node_id, None)
+        self._last_reply.pop(node_id, None)
+        self.rtt.pop(node_id, None)
+
+
+def is_newer(seq, other):
+    """ Whether the sequence number seq was issued after other (the numbers
+    wrap around after _SEQUENCE_SPACE)."""
+    return 0 < (seq - other) % _SEQUENCE_SPACE < _SEQUENCE_SPACE//2
+
+
+def parse_rates(text):
+    """ Parses poll rates given as 'lab6=1,lab7=20' into {lab: rate (Hz)}."""
+    rates = {}
+    if not text:
+        return rates
+    for item in text.split(','):
+        lab, rate = item.split('=')
+        rates[lab.strip()] = float(rate)
+    return rates
@@ -9,9 +9,9 @@ different nodes and make it available in two forms:
 -- store it in a database
 
 To do this, the master uses the Masterserver.tick method, which
--- submits updates to the clients
--- sends requests for data to the nodes
-(in this order)
+submits updates to the clients, and the MasterServer.poll method, which
+sends requests for data to the nodes, each one at the rate of its
+laboratory (see servers.scheduler).
 By centralizing the communications (that is, nodes send updates to
 MasterServer, which then sends them to the clients), we reduce the
 amount of connections required from (#clients * #nodes) to
@@ -39,12 +39,33 @@ import tornado.ioloop as ioloop
 import tornado.web
 import tornado
 from tornado.websocket import WebSocketClosedError
+from tornado.iostream import StreamClosedError
+from tornado import gen
 import signal
 
 import argparse
+import logging
+import multiprocessing
 import time
-from database.DBHandler import DBHandler as DBHandler
-from servers.header import MST_HEADER
+from database.DBWriter import DBWriter
+from database.DBHandler import RETENTION, RAW_RESOLUTION
+from database.PartitionedDB import PARTITION_DIR, PERIODS
+from database.SampleStore import SampleStore, SAMPLES_DIR, FLUSH_INTERVAL
+from servers.header import MST_HEADER, TFORMAT
+from servers.broadcaster import ClientBroadcaster, Subscription, \
+                                KEYFRAME_INTERVAL
+from servers.conditions import ConditionEngine
+from servers.history import HistoryStore, HISTORY_LENGTH
+from servers.hostnames import HostnameCache
+from servers import logs
+from servers.metrics import MetricsRegistry, Counter, Histogram, \
+                            CallbackMetric
+from servers.scheduler import PollScheduler, RequestTracker, parse_rates
+from servers.queries import HistoryQuery, parse_query, FOOTER
+from servers.protocol import MessageDecoder, SchemaError, METAKEYWORD
+from servers.shards import run_shard_worker, SHARD_PORT, SHARD_SOCKETNAME
+from servers.snapshot import save_snapshot, load_snapshot, SNAPSHOT_FILE, \
+                             SNAPSHOT_INTERVAL, RESTORE_TIMEOUT
 
 import uuid
 import socket
@@ -55,17 +76,32 @@ SOCKETPORT  = 8001
 SLAVE_SOCKETNAME  = r'/nodes_ws'
 CLIENT_SOCKETNAME = r'/client_ws'
 STATUS_ADDR       = r'/status'
+METRICS_ADDR      = r'/metrics'
+LOGGING_ADDR      = r'/logging'
+HISTORY_ADDR      = r'/history'
+
+STATUS_INTERVAL   = 5       # (s) Rebuild the status page at most every...
 
 DEFAULTMESSAGE    = 'X,50,0'
 DEFAULTDBNAME     = 'example.db'
 PERIODICITY       = 100
+POLL_RESOLUTION   = 10      # (ms) Check which nodes must be polled every...
+OVERRUN_REPORT_INTERVAL = 10  # (s) Report the tick overruns at most every...
 DB_PERIODICITY    = 30000   #Save data to db every...
 
-TFORMAT = '%y/%m/%d %H:%M:%S'
+# Publication modes (see MasterServer.tick)
+PUBLISH_TICK      = 'tick'   # publish the data of the previous poll on each tick
+PUBLISH_EVENT     = 'event'  # publish as soon as the nodes reply to the poll
+PUBLISH_DEADLINE  = 80       # (ms) In event mode, publish after this time even if some nodes did not reply
+COALESCE_WINDOW   = 5        # (ms) In event mode, wait this long after the last reply before publishing
 
-METAKEYWORD = 'meta'
 CONNCLOSEDSTR = 'Connection closed'
 
+log = logs.get_logger('master')
+log_nodes = logs.get_logger('nodes')
+log_clients = logs.get_logger('clients')
+log_shards = logs.get_logger('shards')
+
 
 
 condition_trap = {'name':'Trap unlock',
@@ -75,7 +111,10 @@ condition_trap = {'name':'Trap unlock',
                   'target_lab':'lab7',
                   'target_ch':13,
                   'target_val':1,
-                  'message':'Trap unlocked'}
+                  'message':'Trap unlocked',
+                  'hold':0.2,
+                  'hysteresis':0.05,
+                  'min_interval':5}
 
 condition_temp = {'name':'Temperature changes',
                   'obs_lab':'lab7',
@@ -84,7 +123,10 @@ condition_temp = {'name':'Temperature changes',
                   'target_lab':'lab7',
                   'target_ch':13,
                   'target_val':1,
-                  'message':'Temperature outside of bounds'}
+                  'message':'Temperature outside of bounds',
+                  'hold':1.0,
+                  'hysteresis':0.5,
+                  'min_interval':10}
 
 
 class MasterServer(object):
@@ -95,7 +137,8 @@ class MasterServer(object):
     CommsHandler class to do internal communications.
 
     Periodically (every fraction of a second), the Master server polls the
-    nodes for data, and sends the results to the clients.
+    nodes for data, and sends the results to the clients. The conditions
+    are checked as soon as new data arrives from the nodes.
     Additionally, with a different periodicity (~10s) the Master server
     saves a copy of the data to a database.
 
@@ -106,30 +149,122 @@ class MasterServer(object):
                  periodicity=PERIODICITY,
                  db_periodicity = DB_PERIODICITY,
                  status_addr = STATUS_ADDR,
+                 metrics_addr = METRICS_ADDR,
+                 logging_addr = LOGGING_ADDR,
+                 history_addr = HISTORY_ADDR,
+                 delta_frames = False,
+                 keyframe_interval = KEYFRAME_INTERVAL,
+                 publish_mode = PUBLISH_TICK,
+                 publish_deadline = PUBLISH_DEADLINE,
+                 coalesce_window = COALESCE_WINDOW,
+                 shards = 0,
+                 shard_port = SHARD_PORT,
+                 poll_rates = None,
+                 poll_resolution = POLL_RESOLUTION,
+                 snapshot_file = SNAPSHOT_FILE,
+                 snapshot_interval = SNAPSHOT_INTERVAL,
+                 full_rate = False,
+                 samples_dir = SAMPLES_DIR,
+                 retention_days = RETENTION[RAW_RESOLUTION]/86400.0,
+                 partition_period = None,
+                 partition_dir = PARTITION_DIR,
                  verbose = True):
          #Init parameters
+        # The messages are written by a background thread (see servers.logs)
+        logs.setup_logging(verbose=verbose)
         self.socketport             = socketport
         self.slave_socketname        = slave_socketname
         self.client_socketname       = client_socketname
         self.status_addr             = status_addr
+        self.metrics_addr            = metrics_addr
+        self.logging_addr            = logging_addr
+        self.history_addr            = history_addr
         self.callback_periodicity    = periodicity
         self.db_callback_periodicity = db_periodicity
         self.verbose                 = verbose
+        self.publish_mode            = publish_mode
+        self.publish_deadline        = publish_deadline
+        self.coalesce_window         = coalesce_window
+        self.num_shards              = shards
+        self.shard_port              = shard_port
+        self.shard_processes         = []
+        self.poll_resolution         = poll_resolution
+        self.snapshot_file           = snapshot_file
+        self.snapshot_interval       = snapshot_interval
         self.callback                = []
+        self.pollcallback            = []
         self.dbcallback              = []
+        self.snapshotcallback        = []
+        self.samplescallback         = []
         self.HTTPserver              = []
         self._conditions             = []  # list of dictionaries
+        # State of the current poll in the event-driven mode
+        self._awaiting_replies       = set()
+        self._round_open             = False
+        self._deadline_handle        = None
+        self._publish_handle         = None
+        self._overruns               = 0
+        self._last_overrun_report    = 0
+        self._snapshot_future        = None
 
         # Create instance of the CommsHandler to mediate communications between
         # node and client handlers
         self.comms_handler = CommsHandler()
+        # Each lab is polled at its own rate, with the requests staggered
+        # across the period (see servers.scheduler)
+        self.scheduler = PollScheduler(periodicity/1000.0, poll_rates,
+                                       requests=self.comms_handler.requests)
+        # The frames sent to the clients are serialized once per tick and
+        # subscription group (see servers.broadcaster)
+        self.client_broadcaster = ClientBroadcaster(delta=delta_frames,
+                                                    keyframe_interval=keyframe_interval,
+                                                    base_rate=1000.0/periodicity)
+        # Recent history of each (lab, channel), sent to the new clients
+        self.history = HistoryStore(capacity=HISTORY_LENGTH)
+        self.comms_handler.bind_to_data_change(
+            lambda idx, data_dict: self.history.append(data_dict))
         # Add callback db_metadata_append upon change to the metadata in nodes
         self.comms_handler.bind_to_metadata_change(self.db_metadata_append)
-        # Also, start communication with the database
-        self.db_handler = DBHandler(db_name=DEFAULTDBNAME)
+        # The conditions are checked whenever a node sends new data
+        self.comms_handler.bind_to_data_change(self.check_conditions)
+        self.comms_handler.bind_to_data_change(self.on_node_reply)
+        # Also, start communication with the database. The writes are done
+        # by a background thread (see database.DBWriter)
+        self.db_flush_duration = Histogram(
+            'nanny_db_flush_duration_seconds', 'Duration of the database commits',
+            buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0))
+        # The raw data older than retention_days is deleted (0: keep it),
+        # and the rollups are kept as set in database.DBHandler.RETENTION.
+        # With a partition_period, the database is split in one file per lab
+        # and day or week (see database.PartitionedDB)
+        db_name = partition_dir if partition_period else DEFAULTDBNAME
+        retention = {RAW_RESOLUTION: retention_days*86400}
+        self.db_writer = DBWriter(db_name=db_name,
+                                   flush_histogram=self.db_flush_duration,
+                                   retention=retention,
+                                   partition_period=partition_period)
+        # In the full-rate mode, every sample is also recorded (see
+        # database.SampleStore)
+        self.sample_store = None
+        if full_rate:
+            self.sample_store = SampleStore(samples_dir)
+            self.comms_handler.bind_to_data_change(
+                lambda idx, data_dict: self.sample_store.append(data_dict))
         # Init program
         self._conditions.append(condition_trap)
         self._conditions.append(condition_temp)
+        self.condition_engine = ConditionEngine(self._conditions)
+        # Queries of the history, run in a pool of threads (see servers.queries)
+        self.history_query = HistoryQuery(db_name,
+                                          samples_dir if full_rate else None,
+                                          partition_period=partition_period,
+                                          retention=retention)
+        # The status page is rendered at most once every STATUS_INTERVAL
+        self.status_snapshot = StatusSnapshot(self.comms_handler)
+        self.metrics = self.setup_metrics()
+        self.comms_handler.bind_to_data_change(self.count_node_message)
+        # Start from the state saved before the last shutdown, if any
+        self.restore_snapshot()
 
 
 
@@ -146,25 +281,51 @@ class MasterServer(object):
         shows information about the status of the master server using the same
         socket and a different address ('/status').
 
-        Afterwards, this method initialises two periodic callbacks:
+        If shards>0, the worker processes of the sharded mode are started
+        first (see servers.shards): they accept node connections on
+        self.shard_port and forward the data to this server, through the
+        SHARD_SOCKETNAME websocket.
+
+        Afterwards, this method initialises the periodic callbacks:
         - One that manages the node/client communications, typically with a
         sub-second periodicity
+        - (tick mode) Another one that polls the nodes whose request is due
+        (every poll_resolution, see MasterServer.poll)
         - Another one to store long-term traces of the data to a database
         (every ~10s)
+        - Another one to save a snapshot of the state of the server (see
+        MasterServer.write_snapshot)
+        - (full-rate mode) Another one to write the buffered samples
+        (every FLUSH_INTERVAL)
         """
-
+        self.start_shards()
+        # Restored nodes which do not reconnect are dropped after a while
+        if self.comms_handler.restored:
+            ioloop.IOLoop.current().call_later(RESTORE_TIMEOUT,
+                                               self.comms_handler.drop_restored)
 
         self.application = tornado.web.Application([(self.slave_socketname,
                                                      NodeHandler,
-                                                     {'comms_handler':self.comms_handler,
-                                                      'verbose':self.verbose}),
+                                                     {'comms_handler':self.comms_handler}),
                                                     (self.client_socketname,
                                                      ClientHandler,
                                                      {'comms_handler':self.comms_handler,
-                                                      'verbose':self.verbose}),
+                                                      'client_broadcaster':self.client_broadcaster,
+                                                      'history':self.history}),
+                                                    (SHARD_SOCKETNAME,
+                                                     ShardHandler,
+                                                     {'comms_handler':self.comms_handler}),
                                                     (self.status_addr,
                                                      StatusHandler,
-                                                     {'comms_handler':self.comms_handler})])
+                                                     {'status_snapshot':self.status_snapshot}),
+                                                    (self.metrics_addr,
+                                                     MetricsHandler,
+                                                     {'registry':self.metrics}),
+                                                    (self.logging_addr,
+                                                     LoggingHandler),
+                                                    (self.history_addr,
+                                                     HistoryHandler,
+                                                     {'history_query':self.history_query})])
         try:
             self.HTTPserver = self.application.listen(self.socketport)
             fqdn = socket.getfqdn()
@@ -174,6 +335,18 @@ class MasterServer(object):
                                                          self.socketport,
                                                          self.status_addr,
                                                          alias))
+            print('Metrics:        @ {}:{}{},    ({})'.format(fqdn,
+                                                         self.socketport,
+                                                         self.metrics_addr,
+                                                         alias))
+            print('Log levels:     @ {}:{}{},    ({})'.format(fqdn,
+                                                         self.socketport,
+                                                         self.logging_addr,
+                                                         alias))
+            print('History:        @ {}:{}{},    ({})'.format(fqdn,
+                                                         self.socketport,
+                                                         self.history_addr,
+                                                         alias))
             print('Websockets opened:')
             print('-Client WS EST  @ {}:{}{},  ({})'.format(fqdn,
                                                            self.socketport,
@@ -183,6 +356,11 @@ class MasterServer(object):
                                                            self.socketport,
                                                            self.slave_socketname,
                                                            alias))
+            if self.num_shards:
+                print('-Nodes WS EST   @ {}:{}{},   ({} shards)'.format(fqdn,
+                                                                     self.shard_port,
+                                                                     self.slave_socketname,
+                                                                     self.num_shards))
             print('-----------------------------------')
 
         except socket.error as error:
@@ -195,6 +373,10 @@ class MasterServer(object):
         self.callback= ioloop.PeriodicCallback(self.tick,
                                                self.callback_periodicity)
         self.callback.start()
+        if self.publish_mode == PUBLISH_TICK:
+            self.pollcallback = ioloop.PeriodicCallback(self.poll,
+                                                        self.poll_resolution)
+            self.pollcallback.start()
         print('\nStarting ioloop')
 
 
@@ -203,11 +385,21 @@ class MasterServer(object):
                                                  self.db_callback_periodicity)
         self.dbcallback.start()
 
+        if self.snapshot_file:
+            self.snapshotcallback = ioloop.PeriodicCallback(self.write_snapshot,
+                                                            self.snapshot_interval)
+            self.snapshotcallback.start()
+
+        if self.sample_store is not None:
+            self.samplescallback = ioloop.PeriodicCallback(self.sample_store.flush,
+                                                           FLUSH_INTERVAL*1000)
+            self.samplescallback.start()
+
         try:
             ioloop.IOLoop.instance().start()
         except KeyboardInterrupt:
             ioloop.IOLoop.instance().stop()
-            print('(MST  {}) Exiting gracefully... '.format(time.strftime(TFORMAT)))
+            log.info('Exiting gracefully... ')
         finally:
             self.on_close()
 
@@ -215,33 +407,108 @@ class MasterServer(object):
     def tick(self):
         """ Function called periodically to manage node/client communication
 
-        - First, the function sends the last data (obtained from the nodes)
-        to the clients
-        -  Then, it requests more data to the nodes.
-
-        By first sending the data, and then asking for more, we make sure the
-        nodes have time to send the data back to the MasterServer before
-        sending that data to the clients; this comes at the expense of sending
-        "old data" (with a repetition period), which has no impact unless the
-        application is time-critical.
+        The function sends the last data (obtained from the nodes) to the
+        clients. The data is serialized only once per tick and subscription
+        group (see servers.broadcaster.ClientBroadcaster) and, in delta mode,
+        only the values that changed since the previous frame are sent.
+        The nodes are polled separately (see MasterServer.poll), each one
+        at the rate of its lab and at a different time within the period, so
+        the replies have arrived by the time they are sent to the clients;
+        this comes at the expense of sending "old data" (with a repetition
+        period), which has no impact unless the application is time-critical.
+
+        In the event-driven mode (publish_mode=PUBLISH_EVENT) this one-period
+        delay is removed: the tick polls the nodes that are due before the
+        next tick (all at once, so the rates of the labs are rounded to
+        multiples of the tick period), and the data is published (see
+        MasterServer.publish) as soon as all the polled nodes have replied,
+        or when publish_deadline has passed, whichever comes first. If the
+        previous poll is still open when the next tick starts, its data is
+        published before polling again.
+
+        Ticks lasting longer than their period are counted and reported.
+
+        The frames are pushed to per-client queues (see
+        servers.broadcaster.ClientQueue), so a slow or closed client can
+        neither delay nor abort the polling of the nodes.
         """
-        # TODO: should only send data to the right client connection?, instead of relying on the nodes to check whether the message is for them?
-
-        try:
+        start = time.perf_counter()
+        if self.publish_mode == PUBLISH_EVENT:
+            if self._round_open:
+                self.publish()
+            polled = self.scheduler.due(time.time(), self.comms_handler.nodes,
+                                        horizon=self.callback_periodicity/1000.0)
+            self._awaiting_replies = set(polled)
+            self._round_open = True
+            self._deadline_handle = ioloop.IOLoop.current()\
+                .call_later(self.publish_deadline/1000.0, self.publish)
+            self.send_polls(polled)
+            if not self._awaiting_replies:
+                self.publish()
+        else:
             # If the NodeHandler decides to write messages to the clients upon
             # reception of each message, comment this line
-            ClientHandler.broadcast(self.comms_handler.last_data)
-            # Write a command with no side consequences. The 'X' ensures that
-            # all nodes reply
-            msg = DEFAULTMESSAGE
-            broadcast(self.comms_handler.nodes,msg)
-            self.check_conditions()
+            self.publish()
+        self.observe_duration(self.tick_duration, self.tick_overruns,
+                              time.perf_counter() - start,
+                              self.callback_periodicity)
+
+    def poll(self):
+        """ Function called every poll_resolution to request data to the
+        nodes whose poll is due (see servers.scheduler.PollScheduler)."""
+        self.send_polls(self.scheduler.due(time.time(), self.comms_handler.nodes))
 
+    def send_polls(self, node_ids):
+        """ Requests data to some nodes.
+
+        The request is a command with no side consequences. The 'X' ensures
+        that the node replies, whatever its user name.
+        """
+        nodes = self.comms_handler.nodes
+        for node_id in node_ids:
+            node = nodes.get(node_id)
+            if node is not None:
+                self.comms_handler.send_request(node, DEFAULTMESSAGE)
+
+    def publish(self):
+        """ Sends the last data (obtained from the nodes) to the clients.
+
+        In the event-driven mode, it also closes the current poll.
+        """
+        self._round_open = False
+        for handle in (self._deadline_handle, self._publish_handle):
+            if handle is not None:
+                ioloop.IOLoop.current().remove_timeout(handle)
+        self._deadline_handle = None
+        self._publish_handle = None
+        try:
+            self.client_broadcaster.publish(self.comms_handler.last_data,
+                                            self.comms_handler.data_version,
+                                            time.time())
         except WebSocketClosedError:
-            print('Websocket closed')
-        #In case we want to exit, we send a KeyboardInterrupt
-        except KeyboardInterrupt:
-            raise
+            log.warning('Websocket closed')
+
+    def on_node_reply(self, idx, data_dict):
+        """ Function called when a node sends new data.
+
+        Only the replies accepted by the CommsHandler (i.e. not older than
+        the previous one) reach this point. The reply is recorded by the
+        scheduler, and its round-trip time in the metrics. In the
+        event-driven mode, once all the polled nodes have replied, the data
+        is published after a short coalescing window (so that replies
+        arriving at about the same time go out in a single frame).
+        """
+        self.scheduler.replied(idx)
+        elapsed = self.comms_handler.requests.rtt.pop(idx, None)
+        if elapsed is not None:
+            self.node_reply_latency.observe(elapsed,
+                                            labels=(data_dict.get('user'),))
+        if self.publish_mode != PUBLISH_EVENT or not self._round_open:
+            return
+        self._awaiting_replies.discard(idx)
+        if not self._awaiting_replies and self._publish_handle is None:
+            self._publish_handle = ioloop.IOLoop.current()\
+                .call_later(self.coalesce_window/1000.0, self.publish)
 
     def db_tick(self):
         """ Function called periodically to save data to the database
@@ -250,24 +517,25 @@ class MasterServer(object):
         held in the CommsHandler.last_data instance.
 
         The details of writing to the database are found in the
-        database.DBHandler module.
+        database.DBHandler module. The entries are only queued here, and
+        written by the thread of the database.DBWriter.
         """
         # Write values to db (called every N seconds, probably 30-60)
         # if self.verbose:
 
         ## CHECK HERE IF THE METADATA HAS BEEN ADDED
-        num_connected_devices = len(self.comms_handler.last_data)
+        start = time.perf_counter()
+        # The data restored from a snapshot was already saved
+        restored = set(self.comms_handler.restored.values())
+        num_connected_devices = len(self.comms_handler.last_data) - len(restored)
         if num_connected_devices>0:
-            print('(MST  {}) Adding {} entries to DB '\
-                  .format(time.strftime(TFORMAT),num_connected_devices))
+            log.info('Adding %d entries to DB ', num_connected_devices)
 
-        for id in self.comms_handler.last_data:
-            datadict = self.comms_handler.last_data[id]
-            # Add data to observations table
-            # Check if table with name "id" exists
-            # Add data to specific table for ID
-            self.db_handler.add_database_entry(datadict)
-        self.db_handler.commit()
+        # All the observations are written in a single transaction
+        entries = [datadict for id, datadict in self.comms_handler.last_data.items()
+                   if id not in restored]
+        self.db_writer.add_database_entries(entries)
+        self.db_tick_duration.observe(time.perf_counter() - start)
 
     def db_metadata_append(self,idx):
         """ Function called when a new node transmits its metadata
@@ -275,7 +543,7 @@ class MasterServer(object):
         This function generates an entry in the database for each new node
         The entry in the database is composed of a timestamp, a username, and the JSON string.
         """
-        print('(MST  {}) Updating metadata'.format(time.strftime(TFORMAT)))
+        log.info('Updating metadata')
         # Metadata can be updated upon (re)connection, or when the connection
         # is closing. When (re)connecting, the metadata is a dictionary
         # which contains, amongst others, a 'user' key. This is not the
@@ -285,34 +553,275 @@ class MasterServer(object):
             user = self.comms_handler.metadata[idx]['user']
         else:
             user = self.comms_handler.last_data[idx]['user']
-        self.db_handler.register_new_metadata(user,self.comms_handler.metadata[idx])
+        self.db_writer.register_new_metadata(user,self.comms_handler.metadata[idx])
+
 
+    def setup_metrics(self):
+        """ Creates the metrics exposed in the METRICS_ADDR address.
+
+        The counters kept by other objects (client queues, condition engine,
+        websocket buffers) are read only when the metrics are requested.
+        """
+        registry = MetricsRegistry()
+        self.tick_duration = registry.add(Histogram(
+            'nanny_tick_duration_seconds', 'Duration of MasterServer.tick'))
+        self.tick_overruns = registry.add(Counter(
+            'nanny_tick_overruns_total', 'Ticks lasting longer than their period'))
+        self.db_tick_duration = registry.add(Histogram(
+            'nanny_db_tick_duration_seconds', 'Duration of MasterServer.db_tick',
+            buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)))
+        registry.add(self.db_flush_duration)
+        db_writer = self.db_writer
+        registry.add(CallbackMetric(
+            'nanny_db_queue_depth', 'Batches waiting to be written to the database',
+            lambda: [((), db_writer.depth)]))
+        registry.add(CallbackMetric(
+            'nanny_db_dropped_total', 'Batches dropped because the database queue was full',
+            lambda: [((), db_writer.dropped)], kind='counter'))
+        registry.add(CallbackMetric(
+            'nanny_db_errors_total', 'Failed database writes',
+            lambda: [((), db_writer.errors)], kind='counter'))
+        registry.add(CallbackMetric(
+            'nanny_db_rejected_total', 'Late observations of read-only database partitions',
+            lambda: [((), db_writer.rejected)], kind='counter'))
+        history_query = self.history_query
+        registry.add(CallbackMetric(
+            'nanny_history_queries_total', 'History queries, by cache result',
+            lambda: [(('hit',), history_query.hits), (('miss',), history_query.misses)],
+            ('cache',), kind='counter'))
+        registry.add(CallbackMetric(
+            'nanny_db_pruned_rows_total', 'Rows (or partitions) deleted by the retention policy',
+            lambda: [((), db_writer.pruned)], kind='counter'))
+        store = self.sample_store
+        if store is not None:
+            registry.add(CallbackMetric(
+                'nanny_samples_recorded_total', 'Samples recorded at full rate',
+                lambda: [((), store.samples)], kind='counter'))
+            registry.add(CallbackMetric(
+                'nanny_samples_written_bytes_total', 'Bytes written to the sample chunk files',
+                lambda: [((), store.bytes)], kind='counter'))
+            registry.add(CallbackMetric(
+                'nanny_samples_queue_depth', 'Sample blocks waiting to be written',
+                lambda: [((), store.depth)]))
+            registry.add(CallbackMetric(
+                'nanny_samples_dropped_total', 'Sample blocks dropped because the queue was full',
+                lambda: [((), store.dropped)], kind='counter'))
+            registry.add(CallbackMetric(
+                'nanny_samples_rejected_total', 'Samples of a lab with an invalid name',
+                lambda: [((), store.rejected)], kind='counter'))
+        self.node_messages = registry.add(Counter(
+            'nanny_node_messages_total', 'Data messages received from each node',
+            ('lab',)))
+        self.node_reply_latency = registry.add(Histogram(
+            'nanny_node_reply_latency_seconds',
+            'Round-trip time of the requests to each node', ('lab',)))
+        schedules = self.scheduler.schedules
+        registry.add(CallbackMetric(
+            'nanny_poll_period_seconds', 'Current poll period of each node',
+            lambda: [((s.lab,), s.period) for s in list(schedules.values())],
+            ('lab',)))
+        registry.add(CallbackMetric(
+            'nanny_polls_total', 'Requests sent to each node',
+            lambda: [((s.lab,), s.polls) for s in list(schedules.values())],
+            ('lab',), kind='counter'))
+        registry.add(CallbackMetric(
+            'nanny_polls_skipped_total', 'Polls skipped because the node had not replied yet',
+            lambda: [((s.lab,), s.skipped) for s in list(schedules.values())],
+            ('lab',), kind='counter'))
+        requests = self.comms_handler.requests
+        registry.add(CallbackMetric(
+            'nanny_requests_in_flight', 'Requests sent to each node without reply',
+            lambda: [((s.lab,), requests.pending(s.node_id)) for s in list(schedules.values())],
+            ('lab',)))
+        registry.add(CallbackMetric(
+            'nanny_stale_replies_total', 'Replies discarded for arriving out of order',
+            lambda: [((), requests.stale_replies)], kind='counter'))
+        registry.add(CallbackMetric(
+            'nanny_poll_backoffs_total', 'Times the poll rate of each node was reduced',
+            lambda: [((s.lab,), s.backoffs) for s in list(schedules.values())],
+            ('lab',), kind='counter'))
+        engine = self.condition_engine
+        registry.add(CallbackMetric(
+            'nanny_condition_evaluations_total', 'Values checked against the conditions',
+            lambda: [((), engine.evaluations)], kind='counter'))
+        registry.add(CallbackMetric(
+            'nanny_condition_firings_total', 'Conditions actuated',
+            lambda: [((), engine.firings)], kind='counter'))
+        registry.add(CallbackMetric(
+            'nanny_conditions_active', 'Conditions currently active',
+            lambda: [((), sum(1 for condition in engine.conditions
+                              if condition.active))]))
+        queues = self.client_broadcaster.queues
+        registry.add(CallbackMetric(
+            'nanny_client_frames_total', 'Frames sent to each client',
+            lambda: [((client_label(q.client),), q.sent_frames) for q in queues()],
+            ('client',), kind='counter'))
+        registry.add(CallbackMetric(
+            'nanny_client_bytes_total', 'Bytes sent to each client',
+            lambda: [((client_label(q.client),), q.sent_bytes) for q in queues()],
+            ('client',), kind='counter'))
+        registry.add(CallbackMetric(
+            'nanny_client_dropped_frames_total', 'Frames dropped for each client',
+            lambda: [((client_label(q.client),), q.dropped_frames) for q in queues()],
+            ('client',), kind='counter'))
+        registry.add(CallbackMetric(
+            'nanny_client_write_buffer_bytes', 'Bytes waiting in the websocket of each client',
+            lambda: [((client_label(q.client),), write_buffer_size(q.client)) for q in queues()],
+            ('client',)))
+        nodes = self.comms_handler.nodes
+        registry.add(CallbackMetric(
+            'nanny_node_write_buffer_bytes', 'Bytes waiting in the websocket of each node',
+            lambda: [((getattr(node, 'user', None) or node_id,), write_buffer_size(node))
+                     for node_id, node in list(nodes.items())],
+            ('lab',)))
+        registry.add(CallbackMetric(
+            'nanny_log_records_dropped_total', 'Log records dropped because the log queue was full',
+            lambda: [((), logs.statistics()[0])], kind='counter'))
+        registry.add(CallbackMetric(
+            'nanny_log_records_suppressed_total', 'Repeated log records suppressed by the rate limit',
+            lambda: [((), logs.statistics()[1])], kind='counter'))
+        registry.add(CallbackMetric(
+            'nanny_connected_nodes', 'Connected nodes',
+            lambda: [((), len(nodes))]))
+        registry.add(CallbackMetric(
+            'nanny_connected_clients', 'Connected clients',
+            lambda: [((), len(self.comms_handler.clients))]))
+        return registry
+
+    def observe_duration(self, histogram, overruns, duration, period):
+        """ Records the duration (s) of a periodic callback, and whether it
+        lasted longer than its period (ms)."""
+        histogram.observe(duration)
+        if duration*1000 > period:
+            overruns.inc()
+            self._overruns += 1
+            now = time.time()
+            if now - self._last_overrun_report > OVERRUN_REPORT_INTERVAL:
+                log.warning('%d overrun(s), the last one lasted %.1f ms (period %s ms)',
+                            self._overruns, duration*1000, period)
+                self._overruns = 0
+                self._last_overrun_report = now
+
+    def count_node_message(self, idx, data_dict):
+        """ Function called when a node sends new data (for the metrics)."""
+        self.node_messages.inc(labels=(data_dict.get('user'),))
+
+    def start_shards(self):
+        """ Starts the worker processes of the sharded mode.
+
+        The workers are spawned (started as new interpreters) instead of
+        forked, so they do not inherit the state of the master (e.g. the
+        locks held by its threads).
+        """
+        coordinator_location = 'ws://127.0.0.1:{}{}'.format(self.socketport,
+                                                           SHARD_SOCKETNAME)
+        context = multiprocessing.get_context('spawn')
+        for _ in range(self.num_shards):
+            process = context.Process(target=run_shard_worker,
+                                      args=(coordinator_location,
+                                            self.shard_port,
+                                            self.slave_socketname),
+                                      kwargs={'verbose': self.verbose})
+            process.daemon = True
+            process.start()
+            self.shard_processes.append(process)
+
+    def snapshot_state(self):
+        """ Returns the state saved in the snapshots, as (state, series)
+        (see servers.snapshot.save_snapshot)."""
+        comms = self.comms_handler
+        state = {'last_data': dict(comms.last_data),
+                 'registry': comms.registry(),
+                 'conditions': self.condition_engine.get_state()}
+        series = {key: buffer.last()
+                  for key, buffer in list(self.history.buffers.items())}
+        return state, series
+
+    def write_snapshot(self):
+        """ Function called periodically to save a snapshot of the state of
+        the server (see servers.snapshot).
+
+        The state is copied in the IOLoop, and written to disk by a thread,
+        so a slow disk does not delay the polling. A snapshot is skipped if
+        the previous one is still being written.
+        """
+        if self._snapshot_future is not None and not self._snapshot_future.done():
+            return
+        state, series = self.snapshot_state()
+        self._snapshot_future = ioloop.IOLoop.current().run_in_executor(
+            None, save_snapshot, self.snapshot_file, state, series)
+        ioloop.IOLoop.current().add_future(self._snapshot_future,
+                                           self._snapshot_written)
+
+    def _snapshot_written(self, future):
+        try:
+            future.result()
+        except OSError as err:
+            log.warning('Could not write the snapshot: %s', err,
+                        extra={'sample': True})
+
+    def restore_snapshot(self):
+        """ Restores the state saved in the snapshot, if there is a recent
+        one.
+
+        The data of the nodes is restored under their previous ids, and
+        replaced as soon as each lab reconnects; the labs that do not
+        reconnect within RESTORE_TIMEOUT are dropped (the timeout is
+        scheduled in MasterServer.run).
+        """
+        if not self.snapshot_file:
+            return
+        start = time.perf_counter()
+        try:
+            snapshot = load_snapshot(self.snapshot_file)
+        except ValueError as err:
+            log.warning('%s', err)
+            return
+        if snapshot is None:
+            return
+        state, series, age = snapshot
+        self.comms_handler.restore(state.get('last_data', {}),
+                                   state.get('registry', {}))
+        self.condition_engine.set_state(state.get('conditions', {}))
+        for (lab, channel), (times, values) in series.items():
+            self.history.restore(lab, channel, times, values)
+        log.info('Restored snapshot from %.0f s ago (%d nodes, %d series) in %.1f ms',
+                 age, len(self.comms_handler.restored), len(series),
+                 (time.perf_counter() - start)*1000)
 
     def on_close(self):
-        self.db_handler.close()
-
-    def check_conditions(self):
-        for condition in self._conditions:
-            # if obs_lab/obs_ch outside obs_range:
-            # send target_lab/target_ch the target_val
-            lab            = condition['obs_lab']
-            observ_channel = condition['obs_ch']
-            range_boundary = condition['obs_range']
-            target_lab     = condition['target_lab']
-            target_channel = condition['target_ch']
-            target_value   = condition['target_val']
-            node_id = self.comms_handler.get_nodeID_by_user(lab)
-            if len(node_id)>0:
-                current_observed_val = self.comms_handler.last_data[node_id[0]][observ_channel]
-                if not range_boundary[0]<= current_observed_val <= range_boundary[1]:
-                    # Add here entry to database when condition is not met
-                    target_id = self.comms_handler.get_nodeID_by_user(target_lab)
-                    msg = target_lab+','+str(target_channel)+','+str(target_value)
-                    broadcast(self.comms_handler.nodes,msg)
-                    print(condition['message'])
-                    print('{} <= {} <= {}'.format(range_boundary[0],current_observed_val,range_boundary[1]))
+        for process in self.shard_processes:
+            process.terminate()
+        if self.snapshot_file:
+            try:
+                save_snapshot(self.snapshot_file, *self.snapshot_state())
+            except OSError as err:
+                log.warning('Could not write the snapshot: %s', err)
+        if self.sample_store is not None:
+            self.sample_store.close()
+        self.history_query.close()
+        self.db_writer.close()
+        logs.stop_logging()
+
+    def check_conditions(self, idx, data_dict):
+        """ Function called when a node sends new data.
+
+        The servers.conditions.ConditionEngine only evaluates the conditions
+        observing the channels of that node whose values changed. When a
+        condition becomes active (obs_lab/obs_ch outside obs_range for longer
+        than its hold time), the target node receives the target_val in its
+        target_ch. Nothing is sent while the condition stays active.
+
+        :param idx: id of the node that sent the data
+        :param data_dict: dictionary sent by the node
+        """
+        for condition, value, active in self.condition_engine.update(data_dict):
+            if active:
+                self.comms_handler.send_command(condition.command)
+                log.warning('%s: %s <= %s <= %s', condition.message,
+                            condition.low, value, condition.high)
             else:
-                pass
+                log.info('%s: cleared (%s)', condition.name, value)
 
 
 
@@ -323,20 +832,21 @@ class NodeHandler(tornado.websocket.WebSocketHandler):
 
     node_dict = {}
 
-    def initialize(self, comms_handler,verbose=True):
+    def initialize(self, comms_handler):
         """Initialisation of an object of the NodeHandler class.
 
         We provide a communications handler object which keeps a list of the nodes
         and clients, and a list of the last messages from the nodes.
 
+        The data received is logged (at DEBUG level) by the 'nodes' logger
+        (see servers.logs).
+
         :param comms_handler:
         :type comms_handler: CommsHandler
-        :param verbose: True for verbose output
         :return:
         """
 
         self.__comms_handler = comms_handler
-        self.verbose = verbose
 
 
 
@@ -353,41 +863,42 @@ class NodeHandler(tornado.websocket.WebSocketHandler):
 
         #self.write_message('Init')
         self.id = uuid.uuid4().hex
+        # Keeps the user name and the layout of the binary frames (if the
+        # node announces one)
+        self.decoder = MessageDecoder()
         NodeHandler.node_dict[self.id] = self
         ip = self.request.remote_ip
-        print('(NDH  {}) New NODE {} ({}). (out of {}) ' \
-              .format(time.strftime(TFORMAT),
-                      socket.getfqdn(ip),
-                      ip,
-                      len(NodeHandler.node_dict)))
-        print('(NDH) UUID: {}'.format(self.id))
+        # The name of the host is resolved in the background (unless cached)
+        self.__comms_handler.hostnames.lookup(ip)
+        log_nodes.info('New NODE %s. (out of %d) ', ip, len(NodeHandler.node_dict))
+        log_nodes.info('UUID: %s', self.id)
 
     def on_message(self, message):
         """ Callback executed upon message reception from the master server.
 
-        The message is a JSON string, which is converted to a dictionary.
+        The message is either a JSON string or, if the node announced a
+        schema in its metadata, a binary frame (see servers.protocol). Both
+        are converted to the same dictionary.
 
         :param message:
         :return:
         """
         ## TODO: maybe we can code here a case in which we configure
         ## For example, we can write a "configure" key in the dictionary
-        message_dict = json.loads(message)
+        try:
+            message_dict = self.decoder.decode(message)
+        except SchemaError as err:
+            log_nodes.warning('%s', err, extra={'sample': True})
+            return
 
         if METAKEYWORD not in message_dict:
 
-            if self.verbose:
-                if not message_dict['error']:
-                    print('(NDH) time: {0:.3f}, user: {1}, error: {2}, ch0: {3}'\
-                          .format(message_dict["x"],
-                                  message_dict["user"],
-                                  message_dict["error"],
-                                  message_dict["ch0"]))
-                else:
-                    print('(NDH) time: {0:.3f}, user: {1}, error: {2}'\
-                          .format(message_dict["x"],
-                                  message_dict["user"],
-                                  message_dict["error"]))
+            if log_nodes.isEnabledFor(logging.DEBUG):
+                log_nodes.debug('time: %.3f, user: %s, error: %s, ch0: %s',
+                                message_dict['x'],
+                                message_dict['user'],
+                                message_dict['error'],
+                                message_dict.get('ch0'))
 
             #There are two ways in which we can pass the data to the clients:
             # - Store the data in the self.__comms_handler.last_data dictionary
@@ -398,10 +909,10 @@ class NodeHandler(tornado.websocket.WebSocketHandler):
 
             # To use the first method, uncomment this line, and make sure that the "tick()" function
             # in the master server uses :
-            self.__comms_handler.last_data[self.id] = message_dict
+            self.__comms_handler.receive_data(self, message_dict,
+                                              self.decoder.last_request)
         else:
-            self.user = message_dict['user']
-            self.__comms_handler.add_metadata(self.id,message_dict)
+            self.__comms_handler.receive_metadata(self, message_dict)
 
 
 
@@ -411,18 +922,18 @@ class NodeHandler(tornado.websocket.WebSocketHandler):
         #    client.write_message(message)
 
 
+    @property
+    def user(self):
+        """ User name of the node (None until it sends some message)"""
+        return self.decoder.user
+
     def on_close(self):
-        # Add log to metadata table in database
-        self.__comms_handler.add_metadata(self.id,CONNCLOSEDSTR)
-        # Remove nodehandler from the comms_handler instance and the class'
-        # node_list.
-        self.__comms_handler.remove_key(self.id)
-        NodeHandler.node_dict.pop(self.id, None)
+        # Add log to metadata table in database, and remove nodehandler from
+        # the comms_handler instance and the class' node_list.
+        self.__comms_handler.close_node(self)
         ip = self.request.remote_ip
         user = self.user
-        print('(NDH  {}) Connection with {} ({}) closed '\
-              .format(time.strftime(TFORMAT),
-                      ip, user))
+        log_nodes.info('Connection with %s (%s) closed ', ip, user)
 
     def check_origin(self, origin):
         #TODO: change this to actually check the origin
@@ -442,13 +953,100 @@ class NodeHandler(tornado.websocket.WebSocketHandler):
             raise
 
 
+class RemoteNode(object):
+    """ Stand-in for the NodeHandler of a node connected to a shard worker.
+
+    It has the attributes of a NodeHandler used by the rest of the master
+    server (id, user, request.remote_ip and write_message), so the remote
+    nodes are kept in NodeHandler.node_dict like any other node. The
+    messages written to it are sent to the shard in batches.
+    """
+    def __init__(self, node_id, remote_ip, shard):
+        self.id = node_id
+        self.user = None
+        self.request = RemoteRequest(remote_ip)
+        self.shard = shard
+
+    def write_message(self, message, binary=False):
+        self.shard.queue_command(self.id, message)
+
+
+class RemoteRequest(object):
+    def __init__(self, remote_ip):
+        self.remote_ip = remote_ip
+
+
+class ShardHandler(tornado.websocket.WebSocketHandler):
+    """ Class that handles the communication with the shard workers (see
+    servers.shards) in the sharded mode.
+    """
+    def initialize(self, comms_handler):
+        self.__comms_handler = comms_handler
+
+    def open(self):
+        self.remote_nodes = {}   # node id -> RemoteNode
+        self.commands = []
+        log_shards.info('New shard connected')
+
+    def on_message(self, message):
+        contents = json.loads(message)
+        kind = contents['type']
+        if kind == 'data':
+            for node_id, samples in contents['samples'].items():
+                node = self.remote_nodes.get(node_id)
+                if node is None:
+                    continue
+                for request, data_dict in samples:
+                    if node.user is None:
+                        node.user = data_dict['user']
+                    self.__comms_handler.receive_data(node, data_dict, request)
+        elif kind == 'open':
+            if contents['id'] not in self.remote_nodes:
+                self.__comms_handler.hostnames.lookup(contents['ip'])
+                node = RemoteNode(contents['id'], contents['ip'], self)
+                self.remote_nodes[node.id] = node
+                NodeHandler.node_dict[node.id] = node
+        elif kind == 'meta':
+            node = self.remote_nodes.get(contents['id'])
+            if node is not None:
+                node.user = contents['meta']['user']
+                self.__comms_handler.receive_metadata(node, contents['meta'])
+        elif kind == 'close':
+            node = self.remote_nodes.pop(contents['id'], None)
+            if node is not None:
+                self.__comms_handler.close_node(node)
+
+    def queue_command(self, node_id, message):
+        """ Queues a message for a node of this shard. The queued
+        messages are sent together, once the current callback finishes."""
+        if not self.commands:
+            ioloop.IOLoop.current().add_callback(self.send_commands)
+        self.commands.append((node_id, message))
+
+    def send_commands(self):
+        commands, self.commands = self.commands, []
+        try:
+            self.write_message(json.dumps({'commands': commands}))
+        except WebSocketClosedError:
+            pass
+
+    def on_close(self):
+        log_shards.info('Shard disconnected')
+        for node in list(self.remote_nodes.values()):
+            self.__comms_handler.close_node(node)
+        self.remote_nodes = {}
+
+    def check_origin(self, origin):
+        return True
+
+
 class ClientHandler(tornado.websocket.WebSocketHandler):
     """ Class that handles the communication via websockets with the
     slave nodes.
     """
     client_list = []
 
-    def initialize(self, comms_handler,verbose=False):
+    def initialize(self, comms_handler, client_broadcaster, history=None):
         """ Initialisation of an object of the ClientHandler class.
 
         We provide a communications handler object which keeps a list of the
@@ -456,105 +1054,242 @@ class ClientHandler(tornado.websocket.WebSocketHandler):
 
         :param comms_handler:
         :type comms_handler: CommsHandler
-        :param verbose: True for verbose output
+        :param client_broadcaster: keeps the subscriptions of the clients
+        :type client_broadcaster: servers.broadcaster.ClientBroadcaster
+        :param history: recent data, sent to the clients when they subscribe
+        :type history: servers.history.HistoryStore
         :return:
         """
         self.__comms_handler = comms_handler
-        self.verbose = verbose
+        self.client_broadcaster = client_broadcaster
+        self.history = history
 
     def open(self):
         """ Callback executed upon opening a new client connection.
 
-        This function adds the new connection to the class "client" list.
+        This function adds the new connection to the class "client" list,
+        and subscribes the client to all the data at full rate until it
+        sends its own subscription. The client receives the recent history
+        right away (and again whenever it subscribes).
 
         :return:
         """
         # We could do here the configuration of the node, like a dictionary with the channels exposed
+        self.id = uuid.uuid4().hex[:8]
         ClientHandler.client_list.append(self)
-        print('(CLH  {}) New connection from {}. Total of clients: {}'\
-              .format(time.strftime(TFORMAT),
-                      self.request.remote_ip,
-                      len(ClientHandler.client_list)))
+        self.__comms_handler.hostnames.lookup(self.request.remote_ip)
+        group = self.client_broadcaster.subscribe(self)
+        log_clients.info('New connection from %s. Total of clients: %d',
+                         self.request.remote_ip, len(ClientHandler.client_list))
+        self.send_keyframe(group)
+        self.send_backfill(group.subscription)
+
+    def send_keyframe(self, group):
+        """ When sending deltas, a new (or re-subscribed) client needs the
+        full state first.
+        """
+        if self.client_broadcaster.delta:
+            self.client_broadcaster.send(self,
+                                         group.keyframe(self.__comms_handler.last_data))
+
+    def send_backfill(self, subscription):
+        """ Sends the recent history of the subscribed labs and channels
+        in a single frame (see servers.history)."""
+        if self.history is None or subscription.backfill == 0:
+            return
+        frame = self.history.backfill(labs=subscription.labs,
+                                      channels=subscription.channels,
+                                      n=subscription.backfill)
+        self.client_broadcaster.send(self, frame, replace=False)
 
     def on_message(self, message):
         """ Callback executed upon message reception from the client.
 
-        The message is a JSON string, which is then broadcasted to all the
-        nodes sequentially.
+        If the message is a subscription (see servers.broadcaster), the
+        client is moved to the corresponding subscription group. Otherwise,
+        the message is a command ('user,pin_number,pin_value'), which is
+        sent to the node of that user only (or to all the nodes if
+        user='X').
 
         :param message:
         :return:
         """
-        if self.verbose:
-            print('(CLH  {}) Message received from client: {}'\
-                  .format(time.strftime(TFORMAT),
-                          message))
-        for node in self.__comms_handler.nodes:
-            self.__comms_handler.nodes[node].write_message(message)
+        log_clients.debug('Message received from client: %s', message)
+        try:
+            subscription = Subscription.from_message(message)
+        except (ValueError, TypeError) as err:
+            log_clients.warning('Invalid subscription: %s', err)
+            return
+        if subscription is not None:
+            group = self.client_broadcaster.subscribe(self, subscription)
+            self.send_keyframe(group)
+            self.send_backfill(subscription)
+            return
+        if not self.__comms_handler.send_command(message):
+            log_clients.warning('No node found for message: %s', message)
 
 
     def on_close(self):
-        print('(CLH  {}) Connection closed'\
-              .format(time.strftime(TFORMAT)))
+        log_clients.info('Connection closed')
         ClientHandler.client_list.remove(self)
-        print(ClientHandler.client_list)
+        self.client_broadcaster.remove(self)
 
     def check_origin(self, origin):
         #TODO: should actually check the origin
         return True
 
-    @classmethod
-    def broadcast(cls, msg):
-        for client in cls.client_list:
-            client.write_message(msg)
-
 
 class StatusHandler(tornado.web.RequestHandler):
-    def initialize(self, comms_handler):
-        """Initialisation of an object of the NodeHandler class.
+    def initialize(self, status_snapshot):
+        """Initialisation of an object of the StatusHandler class.
 
-        We provide a communications handler object which keeps a list of the nodes
-        and clients, and a list of the last messages from the nodes.
+        We provide a StatusSnapshot object, which keeps the last rendered
+        version of the status page.
 
-        :param comms_handler:
-        :type comms_handler: CommsHandler
-        :param verbose: True for verbose output
+        :param status_snapshot:
+        :type status_snapshot: StatusSnapshot
         :return:
         """
 
-        self.__comms_handler = comms_handler
+        self.__status_snapshot = status_snapshot
+
+    def get(self):
+        self.write(self.__status_snapshot.render())
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """ Serves the metrics of the master server (see servers.metrics) in the
+    Prometheus text format."""
+    def initialize(self, registry):
+        self.__registry = registry
+
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write(self.__registry.render())
+
+
+class LoggingHandler(tornado.web.RequestHandler):
+    """ Shows (GET) and changes (POST) the log level of each subsystem of
+    the master server (see servers.logs), without restarting it, e.g.
+        curl -d subsystem=nodes -d level=DEBUG http://master:8001/logging
+    (without a subsystem, the level of all of them is changed).
+    """
+    def get(self):
+        self.write(logs.levels())
+
+    def post(self):
+        subsystem = self.get_argument('subsystem', None)
+        try:
+            logs.set_level(subsystem, self.get_argument('level'))
+        except ValueError as err:
+            raise tornado.web.HTTPError(400, reason=str(err))
+        log.info('Log level of %s set to %s', subsystem or 'all the subsystems',
+                 self.get_argument('level'))
+        self.write(logs.levels())
+
+
+class HistoryHandler(tornado.web.RequestHandler):
+    """ Serves the history of some channels of a lab (see servers.queries),
+    e.g.
+        curl 'http://master:8001/history?lab=lab7&channels=ch2&points=500'
+    Arguments: lab, channels (comma separated), start and end (s, the last
+    day by default), points and method ('lttb' or 'minmax').
+    """
+    def initialize(self, history_query):
+        self.__history_query = history_query
 
+    @gen.coroutine
     def get(self):
+        query = self.__history_query
+        now = time.time()
+        try:
+            arguments = parse_query(self.get_argument, now)
+        except ValueError as err:
+            raise tornado.web.HTTPError(400, reason=str(err))
+        # The requests without an end share their response while it is cached
+        key = tuple(self.get_argument(name, None) for name in
+                    ('lab', 'channels', 'start', 'end', 'points', 'method'))
+        chunks = query.cached(key, now)
+        if chunks is None:
+            # The channels are computed in parallel by the workers; nothing is
+            # written until all of them are ready, so an error (e.g. reading
+            # the database) still gets an error status instead of a
+            # truncated response
+            lab, channels, start, end, points, method = arguments
+            loop = ioloop.IOLoop.current()
+            resolution, header = yield loop.run_in_executor(
+                query.executor, query.header, lab, start, end, points, method)
+            chunks = yield [loop.run_in_executor(
+                query.executor, query.channel, lab, channel, i == 0,
+                start, end, points, method, resolution)
+                for i, channel in enumerate(channels)]
+            chunks = [header] + chunks + [FOOTER]
+            if sum(len(chunk) for chunk in chunks) <= query.cache_bytes:
+                query.store(key, chunks, time.time())
+        self.set_header('Content-Type', 'application/json')
+        try:
+            for chunk in chunks:
+                yield self._send(chunk)
+        except StreamClosedError:
+            # The client went away
+            return
+        self.finish()
+
+    def _send(self, chunk):
+        self.write(chunk)
+        return self.flush()
+
+
+class StatusSnapshot(object):
+    """ Cached rendering of the status page.
+
+    The page is rebuilt at most once every "interval" seconds, no matter how
+    many requests arrive. The host names are taken from the (non-blocking)
+    CommsHandler.hostnames cache, so rendering the page never waits for the
+    DNS server.
+    """
+    def __init__(self, comms_handler, interval=STATUS_INTERVAL):
+        self.__comms_handler = comms_handler
+        self.interval = interval
+        self._page = None
+        self._expiry = 0
+
+    def render(self):
+        now = time.time()
+        if self._page is None or now >= self._expiry:
+            self._page = self.build()
+            self._expiry = now + self.interval
+        return self._page
+
+    def build(self):
+        hostnames = self.__comms_handler.hostnames
+        page = []
         # Time
         fetch_time = time.strftime(TFORMAT)
-        self.write('<meta http-equiv="refresh" content="10">')
-        self.write(' <style> .wrapper {display:flex}</style>')
-        self.write('<p> TIME: {}</p>'.format(fetch_time))
+        page.append('<meta http-equiv="refresh" content="10">')
+        page.append(' <style> .wrapper {display:flex}</style>')
+        page.append('<p> TIME: {}</p>'.format(fetch_time))
         # Nodes
         num_nodes = len(self.__comms_handler.nodes)
-        self.write("<h3>Number of connected nodes: {}</h3><ul>".format(num_nodes))
+        page.append("<h3>Number of connected nodes: {}</h3><ul>".format(num_nodes))
         for node_key in self.__comms_handler.nodes:
             node = self.__comms_handler.nodes[node_key]
-            if 'user' in node.__dict__:
-                user = node.user
-            else:
-                user ='no ID'
-            self.write('<li>{} ({})</li>'.format(socket.getfqdn(node.request.remote_ip),
-                                                 user))
+            user = getattr(node, 'user', None) or 'no ID'
+            page.append('<li>{} ({})</li>'.format(hostnames.lookup(node.request.remote_ip),
+                                                  user))
         # Clients
         num_clients = len(self.__comms_handler.clients)
-        self.write("</ul><h3>Number of connected clients: {}</h3><ul style>".format(num_clients))
+        page.append("</ul><h3>Number of connected clients: {}</h3><ul style>".format(num_clients))
         for client in self.__comms_handler.clients:
-            self.write('<li>{}</li>'.format(socket.getfqdn(client.request.remote_ip)))
-        self.write("</ul><h3>Last data: </h3>")
-        self.write("<div class=wrapper>")
+            page.append('<li>{}</li>'.format(hostnames.lookup(client.request.remote_ip)))
+        page.append("</ul><h3>Last data: </h3>")
+        page.append("<div class=wrapper>")
         for node_id in self.__comms_handler.last_data:
             last_data = self.__comms_handler.last_data[node_id]
-            self.write('<p>{} {}</p>'.format(last_data['user'],
-                                            json2html.convert(json=last_data)))
-        self.write("</div>")
-
-
+            page.append('<p>{} {}</p>'.format(last_data['user'],
+                                              json2html.convert(json=last_data)))
+        page.append("</div>")
+        return ''.join(page)
 
 
 class CommsHandler(object):
@@ -567,6 +1302,12 @@ class CommsHandler(object):
     (that is, the "contents" of each channel in the self.last_data
     dictionaries).
 
+    The NodeHandler instances are also registered by their user name
+    (self.node_by_user), so that commands can be sent only to the node they
+    are addressed to. Every request sent to a node is numbered, and the
+    replies are matched to them by self.requests (see
+    servers.scheduler.RequestTracker).
+
     Whenever the connection between the master and the node is (re)
     established, the metadata corresponding to that id needs to be
     recorded by an external class. To do this, we use an observer
@@ -578,12 +1319,24 @@ class CommsHandler(object):
     def __init__(self):
         self.nodes = NodeHandler.node_dict       #list
         self.clients = ClientHandler.client_list #list
+        # user name (e.g. 'lab7') -> NodeHandler
+        self.node_by_user = {}
+        # Names of the hosts connected to the server, resolved in the background
+        self.hostnames = HostnameCache()
+        # Requests in flight to each node
+        self.requests = RequestTracker()
+        # Nodes restored from a snapshot which have not reconnected yet:
+        # user name -> id of the node before the restart
+        self.restored = {}
         #Data dictionary
         self.last_data = {}                #dictionary
+        # Counter increased every time last_data changes
+        self.data_version = 0
         #Metadata dictionary
         self.metadata = {}                 #dictionary
         self._last_metadata_id = []
         self._metadata_observers= []
+        self._data_observers = []
 
     def get_last_metadata_id(self):
         return self._last_metadata_id
@@ -607,11 +1360,34 @@ class CommsHandler(object):
         '''
         self._metadata_observers.append(callback)
 
+    def bind_to_data_change(self, callback):
+        ''' Binds callbacks to the reception of new data from the nodes
+
+        The callbacks are called with the id of the node and the data
+        dictionary, e.g. to evaluate the conditions as soon as the data
+        arrives.
+
+        :param callback:
+        :return:
+        '''
+        self._data_observers.append(callback)
+
     def add_metadata(self, id, contents):
-        print(contents)
+        log_nodes.debug('Metadata of %s: %s', id, contents)
         self.metadata[id] = contents
         self.last_metadata_id = id # This triggers the callback
 
+    def update_data(self, id, data_dict):
+        """ Stores the last data dictionary received from a node.
+
+        :param id: the UUID given by the MasterServer to the node
+        :param data_dict: dictionary sent by the node
+        """
+        self.last_data[id] = data_dict
+        self.data_version += 1
+        for callback in self._data_observers:
+            callback(id, data_dict)
+
     def remove_key(self,id):
         """
         Removes the node with a given id from the comms_handler.
@@ -625,19 +1401,141 @@ class CommsHandler(object):
         """
         self.last_data.pop(id,None)
         self.metadata.pop(id,None)
+        self.data_version += 1
+
+    def register_user(self, user, node):
+        """ Associates a user name with a NodeHandler.
+
+        The user is known once the node sends its metadata (or its first
+        data). If another connection with the same user exists, the newest
+        connection replaces it.
+
+        :param user: The laboratory name
+        :param node: NodeHandler instance
+        """
+        self.node_by_user[user] = node
+        if user in self.restored:
+            self.remove_key(self.restored.pop(user))
+
+    def unregister_user(self, user, node):
+        """ Removes a user name from the registry, if it belongs to the
+        given NodeHandler.
+        """
+        if self.node_by_user.get(user) is node:
+            del self.node_by_user[user]
+
+    def registry(self):
+        """ Returns the registry of the nodes, {user: {'id', 'ip'}},
+        including those restored which have not reconnected yet."""
+        registry = {user: {'id': node_id, 'ip': None}
+                    for user, node_id in self.restored.items()}
+        for user, node in self.node_by_user.items():
+            registry[user] = {'id': node.id, 'ip': node.request.remote_ip}
+        return registry
+
+    def restore(self, last_data, registry):
+        """ Restores the data of the nodes saved in a snapshot.
+
+        The data is kept under the ids that the nodes had before the
+        restart, until they reconnect (see register_user).
+
+        :param last_data: dictionary {node id: data dictionary}
+        :param registry: dictionary {user: {'id': node id, ...}}
+        """
+        for user, info in registry.items():
+            node_id = info['id']
+            if user in self.node_by_user or node_id not in last_data:
+                continue
+            self.restored[user] = node_id
+            self.last_data[node_id] = last_data[node_id]
+        self.data_version += 1
+
+    def drop_restored(self):
+        """ Forgets the restored nodes which did not reconnect."""
+        for node_id in self.restored.values():
+            self.remove_key(node_id)
+        self.restored = {}
+
+    def receive_data(self, node, data_dict, request=None):
+        """ Handles the data dictionary sent by a node.
+
+        Replies older than the last one accepted from the node are
+        discarded, so that a late reply never overwrites newer data.
+
+        :param node: NodeHandler (or any object with 'id' and 'user'
+                     attributes and a 'write_message' method)
+        :param data_dict: dictionary sent by the node
+        :param request: sequence number of the request answered by the node
+                        (None if the node did not give one)
+        """
+        if not self.requests.reply(node.id, request, time.time()):
+            return
+        if self.node_by_user.get(node.user) is not node:
+            self.register_user(node.user, node)
+        self.update_data(node.id, data_dict)
+
+    def receive_metadata(self, node, metadata_dict):
+        """ Handles the metadata dictionary sent by a node."""
+        self.register_user(node.user, node)
+        self.add_metadata(node.id, metadata_dict)
+
+    def close_node(self, node):
+        """ Forgets a node whose connection closed, and records the
+        closure in its metadata."""
+        self.add_metadata(node.id, CONNCLOSEDSTR)
+        self.remove_key(node.id)
+        self.unregister_user(node.user, node)
+        self.requests.forget(node.id)
+        self.nodes.pop(node.id, None)
+
+    def get_node_by_user(self, user):
+        """ Returns the NodeHandler of a given user, or None."""
+        return self.node_by_user.get(user)
 
     def get_nodeID_by_user(self,user):
         """ Returns the node.id of the node with a given user name
 
-        Since the user is first obtained after getting data, we infer
-        it from the information in the self.last_data dictionary.
-
         :param user: The laboratory name
         :type user: str
-        :return: Returns the UUID given by the master server to the node
-        with a given username
+        :return: Returns a list with the UUID given by the master server to
+        the node with a given username (or an empty list)
+        """
+        node = self.node_by_user.get(user)
+        if node is None:
+            return []
+        return [node.id]
+
+    def send_command(self, msg):
+        """ Sends a command to the node it is addressed to.
+
+        :param msg: command with the syntax 'user,pin_number,pin_value'.
+                    If user='X', the command is broadcast to all the nodes.
+        :type msg: str
+        :return: True if the command was written to some node
+        """
+        # The sequence number is added by send_request
+        msg = ','.join(msg.split(',')[:3])
+        user = msg.split(',', 1)[0]
+        if user == 'X':
+            sent = [self.send_request(node, msg) for node in list(self.nodes.values())]
+            return any(sent)
+        node = self.node_by_user.get(user)
+        if node is None:
+            return False
+        return self.send_request(node, msg)
+
+    def send_request(self, node, msg):
+        """ Sends a request to a node, numbered so that its reply can be
+        matched ('user,pin_number,pin_value,seq').
+
+        :return: True if the request was written to the node
         """
-        return [key for key in self.last_data if self.last_data[key]['user'] == user]
+        seq = self.requests.issue(node.id, time.time())
+        try:
+            node.write_message('{},{}'.format(msg, seq))
+        except WebSocketClosedError:
+            return False
+        return True
 
 ########################################
 
@@ -650,12 +1548,50 @@ def broadcast(dictionary_of_endpoints, msg):
     :return:
     """
     for endpoint in dictionary_of_endpoints:
-        dictionary_of_endpoints[endpoint].write_message(msg)
+        # A closed endpoint must not prevent the others from receiving the
+        # message (its on_close callback will remove it from the dictionary)
+        try:
+            dictionary_of_endpoints[endpoint].write_message(msg)
+        except WebSocketClosedError:
+            pass
+
+
+
+def client_label(client):
+    """ Label used to identify a client in the metrics."""
+    return '{}/{}'.format(client.request.remote_ip, getattr(client, 'id', ''))
 
 
+def write_buffer_size(handler):
+    """ Returns the number of bytes waiting to be written in the websocket
+    of a handler (0 if unknown, e.g. for the nodes of a shard)."""
+    stream = getattr(getattr(handler, 'ws_connection', None), 'stream', None)
+    if stream is None:
+        return 0
+    return getattr(stream, '_total_write_index', 0) - \
+           getattr(stream, '_total_write_done_index', 0)
 
-def main1(periodicity=100, verbose=0):
+
+def main1(periodicity=100, verbose=0, delta_frames=False,
+          publish_mode=PUBLISH_TICK, publish_deadline=PUBLISH_DEADLINE,
+          shards=0, shard_port=SHARD_PORT, poll_rates=None,
+          snapshot_file=SNAPSHOT_FILE, full_rate=False,
+          samples_dir=SAMPLES_DIR,
+          retention_days=RETENTION[RAW_RESOLUTION]/86400.0,
+          partition_period=None, partition_dir=PARTITION_DIR):
     my_master_server = MasterServer(periodicity=periodicity,
+                                    poll_rates=poll_rates,
+                                    snapshot_file=snapshot_file,
+                                    full_rate=full_rate,
+                                    samples_dir=samples_dir,
+                                    retention_days=retention_days,
+                                    partition_period=partition_period,
+                                    partition_dir=partition_dir,
+                                    shards=shards,
+                                    shard_port=shard_port,
+                                    delta_frames=delta_frames,
+                                    publish_mode=publish_mode,
+                                    publish_deadline=publish_deadline,
                                     verbose=verbose)
     return my_master_server
 
@@ -670,13 +1606,62 @@ if __name__ == "__main__":
     parser.add_argument("-pr","--periodicity",
                         help="periodicity to poll nodes",
                         type=int,default=PERIODICITY)
+    parser.add_argument("-rt","--poll_rates",
+                        help="poll rates (Hz) of some labs, e.g. 'lab6=1,lab7=20'",
+                        default='')
     parser.add_argument("-dbpr","--database_periodicity",
                         help="periodicity of saving data to database",
                         type=int,default=DB_PERIODICITY)
+    parser.add_argument("-df","--delta_frames",
+                        help="send only the changes to the clients, with periodic keyframes",
+                        type=int,default=0)
+    parser.add_argument("-pm","--publish_mode",
+                        help="'tick': publish the data of the previous poll on each tick; "
+                             "'event': publish as soon as the nodes reply",
+                        choices=(PUBLISH_TICK,PUBLISH_EVENT),default=PUBLISH_TICK)
+    parser.add_argument("-pd","--publish_deadline",
+                        help="(event mode) maximum time (ms) to wait for the nodes' replies",
+                        type=int,default=PUBLISH_DEADLINE)
+    parser.add_argument("-sh","--shards",
+                        help="number of worker processes accepting node connections (0: no sharding)",
+                        type=int,default=0)
+    parser.add_argument("-sp","--shard_port",
+                        help="port where the shards accept the node connections",
+                        type=int,default=SHARD_PORT)
+    parser.add_argument("-ss","--snapshot",
+                        help="file where the state is saved, to be restored on restart ('' to disable)",
+                        default=SNAPSHOT_FILE)
+    parser.add_argument("-fr","--full_rate",
+                        help="record every sample of the nodes (see database/SampleStore.py)",
+                        type=int,default=0)
+    parser.add_argument("-sd","--samples_dir",
+                        help="directory of the samples recorded in the full-rate mode",
+                        default=SAMPLES_DIR)
+    parser.add_argument("-rd","--retention_days",
+                        help="days of raw data kept in the database (0: keep everything)",
+                        type=float,default=RETENTION[RAW_RESOLUTION]/86400.0)
+    parser.add_argument("-pt","--partition",
+                        help="store the database in one file per lab and day or week ('': single file)",
+                        choices=('',)+tuple(sorted(PERIODS)),default='')
+    parser.add_argument("-ptd","--partition_dir",
+                        help="directory of the partitioned database",
+                        default=PARTITION_DIR)
     parser.add_argument("-v","--verbose",help="Activate verbose",
                         type=int,default=0)
     args = parser.parse_args()
 
     signal.signal(signal.SIGINT,signal_handler)
     main1(periodicity=args.periodicity,
-          verbose=args.verbose)
+          verbose=args.verbose,
+          delta_frames=bool(args.delta_frames),
+          publish_mode=args.publish_mode,
+          publish_deadline=args.publish_deadline,
+          shards=args.shards,
+          shard_port=args.shard_port,
+          poll_rates=parse_rates(args.poll_rates),
+          snapshot_file=args.snapshot,
+          full_rate=bool(args.full_rate),
+          samples_dir=args.samples_dir,
+          retention_days=args.retention_days,
+          partition_period=args.partition or None,
+          partition_dir=args.partition_dir)
@@ -17,7 +17,11 @@ using the Slavenode.message_bridging_arduino method, which converts
 -- messages sent from the master server to an arduino command using the
    convert_message_to_command function.
 -- a list of channels to a JSON dictionary, using the SlaveNode.convert_data
-   method) which is written into the master server's websocket
+   method) which is written into the master server's websocket. With the
+   --binary option, the node announces its channels in the metadata and
+   sends compact binary frames instead (see servers.protocol).
+Every reply echoes the sequence number of the request it answers, so that
+the master can match them (see servers.scheduler.RequestTracker).
 
 To deploy:
 -- Change the DICT_CONTENTS variable to state the actual contents of the
@@ -39,8 +43,10 @@ from serial.serialutil import SerialException
 from communications import SerialCommManager as SCM
 from communications.SerialCommManager import ArduinoConnectionError,\
                                             handshake_func
-from servers.server_master import METAKEYWORD
 from servers.header import NODE_HEADER
+from servers import logs
+from servers.protocol import FrameSchema, METAKEYWORD, SCHEMA_KEYWORD, \
+                             REQUEST_KEYWORD, NO_REQUEST
 
 import json
 import time
@@ -64,8 +70,7 @@ MASTER_LOCATION = "ws://127.0.0.1:8001/nodes_ws" #"ws://localhost:8001/nodes_ws"
 ## e.g. pin 0 LOW corresponds to 64 and pin 1 HIGH corresponds to 66
 MESSAGE_PINVALUE_0 = 65
 
-# Time format
-TFORMAT = '%y/%m/%d %H:%M:%S'
+log = logs.get_logger('node')
 
 # Should contain the keys 'user' and 'error', and probably 'x'
 # (see the SlaveNode.convert_data, as the keys in the dictionary should be identical,
@@ -89,7 +94,10 @@ class SlaveNode(object):
                  verbose=True,
                  masterWSlocation=MASTER_LOCATION,
                  reference=USER_REFERENCE,
-                 arduino_port = []):
+                 arduino_port = [],
+                 binary=False):
+        # The messages are written by a background thread (see servers.logs)
+        logs.setup_logging(verbose=verbose)
         self.emulate = emulate
         self.location = masterWSlocation
         self.reference = reference
@@ -99,14 +107,20 @@ class SlaveNode(object):
 
         #Register node in master (metadata)
         self.metadata_registered = False  # If the metadata has been sent to the master server
-        self.metadata_dict = DICT_CONTENTS
+        self.metadata_dict = dict(DICT_CONTENTS)
         self.metadata_dict['user']=self.reference
-
-
-        print("Initiating Slave Node {}".format(self.reference))
-        if self.verbose:
-            print("Verbose mode")
-        print("Emulation = {}".format(self.emulate))
+        # Binary frames: the channels are announced once in the metadata
+        self.schema = None
+        if binary:
+            self.schema = FrameSchema(sorted(key for key in DICT_CONTENTS
+                                             if key.startswith('ch')))
+            self.metadata_dict[SCHEMA_KEYWORD] = self.schema.describe()
+
+
+        log.info('Initiating Slave Node %s', self.reference)
+        log.debug('Verbose mode')
+        log.info('Emulation = %s', self.emulate)
+        log.info('Binary frames = %s', self.schema is not None)
         self.is_arduino_connected = False
         self.is_master_connected = False
         self.emulation_port = []
@@ -125,8 +139,7 @@ class SlaveNode(object):
         """
         try:
             if self.emulate:
-                print('(node {}) Emulating arduino'\
-                      .format(time.strftime(TFORMAT)))
+                log.info('Emulating arduino')
                 my_emulator = ArduinoSerialEmulator()
                 self.emulation_port = my_emulator.report_server()
                 my_emulator.start()
@@ -134,8 +147,7 @@ class SlaveNode(object):
                 self.emulation_port=[]
 
 
-            print('(node {}) Setting-up arduino communications'\
-                  .format(time.strftime(TFORMAT)))
+            log.info('Setting-up arduino communications')
             arduino_COMS= SCM.SerialCommManager(0.01,
                                                 verbose=self.verbose,
                                                 emulatedPort=self.emulation_port,
@@ -143,15 +155,13 @@ class SlaveNode(object):
 
             if arduino_COMS.is_arduino_connected():
                 self.is_arduino_connected = True
-                print('(node {}) Arduino connected'\
-                      .format(time.strftime(TFORMAT)))
+                log.info('Arduino connected')
             else:
                 self.is_arduino_connected = False
             return arduino_COMS
 
         except SerialException:
-            print('(node {}) Serial exception ocurred. Try again in a few seconds '\
-                  .format(time.strftime(TFORMAT)))
+            log.error('Serial exception ocurred. Try again in a few seconds ')
             self.is_arduino_connected = False
             raise
         except ValueError as err:
@@ -179,21 +189,21 @@ class SlaveNode(object):
                server's websocket
 
         :param msg: Message from the master node, currently implemented using the
-                    syntax 'user,pin_number,pin_value', where
+                    syntax 'user,pin_number,pin_value[,seq]', where
                     user=lab6,lab7,... [If user=X, all arduinos will respond.]
                     pin_number=integer,
-                    pin_value=(0,1).
+                    pin_value=(0,1),
+                    seq=sequence number of the request, echoed in the reply.
         :type msg: str
 
         :return:
         """
+        seq = request_sequence(msg)
         if self.is_arduino_connected:
             user, pinValue, pinNumber = convert_message_to_command(msg)
             #Check if the message is for this node
             if (user in (self.reference,'X')) and self.is_arduino_connected:
-                if self.verbose:
-                    print("(node) Incoming msg is: {}".format(msg))
-                    print("(node) CMD to arduino:  {}".format(pinNumber))
+                log.debug('Incoming msg is: %s, CMD to arduino: %s', msg, pinNumber)
                 #This "try" block will look for KeyboardInterrupt events to close the program
 
                 poll_output = self.arduino_COMS.poll_arduino(
@@ -201,11 +211,20 @@ class SlaveNode(object):
                                     command=pinNumber)
                 if poll_output is not None:
                     t, channels = poll_output
-                    point_data = self.convert_data(channels)
-                    self.master_server.write_message(json.dumps(point_data))
+                    if self.schema is not None:
+                        frame = self.schema.pack(NO_REQUEST if seq is None else seq,
+                                                 time.time(),
+                                                 False,
+                                                 self.scale_data(channels))
+                        self.master_server.write_message(frame, binary=True)
+                    else:
+                        point_data = self.convert_data(channels)
+                        if seq is not None:
+                            point_data[REQUEST_KEYWORD] = seq
+                        self.master_server.write_message(json.dumps(point_data))
 
         else:
-            self.send_message_on_serial_exception()
+            self.send_message_on_serial_exception(seq)
 
 
     @gen.coroutine
@@ -215,13 +234,11 @@ class SlaveNode(object):
         """
         while not self.is_arduino_connected:
             try:
-                if self.verbose:
-                    print('(node {}) Trying to connect'\
-                          .format(time.strftime(TFORMAT)))
+                log.debug('Trying to connect')
                 self.arduino_COMS.init_arduino_connection()
                 self.is_arduino_connected = True
             except SerialException:
-                print('(node) Serial exception ocurred. Try again in a few seconds')
+                log.error('Serial exception ocurred. Try again in a few seconds')
                 self.is_arduino_connected = False
                 raise
             except ValueError as err:
@@ -229,8 +246,10 @@ class SlaveNode(object):
             except ArduinoConnectionError:
                 time.sleep(1)
 
-    def send_message_on_serial_exception(self):
+    def send_message_on_serial_exception(self, seq=None):
         """ Default message sent if a serial exception is present.
+
+        :param seq: sequence number of the request being answered
         :return:
         """
         point_data = {
@@ -238,6 +257,8 @@ class SlaveNode(object):
                         'user':self.reference,
                         'error':True
                     }
+        if seq is not None:
+            point_data[REQUEST_KEYWORD] = seq
         self.master_server.write_message(json.dumps(point_data))
 
 
@@ -269,23 +290,18 @@ class SlaveNode(object):
 
         while not self.is_master_connected:
             try:
-                print("(node {}) Connecting to WS connection = {} "\
-                      .format(time.strftime(TFORMAT),
-                              self.location))
+                log.info('Connecting to WS connection = %s ', self.location)
                 self.master_server = yield tornado.websocket.websocket_connect(self.location)
-                print('(node {}) Connection with master server started'\
-                      .format(time.strftime(TFORMAT)))
+                log.info('Connection with master server started')
                 self.is_master_connected = True
             except socket.error as error:
                 if error.errno == 10061:
-                    print('\n(node {}) Connection refused by host. \
-                    Maybe it is not running? Waiting'.format(time.strftime(TFORMAT)))
+                    log.warning('Connection refused by host. Maybe it is not running? Waiting')
                     time.sleep(5)
                 self.is_master_connected = False
                 self.metadata_registered = False
             except HTTPError as error:
-                print('(node {}) Connection taking quite long... '\
-                      .format(time.strftime(TFORMAT)))
+                log.warning('Connection taking quite long... ')
 
 
         #Main loop for data acquisition/sending
@@ -298,7 +314,7 @@ class SlaveNode(object):
 
                 msg = yield self.master_server.read_message() #we may use a callback here, instead of the rest of this code block
             except UnboundLocalError:
-                print('\n(node) Connection refused by host. Maybe Master server is not running?')
+                log.warning('Connection refused by host. Maybe Master server is not running?')
                 self.is_master_connected = False
                 self.metadata_registered = False
                 raise HostConnectionError
@@ -312,19 +328,18 @@ class SlaveNode(object):
                 # there is an error.
                 except (SerialException, ArduinoConnectionError):
                     # If the connection is not accessible, send a "standard" dictionary, with the 'error' flag
-                    self.send_message_on_serial_exception()
-                    print('(node {}) Serial Exception '.format(time.strftime(TFORMAT)))
+                    self.send_message_on_serial_exception(request_sequence(msg))
+                    log.warning('Serial Exception ', extra={'sample': True})
                     if self.is_arduino_connected:
                         self.is_arduino_connected = False
                         self.arduino_COMS.cleanup()
                         self.reconnect_to_arduino()
                 except ValueError as err:
-                    print('(node {}) ValueError thrown'.format(time.strftime(TFORMAT)))
-                    print(err.args)
+                    log.warning('ValueError thrown: %s', err.args, extra={'sample': True})
 
                 except RuntimeError as err:
                     if err.args[0]=='generator raised StopIteration':
-                        print('(node) Cannot find arduino connection')
+                        log.error('Cannot find arduino connection')
                     else:
                         raise err
                 except KeyboardInterrupt:
@@ -333,13 +348,13 @@ class SlaveNode(object):
                     raise
 
             else:
-                print('(node) Could not retrieve message from server. It may be disconnected.')
+                log.warning('Could not retrieve message from server. It may be disconnected.')
                 self.is_master_connected = False
                 self.metadata_registered = False
                 #raise KeyboardInterrupt
 
 
-    def convert_data(self,list_of_data):
+    def scale_data(self,list_of_data):
         """Converts data from arduino to a value in volts.
 
         Arduino Due provides ADC with 12 bits resolution. This function converts the
@@ -348,10 +363,21 @@ class SlaveNode(object):
         Typically, the list of data
 
         :param list_of_data: typically a list with values 0-(2^12-1) for a number of analog channels
-
+        :return: list with the physical values of the channels ch0-ch6
         """
         list_of_data = [round(datum*ADC_MAXVOLT/ADC_MAXINT,5) for datum in list_of_data]
         list_of_data[2] = list_of_data[2]*100  #Temperature conversion
+        return list_of_data[:7]
+
+    def convert_data(self,list_of_data):
+        """Converts data from arduino to a dictionary with physical values.
+
+        See SlaveNode.scale_data for the conversion of the values.
+
+        :param list_of_data: typically a list with values 0-(2^12-1) for a number of analog channels
+
+        """
+        list_of_data = self.scale_data(list_of_data)
         point_data =  {
             'user': self.reference,
             'error': False,   #Distinguishes it from the error state
@@ -375,7 +401,8 @@ def convert_message_to_command(message):
 
     A message typically has the syntax "source, channel, state", where "source"
     is the reference found in USER_REFERENCE, "channel" is the digital channel
-    to affect, and "state" is either 0 or 1.
+    to affect, and "state" is either 0 or 1. An optional fourth field holds
+    the sequence number of the request (see request_sequence).
 
     :param message: Typically a string indicating the source, the pin number and
     the state ( eg. "lab6,1,false")
@@ -396,6 +423,17 @@ def convert_message_to_command(message):
 
     return (user, pinValue, pinNumber)
 
+def request_sequence(message):
+    """ Returns the sequence number of a request from the master server
+    (the optional fourth field, e.g. "X,50,0,1234"), or None."""
+    split_message = message.split(',')
+    if len(split_message) < 4:
+        return None
+    try:
+        return int(split_message[3])
+    except ValueError:
+        return None
+
 ### ERRORS
 class HostConnectionError(Exception):
     """ This error is thrown whenever the master server is disconnected
@@ -415,9 +453,13 @@ if __name__ == "__main__":
     parser.add_argument("-p","--arduport",help="Arduino port",
         default=0)
 
+    parser.add_argument("-b","--binary",help="Send binary frames instead of JSON dictionaries",
+        type=int,default=0)
     parser.add_argument("-v","--verbose",help="Activate verbose",
         type=int,default=0)
     args = parser.parse_args()
+    # 'kill -USR1 <pid>' switches the verbose output on and off
+    logs.install_signal_toggle()
     if args.emulate:
         from servers.arduino_emulator import ArduinoSerialEmulator
 
@@ -427,9 +469,10 @@ if __name__ == "__main__":
                                       masterWSlocation=args.websocket,
                                       reference=args.reference,
                                       verbose=args.verbose,
-                                      arduino_port=args.arduport)
+                                      arduino_port=args.arduport,
+                                      binary=bool(args.binary))
     except KeyboardInterrupt:
-        print('(node {}) Exiting gracefully'.format(time.strftime(TFORMAT)))
+        log.info('Exiting gracefully')
 
     ### EXECUTE THE KEEPALIVE_WS
     while True:
@@ -437,31 +480,26 @@ if __name__ == "__main__":
 
             tornado.ioloop.IOLoop.instance().run_sync(slaveNodeInstance.keepalive_ws)
         except ArduinoConnectionError as err:
-            print(err.args)
-            print('(node {}) Problem found in serial connection. Exiting'\
-                  .format(time.strftime(TFORMAT)))
+            log.error('Problem found in serial connection (%s). Exiting', err.args)
         #except TypeError as err:
         #    print('(node) TypeError thrown')
         #    print(err)
         except ValueError as err:
-            print(type(err))
-            print(err.args)
+            log.error('%s: %s', type(err), err.args)
         except RuntimeError as err:
             if err.args[0]=='generator raised StopIteration':
-                print('(node {}) Cannot find arduino connection'\
-                      .format(time.strftime(TFORMAT)))
+                log.error('Cannot find arduino connection')
             else:
                 raise err
         except HostConnectionError:
-            print('(node {}) Master server is disconnected.'\
-                  .format(time.strftime(TFORMAT)))
+            log.warning('Master server is disconnected.')
             slaveNodeInstance.is_master_connected = False
             slaveNodeInstance.metadata_registered = False
             time.sleep(10)
         except KeyboardInterrupt:
             tornado.ioloop.IOLoop.instance().stop()
             tornado.ioloop.IOLoop.instance().close()
-            print('(node {}) Exiting gracefully'\
-                  .format(time.strftime(TFORMAT)))
+            log.info('Exiting gracefully')
+            logs.stop_logging()
             break
         time.sleep(2)
@@ -0,0 +1,232 @@
+"""Node-ingestion shards for the lab-nanny master server
+
+In the sharded mode, the master server (the coordinator) starts several
+worker processes. All of them accept node connections on the same port
+(SHARD_PORT) using SO_REUSEPORT, so that the kernel spreads the nodes
+amongst the workers. Each worker:
+-- decodes the messages of its nodes (JSON or binary, see servers.protocol)
+-- batches the samples of its nodes (all of them, not only the last one of
+   each node)
+-- every FLUSH_PERIOD forwards the samples of all its nodes to the
+   coordinator in a single message, through a websocket connected to
+   SHARD_SOCKETNAME.
+The coordinator keeps the CommsHandler, the conditions and the clients, and
+sends the commands for the nodes back through the same websocket. When the
+worker reconnects to the coordinator (e.g. after a restart of the master),
+it announces its nodes again, with their last metadata.
+
+Messages from the worker to the coordinator (JSON):
+    {'type':'open',  'id':node_id, 'ip':remote_ip}
+    {'type':'meta',  'id':node_id, 'meta':metadata_dict}
+    {'type':'data',  'samples':{node_id:[[request, data_dict], ...], ...}}
+                     (request: sequence number of the request answered by
+                     the sample, or None)
+    {'type':'close', 'id':node_id}
+Messages from the coordinator to the worker (JSON):
+    {'commands':[[node_id, message], ...]}
+"""
+import collections
+import json
+import os
+import uuid
+
+import tornado.httpclient
+import tornado.httpserver
+import tornado.ioloop as ioloop
+import tornado.netutil
+import tornado.web
+import tornado.websocket
+from tornado import gen
+from tornado.websocket import WebSocketClosedError
+
+from servers import logs
+from servers.protocol import MessageDecoder, SchemaError, METAKEYWORD
+
+SHARD_PORT       = 8002
+SHARD_SOCKETNAME = r'/shards_ws'
+FLUSH_PERIOD     = 20     # (ms) Forward the node updates to the coordinator every...
+RECONNECT_DELAY  = 1      # (s) Wait before reconnecting to the coordinator
+PENDING_SAMPLES  = 1000   # Samples kept per node while the coordinator is away
+
+log = logs.get_logger('shards')
+
+
+class ShardNodeHandler(tornado.websocket.WebSocketHandler):
+    """ Handles the websocket of a node connected to a shard worker."""
+
+    def initialize(self, worker):
+        self.worker = worker
+
+    def open(self):
+        self.id = uuid.uuid4().hex
+        self.decoder = MessageDecoder()
+        self.worker.nodes[self.id] = self
+        self.worker.forward({'type': 'open',
+                             'id': self.id,
+                             'ip': self.request.remote_ip})
+
+    def on_message(self, message):
+        try:
+            message_dict = self.decoder.decode(message)
+        except SchemaError as err:
+            log.warning('%s', err, extra={'sample': True})
+            return
+        if METAKEYWORD in message_dict:
+            self.worker.metadata[self.id] = message_dict
+            self.worker.forward({'type': 'meta',
+                                 'id': self.id,
+                                 'meta': message_dict})
+        else:
+            samples = self.worker.pending.get(self.id)
+            if samples is None:
+                samples = self.worker.pending[self.id] = \
+                    collections.deque(maxlen=PENDING_SAMPLES)
+            samples.append((self.decoder.last_request, message_dict))
+
+    def on_close(self):
+        self.worker.nodes.pop(self.id, None)
+        self.worker.metadata.pop(self.id, None)
+        self.worker.forward({'type': 'close', 'id': self.id})
+        self.worker.pending.pop(self.id, None)
+
+    def check_origin(self, origin):
+        return True
+
+
+class ShardWorker(object):
+    """ Worker process that accepts node connections and forwards their data
+    to the coordinator.
+
+    :param coordinator_location: websocket address of the coordinator,
+                                 e.g. 'ws://127.0.0.1:8001/shards_ws'
+    """
+    def __init__(self, coordinator_location, shard_port=SHARD_PORT,
+                 slave_socketname=r'/nodes_ws', flush_period=FLUSH_PERIOD):
+        self.coordinator_location = coordinator_location
+        self.shard_port = shard_port
+        self.slave_socketname = slave_socketname
+        self.flush_period = flush_period
+        self.nodes = {}      # node id -> ShardNodeHandler
+        self.metadata = {}   # node id -> last metadata dictionary
+        self.pending = {}    # node id -> deque of (request, data dictionary)
+        # Messages waiting for the coordinator connection, as (type, JSON)
+        self.outbox = collections.deque()
+        self.coordinator = None
+        self.parent_pid = os.getppid()
+
+    def run(self):
+        application = tornado.web.Application([(self.slave_socketname,
+                                                ShardNodeHandler,
+                                                {'worker': self})])
+        # SO_REUSEPORT lets all the workers listen on the same port
+        sockets = tornado.netutil.bind_sockets(self.shard_port, reuse_port=True)
+        server = tornado.httpserver.HTTPServer(application)
+        server.add_sockets(sockets)
+        ioloop.PeriodicCallback(self.flush, self.flush_period).start()
+        ioloop.IOLoop.current().add_callback(self.keepalive_coordinator)
+        try:
+            ioloop.IOLoop.current().start()
+        except KeyboardInterrupt:
+            ioloop.IOLoop.current().stop()
+
+    @gen.coroutine
+    def keepalive_coordinator(self):
+        """ Keeps the connection with the coordinator, and executes the
+        commands it sends."""
+        while True:
+            if os.getppid() != self.parent_pid:
+                # The coordinator process is gone
+                ioloop.IOLoop.current().stop()
+                return
+            try:
+                self.coordinator = yield tornado.websocket.websocket_connect(
+                    self.coordinator_location)
+            except (IOError, tornado.httpclient.HTTPError):
+                yield gen.sleep(RECONNECT_DELAY)
+                continue
+            self.announce_nodes()
+            self._send_outbox()
+            self.flush()
+            while True:
+                msg = yield self.coordinator.read_message()
+                if msg is None:
+                    break
+                self.execute_commands(json.loads(msg))
+            log.warning('Connection with the coordinator lost')
+            self.coordinator = None
+            yield gen.sleep(RECONNECT_DELAY)
+
+    def announce_nodes(self):
+        """ Queues an 'open' message (and the last metadata) of every node,
+        ahead of the data, for a new coordinator connection.
+
+        The coordinator forgets the nodes of a shard when its connection
+        closes, so these messages replace the events left in the outbox.
+        """
+        self.outbox = collections.deque(item for item in self.outbox
+                                        if item[0] == 'data')
+        announcements = []
+        for node_id, node in self.nodes.items():
+            announcements.append({'type': 'open', 'id': node_id,
+                                  'ip': node.request.remote_ip})
+            if node_id in self.metadata:
+                announcements.append({'type': 'meta', 'id': node_id,
+                                      'meta': self.metadata[node_id]})
+        self.outbox.extendleft((item['type'], json.dumps(item))
+                               for item in reversed(announcements))
+
+    def execute_commands(self, contents):
+        for node_id, message in contents.get('commands', []):
+            node = self.nodes.get(node_id)
+            if node is None:
+                continue
+            try:
+                node.write_message(message)
+            except WebSocketClosedError:
+                pass
+
+    def forward(self, contents):
+        """ Sends a message to the coordinator (after the pending data, to
+        keep the order of the events)."""
+        if contents['type'] != 'data' and self.pending:
+            self.flush()
+        self.outbox.append((contents['type'], json.dumps(contents)))
+        self._send_outbox()
+
+    def flush(self):
+        """ Forwards the samples received from the nodes.
+
+        While the coordinator is disconnected, the samples are kept (the
+        last PENDING_SAMPLES of each node).
+        """
+        if not self.pending or self.coordinator is None:
+            return
+        pending, self.pending = self.pending, {}
+        samples = {node_id: list(node_samples)
+                   for node_id, node_samples in pending.items()}
+        self.outbox.append(('data', json.dumps({'type': 'data',
+                                                'samples': samples})))
+        self._send_outbox()
+
+    def _send_outbox(self):
+        """ Writes the messages of the outbox, each one removed once it is
+        written (so none is sent twice after a failed write)."""
+        while self.outbox and self.coordinator is not None:
+            try:
+                self.coordinator.write_message(self.outbox[0][1])
+            except WebSocketClosedError:
+                return
+            self.outbox.popleft()
+
+
+def run_shard_worker(coordinator_location, shard_port=SHARD_PORT,
+                     slave_socketname=r'/nodes_ws', flush_period=FLUSH_PERIOD,
+                     verbose=False):
+    """ Entry point of the worker processes (started as new interpreters,
+    so they start their own log writer)."""
+    logs.setup_logging(verbose=verbose)
+    worker = ShardWorker(coordinator_location,
+                         shard_port=shard_port,
+                         slave_socketname=slave_socketname,
+                         flush_period=flush_period)
+    worker.run()
@@ -0,0 +1,104 @@
+"""State snapshots of the lab-nanny master server
+
+When the master restarts, it would start with no data: the clients would see
+blank graphs, and the conditions would be blind until the nodes reconnect and
+send fresh data. To avoid this, the master periodically writes a snapshot of
+its live state (see MasterServer.write_snapshot):
+-- the last data of each node, and the registry of the nodes (lab -> id,
+   address),
+-- the state of the conditions (active, pending, last actuation) and the
+   samples of their rolling windows,
+-- the recent history of every (lab, channel) (see servers.history).
+On startup, the snapshot is loaded before accepting connections, if it is not
+older than SNAPSHOT_MAX_AGE.
+
+The snapshot is a NumPy .npz file: the history is stored as arrays ('t<i>'
+and 'v<i>'), and the rest of the state as a JSON document ('state'), so it
+can be loaded without unpickling anything. The file is written to a temporary
+file, synced and renamed, so a crash while writing never leaves a truncated
+snapshot behind.
+"""
+import json
+import os
+import time
+import zipfile
+
+import numpy as np
+
+SNAPSHOT_FILE     = 'master_state.npz'
+SNAPSHOT_VERSION  = 1
+SNAPSHOT_INTERVAL = 5000    # (ms) Write a snapshot every...
+SNAPSHOT_MAX_AGE  = 3600    # (s) Older snapshots are not restored
+RESTORE_TIMEOUT   = 60      # (s) Restored nodes that do not reconnect are dropped after...
+
+
+def save_snapshot(path, state, series):
+    """ Writes a snapshot atomically.
+
+    :param path: name of the snapshot file
+    :param state: JSON-serializable dictionary
+    :param series: dictionary {(lab, channel): (times, values)} of arrays
+    """
+    keys = []
+    arrays = {}
+    for i, (key, (times, values)) in enumerate(series.items()):
+        keys.append(list(key))
+        arrays['t{}'.format(i)] = times
+        arrays['v{}'.format(i)] = values
+    document = {'version': SNAPSHOT_VERSION,
+                'time': time.time(),
+                'state': state,
+                'series': keys}
+    arrays['state'] = np.frombuffer(json.dumps(document).encode('utf-8'),
+                                    dtype=np.uint8)
+    write_atomic(path, lambda f: np.savez(f, **arrays))
+
+
+def load_snapshot(path, max_age=SNAPSHOT_MAX_AGE):
+    """ Reads a snapshot written by save_snapshot.
+
+    :return: (state, series, age), or None if there is no usable snapshot
+    :raises ValueError: if the file is not a valid snapshot
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        with np.load(path, allow_pickle=False) as contents:
+            document = json.loads(contents['state'].tobytes().decode('utf-8'))
+            if document.get('version') != SNAPSHOT_VERSION:
+                return None
+            age = time.time() - document['time']
+            if age > max_age:
+                return None
+            series = {tuple(key): (contents['t{}'.format(i)],
+                                   contents['v{}'.format(i)])
+                      for i, key in enumerate(document['series'])}
+    except (OSError, KeyError, ValueError, zipfile.BadZipFile) as err:
+        raise ValueError('Invalid snapshot {}: {}'.format(path, err))
+    return document['state'], series, age
+
+
+def write_atomic(path, write):
+    """ Writes a file through a temporary file, which replaces the original
+    once it has been synced to disk.
+
+    :param write: function writing the contents to a binary file object
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    temporary = '{}.tmp'.format(path)
+    with open(temporary, 'wb') as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, path)
+    # Make the rename itself durable (not supported on every platform)
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
@@ -0,0 +1,189 @@
+"""Tests of the frames sent to the clients (servers/broadcaster.py)"""
+import json
+from concurrent.futures import Future
+
+import pytest
+from tornado.websocket import WebSocketClosedError
+
+from servers.broadcaster import (FrameEncoder, node_delta, Subscription,
+                                 SubscriptionGroup, ClientBroadcaster,
+                                 ClientQueue, FRAME_KEY, FRAME_DELTA,
+                                 MIN_CLIENT_RATE)
+
+
+def node(x, **channels):
+    data = {'user': 'lab7', 'error': 0, 'x': x}
+    data.update(channels)
+    return data
+
+
+def test_full_frames_are_cached_by_version():
+    encoder = FrameEncoder()
+    last_data = {1: node(1.0, ch0=1)}
+    frame = encoder.encode(last_data, version=1)
+    assert json.loads(frame) == {'1': node(1.0, ch0=1)}
+    last_data[1] = node(2.0, ch0=1)
+    assert encoder.encode(last_data, version=1) is frame
+    assert encoder.encode(last_data, version=2) != frame
+
+
+def test_node_delta():
+    assert node_delta(None, node(1.0, ch0=1)) == node(1.0, ch0=1)
+    assert node_delta(node(1.0, ch0=1), node(1.0, ch0=1)) == {}
+    assert node_delta(node(1.0, ch0=1), node(2.0, ch0=1)) == \
+        {'user': 'lab7', 'x': 2.0}
+
+
+def test_delta_frames_send_only_the_changes():
+    encoder = FrameEncoder(delta=True, keyframe_interval=100)
+    first = node(1.0, ch0=1, ch1=2)
+    frame = json.loads(encoder.encode({1: first}))
+    assert (frame['frame'], frame['seq']) == (FRAME_DELTA, 1)
+    assert frame['nodes'] == {'1': first}
+    # Same dictionary: nothing to send
+    assert encoder.encode({1: first}) is None
+    frame = json.loads(encoder.encode({1: node(2.0, ch0=1, ch1=3)}))
+    assert frame['nodes'] == {'1': {'user': 'lab7', 'x': 2.0, 'ch1': 3}}
+    frame = json.loads(encoder.encode({}))
+    assert (frame['seq'], frame['nodes'], frame['removed']) == (3, {}, [1])
+
+
+def test_keyframes_every_interval():
+    encoder = FrameEncoder(delta=True, keyframe_interval=3)
+    last_data = {1: node(1.0, ch0=1)}
+    kinds = []
+    for _ in range(6):
+        frame = encoder.encode(last_data)
+        kinds.append(frame and json.loads(frame)['frame'])
+    assert kinds == [FRAME_DELTA, None, FRAME_KEY, None, None, FRAME_KEY]
+
+
+def test_keyframe_for_a_new_client_keeps_the_state():
+    encoder = FrameEncoder(delta=True)
+    last_data = {1: node(1.0, ch0=1)}
+    encoder.encode(last_data)
+    frame = json.loads(encoder.keyframe(last_data))
+    assert (frame['frame'], frame['seq']) == (FRAME_KEY, 1)
+    assert encoder.encode(last_data) is None
+
+
+def test_subscription_messages():
+    subscription = Subscription.from_message(json.dumps(
+        {'subscribe': {'labs': ['lab7'], 'channels': ['ch0'], 'max_rate': 2}}))
+    assert (subscription.labs, subscription.channels) == \
+        ({'lab7'}, {'ch0'})
+    assert subscription.min_interval == 0.5
+    assert Subscription.from_message('{"subscribe": null}').key == Subscription().key
+    # Actuation commands are not subscriptions
+    assert Subscription.from_message('lab7,13,1') is None
+    assert Subscription.from_message('{"lab": "lab7"}') is None
+
+
+@pytest.mark.parametrize('message', ['{"subscribe": [1]}',
+                                     '{"subscribe": {"max_rate": 0}}'])
+def test_invalid_subscriptions(message):
+    with pytest.raises(ValueError):
+        Subscription.from_message(message)
+
+
+def test_filter_node():
+    data = node(1.0, ch0=1, ch1=2)
+    assert Subscription(labs=['lab8']).filter_node(data) is None
+    assert Subscription(labs=['lab7']).filter_node(data) is data
+    assert Subscription(channels=['ch1']).filter_node(data) == node(1.0, ch1=2)
+
+
+def test_groups_are_rate_limited():
+    group = SubscriptionGroup(Subscription(max_rate=2))
+    last_data = {1: node(1.0, ch0=1)}
+    sent = [t for t in (0.0, 0.1, 0.3, 0.5, 0.6, 1.0)
+            if group.frame(last_data, version=t, now=t) is not None]
+    assert sent == [0.0, 0.5, 1.0]
+    # After a long pause the frames are not sent in a burst
+    assert group.frame(last_data, version=10, now=10.0) is not None
+    assert group.frame(last_data, version=11, now=10.1) is None
+
+
+def test_clients_with_the_same_subscription_share_a_group():
+    broadcaster = ClientBroadcaster()
+    first = broadcaster.subscribe('a', Subscription(labs=['lab7']))
+    assert broadcaster.subscribe('b', Subscription(labs=['lab7'])) is first
+    other = broadcaster.subscribe('b', Subscription(labs=['lab8']))
+    assert other is not first and first.clients == ['a']
+    broadcaster.unsubscribe('a')
+    assert list(broadcaster.groups) == [other.subscription.key]
+
+
+class Client(object):
+    """ Websocket whose writes only complete when finish_write is called."""
+    def __init__(self, closed=False):
+        self.written = []
+        self.pending = None
+        self.closed = closed
+
+    def write_message(self, frame):
+        if self.closed:
+            raise WebSocketClosedError()
+        self.written.append(frame)
+        self.pending = Future()
+        return self.pending
+
+    def finish_write(self):
+        self.pending.set_result(None)
+
+    def close(self):
+        self.closed = True
+
+
+def test_queue_writes_one_frame_at_a_time_and_the_latest_wins():
+    client = Client()
+    queue = ClientQueue(client, max_depth=2)
+    for frame in 'abcd':
+        queue.push(frame)
+    assert client.written == ['a']
+    assert list(queue.frames) == ['c', 'd'] and queue.dropped == 1
+    client.finish_write()
+    assert client.written == ['a', 'c'] and queue.dropped == 0
+    client.finish_write()
+    assert client.written == ['a', 'c', 'd'] and not queue.frames
+
+
+def test_delta_queue_is_replaced_by_a_keyframe():
+    client = Client()
+    queue = ClientQueue(client, max_depth=2)
+    for frame in 'abcd':
+        queue.push(frame, delta=True)
+    # Dropping a delta invalidates the ones queued after it
+    assert not queue.frames and queue.needs_keyframe
+    assert queue.dropped == 3
+    queue.replace('K')
+    assert not queue.needs_keyframe
+    client.finish_write()
+    assert client.written == ['a', 'K']
+
+
+def test_closed_client_is_skipped():
+    queue = ClientQueue(Client(closed=True))
+    queue.push('a')
+    assert queue.closed
+    queue.push('b')
+    assert not queue.frames
+
+
+def test_lagging_client_is_downgraded_then_disconnected():
+    broadcaster = ClientBroadcaster(base_rate=10, max_queue_depth=1, max_lag=2)
+    client = Client()
+    broadcaster.subscribe(client)
+    last_data = {1: node(1.0, ch0=1)}
+    rates = []
+    now = 0.0
+    while not client.closed:
+        broadcaster.publish(last_data, version=now, now=now)
+        rate = broadcaster.group_of(client) and \
+            broadcaster.group_of(client).subscription.max_rate
+        if rate and rate not in rates:
+            rates.append(rate)
+        now += 0.1
+    assert rates == [5.0, 2.5, 1.25, 0.625, 0.3125]
+    assert rates[-1]/2 < MIN_CLIENT_RATE
+    assert broadcaster.group_of(client) is None
@@ -0,0 +1,141 @@
+"""Tests of the condition engine (servers/conditions.py)"""
+import statistics
+
+import pytest
+
+from servers.conditions import (Condition, ConditionEngine, RollingWindow,
+                                ThresholdIndex)
+
+
+def condition_dict(name='too hot', obs_range=(19, 23), **options):
+    contents = {'name': name, 'obs_lab': 'lab7', 'obs_ch': 'ch2',
+                'obs_range': obs_range, 'target_lab': 'lab7',
+                'target_ch': 13, 'target_val': 1}
+    contents.update(options)
+    return contents
+
+
+def sample(t, value, lab='lab7', error=0):
+    return {'user': lab, 'error': error, 'x': t, 'ch2': value}
+
+
+def test_threshold_index_finds_the_violated_conditions():
+    index = ThresholdIndex()
+    narrow = Condition(condition_dict('narrow', (20, 22)))
+    wide = Condition(condition_dict('wide', (10, 30)))
+    for condition in (narrow, wide):
+        index.add(condition)
+    assert index.violated(21) == []
+    assert index.violated(20) == []     # the boundaries are allowed
+    assert index.violated(25) == [narrow]
+    assert set(index.violated(5)) == {narrow, wide}
+    index.remove(narrow)
+    index.remove(narrow)
+    assert len(index) == 1
+    assert index.violated(25) == []
+
+
+def test_engine_fires_once_per_transition():
+    engine = ConditionEngine([condition_dict()])
+    assert engine.update(sample(0, 21)) == []
+    events = engine.update(sample(1, 25))
+    assert [(event.condition.name, event.active) for event in events] == \
+        [('too hot', True)]
+    assert events[0].condition.command == 'lab7,13,1'
+    assert engine.update(sample(2, 26)) == []
+    events = engine.update(sample(3, 21))
+    assert [event.active for event in events] == [False]
+    assert engine.firings == 1
+
+
+def test_engine_ignores_other_labs_and_errors():
+    engine = ConditionEngine([condition_dict()])
+    assert engine.update(sample(0, 50, lab='lab8')) == []
+    assert engine.update(sample(0, 50, error=1)) == []
+    assert engine.evaluations == 0
+
+
+def test_engine_unchanged_values_are_not_evaluated():
+    engine = ConditionEngine([condition_dict()])
+    for t in range(5):
+        engine.update(sample(t, 21))
+    assert engine.evaluations == 1
+
+
+def test_removed_conditions_no_longer_fire():
+    engine = ConditionEngine()
+    condition = engine.add_condition(condition_dict())
+    engine.remove_condition(condition)
+    assert engine.update(sample(0, 50)) == []
+    assert not engine.conditions
+
+
+def transitions(engine, samples):
+    return [(t, [event.active for event in engine.update(sample(t, value))])
+            for t, value in samples]
+
+
+def test_hold_debounces_short_excursions():
+    engine = ConditionEngine([condition_dict(hold=2)])
+    assert transitions(engine, [(0, 25), (1, 21), (2, 25), (3, 25), (4, 25)]) == \
+        [(0, []), (1, []), (2, []), (3, []), (4, [True])]
+
+
+def test_hysteresis_delays_the_clearing():
+    engine = ConditionEngine([condition_dict(hysteresis=0.5)])
+    assert transitions(engine, [(0, 24), (1, 22.8), (2, 22.4)]) == \
+        [(0, [True]), (1, []), (2, [False])]
+
+
+def test_min_interval_between_actuations():
+    engine = ConditionEngine([condition_dict(min_interval=10)])
+    result = transitions(engine, [(0, 25), (1, 21), (2, 25), (11, 25)])
+    assert result == [(0, [True]), (1, [False]), (2, []), (11, [True])]
+
+
+def test_restored_state_is_not_actuated_again():
+    engine = ConditionEngine([condition_dict()])
+    engine.update(sample(0, 25))
+    state = engine.get_state()
+    restored = ConditionEngine([condition_dict()])
+    restored.set_state(state)
+    assert restored.update(sample(1, 25)) == []
+    assert [event.active for event in restored.update(sample(2, 21))] == [False]
+
+
+def test_rolling_window_statistics():
+    window = RollingWindow(10)
+    values = [3.0, 1.0, 4.0, 1.0, 5.0, 9.0, 2.0, 6.0]
+    for t, value in enumerate(values):
+        window.add(t*2, value)
+    # Only the samples of the last 10 s (t >= 4) are kept
+    kept = values[2:]
+    assert len(window) == len(kept)
+    assert window.statistic('mean') == pytest.approx(statistics.mean(kept))
+    assert window.statistic('min') == min(kept)
+    assert window.statistic('max') == max(kept)
+    assert window.statistic('std') == pytest.approx(statistics.pstdev(kept))
+    assert window.statistic('rate') == pytest.approx((6.0 - 4.0)/10)
+
+
+def test_rolling_window_restarts_when_time_goes_back():
+    window = RollingWindow(10)
+    window.add(5, 1.0)
+    window.add(6, 3.0)
+    window.add(2, 7.0)
+    assert window.samples() == [(2, 7.0)]
+    assert window.statistic('std') is None
+
+
+def test_windowed_condition():
+    engine = ConditionEngine([condition_dict(obs_stat='mean', window=3)])
+    result = transitions(engine, [(0, 21), (1, 30), (2, 21), (3, 30), (10, 21)])
+    # The mean leaves (19, 23) at t=1 and comes back once the window is cleared
+    assert result == [(0, []), (1, [True]), (2, []), (3, []), (10, [False])]
+
+
+def test_windowed_condition_needs_a_window():
+    with pytest.raises(ValueError):
+        Condition(condition_dict(obs_stat='mean'))
+    with pytest.raises(ValueError):
+        Condition(condition_dict(obs_stat='median', window=3))
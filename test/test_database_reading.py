@@ -0,0 +1,85 @@
+"""Tests of the NumPy loaders of the database (database/database_reading.py)"""
+import json
+import time
+
+import numpy as np
+import pytest
+
+from database.DBHandler import DBHandler
+from database.PartitionedDB import PartitionedDB, partition_start
+from database.database_reading import (load_lab, iter_lab, count_rows,
+                                       channels_of_lab, load_events,
+                                       to_datetime64, CONNCLOSEDSTR)
+
+DAY = 86400
+
+
+def entry(lab, t, error=0, **channels):
+    data = {'user': lab, 'error': error, 'x': t}
+    data.update(channels)
+    return data
+
+
+@pytest.fixture
+def db_name(tmp_path):
+    name = str(tmp_path / 'reading.db')
+    db = DBHandler(db_name=name)
+    db.add_database_entries([entry('lab7', float(t), ch0=float(t), ch1=-float(t))
+                             for t in range(5)])
+    db.add_database_entries([entry('lab7', 5.0, error=1, ch0=0.0, ch1=0.0),
+                             entry('lab8', 1.0, ch0=7.0)])
+    lab7 = db.get_labID_by_name('lab7')
+    for t, metadata in ((0.5, {'ch0': 'temperature'}), (3.5, CONNCLOSEDSTR),
+                        (4.5, {'ch0': 'temperature'})):
+        db.cursor.execute('INSERT INTO metadata_list(time, labID, metadata) '
+                          'VALUES (?,?,?)', (t, lab7, json.dumps(metadata)))
+    db.commit()
+    db.close()
+    return name
+
+
+def test_load_lab(db_name):
+    data = load_lab(db_name, 'lab7', ['ch1', 'ch9'], start=1, end=3, chunk_rows=2)
+    assert list(data['x']) == [1.0, 2.0, 3.0]
+    assert list(data['ch1']) == [-1.0, -2.0, -3.0]
+    # Channels missing from the table are NaN
+    assert np.isnan(data['ch9']).all()
+
+
+def test_load_lab_all_channels_without_errors(db_name):
+    assert channels_of_lab(db_name, 'lab7') == ['ch0', 'ch1']
+    assert count_rows(db_name, 'lab7') == 5
+    data = load_lab(db_name, 'lab7')
+    assert sorted(data) == ['ch0', 'ch1', 'x']
+    assert list(data['ch0']) == [0.0, 1.0, 2.0, 3.0, 4.0]
+    assert len(load_lab(db_name, 'lab9')['x']) == 0
+
+
+def test_iter_lab_yields_chunks(db_name):
+    chunks = list(iter_lab(db_name, 'lab7', ['ch0'], chunk_rows=2))
+    assert [len(x) for x, _ in chunks] == [2, 2, 1]
+    assert chunks[0][1].shape == (2, 1)
+
+
+def test_load_events(db_name):
+    events = load_events(db_name, 'lab7')
+    assert list(events['connect']) == [0.5, 4.5]
+    assert list(events['disconnect']) == [3.5]
+    assert list(load_events(db_name, 'lab7', start=1)['connect']) == [4.5]
+    assert len(load_events(db_name, 'lab8')['connect']) == 0
+
+
+def test_partitioned_source(tmp_path):
+    directory = str(tmp_path / 'parts')
+    now = partition_start(time.time(), 'day') + DAY/2
+    db = PartitionedDB(directory, 'day')
+    db.add_database_entries([entry('lab7', now - day*DAY, ch0=float(day))
+                             for day in range(3)])
+    db.close()
+    data = load_lab(directory, 'lab7', ['ch0'], start=now - 1.5*DAY)
+    assert list(data['x']) == [now - DAY, now]
+    assert list(data['ch0']) == [1.0, 0.0]
+
+
+def test_to_datetime64():
+    assert str(to_datetime64([1558051200.5])[0]) == '2019-05-17T00:00:00.500000'
@@ -0,0 +1,66 @@
+"""Tests of the batched writes of the database (database/DBHandler.py)"""
+import pytest
+
+from database.DBHandler import DBHandler
+
+
+def entry(lab, t, **channels):
+    data = {'user': lab, 'error': 0, 'x': t}
+    data.update(channels)
+    return data
+
+
+@pytest.fixture
+def db(tmp_path):
+    handler = DBHandler(db_name=str(tmp_path / 'batches.db'))
+    yield handler
+    handler.close()
+
+
+def rows(db, sql):
+    db.cursor.execute(sql)
+    return db.cursor.fetchall()
+
+
+def test_observation_ids_are_consecutive_across_batches(db):
+    db.add_database_entries([entry('lab7', 1.0, ch0=1.0),
+                             entry('lab8', 1.0, ch0=2.0)])
+    db.add_database_entry(entry('lab7', 2.0, ch0=3.0))
+    db.add_database_entries([entry('lab8', 3.0, ch0=4.0),
+                             entry('lab7', 3.0, ch0=5.0)])
+    lab7, lab8 = db.get_labID_by_name('lab7'), db.get_labID_by_name('lab8')
+    assert rows(db, 'SELECT _id, labID FROM observation_list ORDER BY _id') == \
+        [(1, lab7), (2, lab8), (3, lab7), (4, lab8), (5, lab7)]
+    assert rows(db, 'SELECT ID, x, ch0 FROM lab7 ORDER BY ID') == \
+        [(1, 1.0, 1.0), (3, 2.0, 3.0), (5, 3.0, 5.0)]
+    assert rows(db, 'SELECT ID, ch0 FROM lab8 ORDER BY ID') == [(2, 2.0), (4, 4.0)]
+
+
+def test_observation_ids_are_not_reused(db):
+    db.add_database_entries([entry('lab7', t, ch0=t) for t in range(3)])
+    db.cursor.execute('DELETE FROM observation_list WHERE _id=3')
+    db.commit()
+    db.add_database_entries([entry('lab7', 3.0, ch0=3.0)])
+    assert rows(db, 'SELECT _id FROM observation_list ORDER BY _id') == \
+        [(1,), (2,), (4,)]
+
+
+def test_entries_with_other_keys_order(db):
+    db.add_database_entries([entry('lab7', 1.0, ch0=1.0),
+                             {'ch0': 2.0, 'x': 2.0, 'error': 0, 'user': 'lab7'}])
+    assert rows(db, 'SELECT ID, x, ch0 FROM lab7 ORDER BY ID') == \
+        [(1, 1.0, 1.0), (2, 2.0, 2.0)]
+
+
+def test_batches_survive_reopening(tmp_path):
+    name = str(tmp_path / 'batches.db')
+    db = DBHandler(db_name=name)
+    db.add_database_entries([entry('lab7', 1.0, ch0=1.0)])
+    db.close()
+    db = DBHandler(db_name=name)
+    db.add_database_entries([entry('lab7', 2.0, ch0=2.0),
+                             entry('lab9', 2.0, ch1=7.0)])
+    assert rows(db, 'SELECT _id FROM observation_list ORDER BY _id') == \
+        [(1,), (2,), (3,)]
+    assert rows(db, 'SELECT ID, ch1 FROM lab9') == [(3, 7.0)]
+    db.close()
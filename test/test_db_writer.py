@@ -0,0 +1,80 @@
+"""Tests of the background database writer (database/DBWriter.py)"""
+import sqlite3
+
+import pytest
+
+from database.DBHandler import DBHandler
+from database.DBWriter import DBWriter
+
+
+def entry(x, lab='lab7', **channels):
+    dictionary = {'user': lab, 'error': 0, 'x': x}
+    dictionary.update(channels or {'ch0': 1.0})
+    return dictionary
+
+
+def rows(db_name, table, column='x'):
+    db = sqlite3.connect(db_name)
+    try:
+        return db.execute('SELECT {0} FROM {1} ORDER BY {0}'
+                          .format(column, table)).fetchall()
+    finally:
+        db.close()
+
+
+@pytest.fixture
+def db_name(tmp_path):
+    return str(tmp_path / 'writer.db')
+
+
+def test_batches_are_grouped_in_one_commit(db_name):
+    writer = DBWriter(db_name, commit_delay=1)
+    for x in range(5):
+        writer.add_database_entries([entry(x)])
+    writer.register_new_metadata('lab7', {'user': 'lab7', 'meta': {}})
+    assert writer.flush(10)
+    writer.close()
+    assert (writer.written, writer.commits, writer.errors) == (6, 1, 0)
+    assert len(rows(db_name, 'lab7')) == 5
+
+
+def test_failing_batch_is_discarded_as_a_whole(db_name):
+    writer = DBWriter(db_name, commit_delay=1)
+    writer.add_database_entries([entry(1)])
+    # The second observation has a column which the table lacks
+    writer.add_database_entries([entry(2), entry(3, ch0=1.0, ch9=2.0)])
+    writer.add_database_entries([entry(4)])
+    assert writer.flush(10)
+    writer.close()
+    assert writer.errors == 1
+    assert rows(db_name, 'lab7') == [(1,), (4,)]
+    assert len(rows(db_name, 'observation_list', '_id')) == 2
+
+
+def test_failing_batch_rolls_back_new_tables(db_name):
+    db = DBHandler(db_name)
+    with pytest.raises(sqlite3.OperationalError):
+        with db.atomic():
+            db.add_database_entries([entry(1, lab='lab8'),
+                                     entry(2, lab='lab8', ch0=1.0, ch9=2.0)],
+                                    commit=False)
+    assert not db.check_table_exists('lab8')
+    # The tables and lab ids of the rolled back batch are created again
+    with db.atomic():
+        db.add_database_entries([entry(3, lab='lab8')], commit=False)
+    db.close()
+    assert rows(db_name, 'lab8') == [(3,)]
+
+
+def test_full_queue_drops_batches(db_name):
+    writer = DBWriter(db_name, queue_size=1)
+    # The writer thread takes at most one batch at a time
+    accepted = sum(writer.add_database_entries([entry(x)]) for x in range(1000))
+    writer.close()
+    assert accepted + writer.dropped == 1000
+    assert len(rows(db_name, 'lab7')) == accepted
+
+
+def test_open_error_is_raised_by_the_constructor(tmp_path):
+    with pytest.raises(sqlite3.OperationalError):
+        DBWriter(str(tmp_path / 'missing' / 'writer.db'))
@@ -0,0 +1,50 @@
+"""Tests of the in-memory history of the node data (servers/history.py)"""
+import json
+
+import numpy as np
+
+from servers.history import RingBuffer, HistoryStore, FRAME_BACKFILL
+
+
+def test_ring_buffer_keeps_the_last_samples():
+    buffer = RingBuffer(4)
+    for t in range(6):
+        buffer.append(t, 10*t)
+    assert len(buffer) == 4
+    times, values = buffer.last()
+    assert list(times) == [2, 3, 4, 5]
+    assert list(values) == [20, 30, 40, 50]
+    times, _ = buffer.last(2)
+    assert list(times) == [4, 5]
+    times, _ = buffer.last(10)
+    assert len(times) == 4
+
+
+def test_ring_buffer_extend_wraps_around():
+    buffer = RingBuffer(4)
+    buffer.append(0, 0)
+    buffer.append(1, 1)
+    buffer.extend(np.arange(2, 5), np.arange(2, 5))
+    assert list(buffer.last()[0]) == [1, 2, 3, 4]
+    buffer.extend(np.arange(5, 15), np.arange(5, 15))
+    assert list(buffer.last()[1]) == [11, 12, 13, 14]
+
+
+def test_history_store_skips_errors_and_non_channels():
+    store = HistoryStore(capacity=10)
+    store.append({'user': 'lab7', 'error': 0, 'x': 1.0, 'ch0': 1.5, 'note': 'a'})
+    store.append({'user': 'lab7', 'error': 1, 'x': 2.0, 'ch0': 9.0})
+    assert list(store.buffers) == [('lab7', 'ch0')]
+    times, values = store.series('lab7', 'ch0')
+    assert (list(times), list(values)) == ([1.0], [1.5])
+    assert len(store.series('lab8', 'ch0')[0]) == 0
+
+
+def test_backfill_frame_filters_labs_and_channels():
+    store = HistoryStore(capacity=10)
+    for t in range(3):
+        store.append({'user': 'lab7', 'error': 0, 'x': t, 'ch0': t, 'ch1': -t})
+        store.append({'user': 'lab8', 'error': 0, 'x': t, 'ch0': t})
+    frame = json.loads(store.backfill(labs=['lab7'], channels=['ch1'], n=2))
+    assert frame == {'frame': FRAME_BACKFILL,
+                     'labs': {'lab7': {'ch1': {'x': [1, 2], 'y': [-1, -2]}}}}
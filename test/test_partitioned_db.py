@@ -0,0 +1,107 @@
+"""Tests of the time-partitioned database (database/PartitionedDB.py)"""
+import os
+import time
+
+import pytest
+
+from database.DBHandler import RAW_RESOLUTION
+from database.DBWriter import DBWriter
+from database.PartitionedDB import PartitionedDB, partition_start, PERIODS
+
+DAY = 86400
+
+
+def entries(lab, times, value=1.0):
+    return [{'user': lab, 'error': 0, 'x': t, 'ch0': value} for t in times]
+
+
+@pytest.fixture
+def now():
+    # Noon (UTC), so the times of a test stay in the same day
+    return partition_start(time.time(), 'day') + DAY/2
+
+
+@pytest.fixture
+def database(tmp_path):
+    db = PartitionedDB(str(tmp_path / 'parts'), 'day', retention={RAW_RESOLUTION: 10*DAY})
+    yield db
+    db.close()
+
+
+def test_partition_start_day():
+    t = 1558000000.5
+    start = partition_start(t, 'day')
+    assert start % DAY == 0
+    assert start <= t < start + DAY
+
+
+def test_partition_start_week_is_monday():
+    t = 1558000000
+    start = partition_start(t, 'week')
+    assert time.gmtime(start).tm_wday == 0
+    assert start <= t < start + PERIODS['week']
+
+
+def test_query_reads_only_overlapping_partitions(database, now):
+    for day in range(5):
+        database.add_database_entries(entries('lab7', [now - day*DAY], value=day))
+    assert len(database.partitions('lab7')) == 5
+    assert len(database.partitions('lab7', now - 1.5*DAY, now)) == 2
+    data = database.query('lab7', 'ch0', now - 1.5*DAY, now, resolution=RAW_RESOLUTION)
+    assert list(data['mean']) == [1.0, 0.0]
+
+
+def test_prune_deletes_partitions_and_keeps_rollups(database, now):
+    for day in range(10):
+        database.add_database_entries(entries('lab7', [now - day*DAY]))
+    later = now + 5*DAY
+    # The partitions which ended more than 10 days before are deleted
+    assert database.prune(later) == 4
+    assert len(database.partitions('lab7')) == 6
+    # The daily rollups outlive the raw data
+    data = database.query('lab7', 'ch0', now - 9*DAY - 1, now, resolution=DAY)
+    assert len(data['x']) == 10
+    assert database.choose_resolution(now - 8*DAY, now, now=later) != RAW_RESOLUTION
+
+
+def test_prune_compacts_old_partitions(database, now):
+    database.add_database_entries(entries('lab7', [now - 3*DAY, now]))
+    database.prune(now)
+    (old_path, _, _, old_readonly), (path, _, _, readonly) = database.partitions('lab7')
+    assert old_readonly and not readonly
+    assert not os.stat(old_path).st_mode & 0o222
+    data = database.query('lab7', 'ch0', now - 4*DAY, now, resolution=RAW_RESOLUTION)
+    assert len(data['x']) == 2
+
+
+def test_late_rows_of_compacted_partition_are_rejected(database, now):
+    database.add_database_entries(entries('lab7', [now - 3*DAY]))
+    database.prune(now)
+    rejected = database.add_database_entries(entries('lab7', [now - 3*DAY + 1, now]))
+    assert rejected == 1
+    assert database.rejected == 1
+    data = database.query('lab7', 'ch0', now - 4*DAY, now, resolution=RAW_RESOLUTION)
+    assert list(data['x']) == [now - 3*DAY, now]
+
+
+def test_late_rows_of_expired_partition_are_rejected(database, now):
+    assert database.add_database_entries(entries('lab7', [now - 20*DAY])) == 1
+    assert not database.partitions('lab7')
+
+
+def test_writer_counts_rejected_rows(tmp_path, now):
+    directory = str(tmp_path / 'parts')
+    database = PartitionedDB(directory, 'day')
+    database.add_database_entries(entries('lab7', [now - 3*DAY]))
+    database.prune(now)
+    database.close()
+    writer = DBWriter(directory, partition_period='day')
+    writer.add_database_entries(entries('lab7', [now - 3*DAY + 1, now]))
+    assert writer.flush(10)
+    writer.close()
+    assert writer.rejected == 1
+    assert writer.errors == 0
+    database = PartitionedDB(directory, 'day', readonly=True)
+    data = database.query('lab7', 'ch0', now - 1, now + 1, resolution=RAW_RESOLUTION)
+    database.close()
+    assert list(data['x']) == [now]
@@ -0,0 +1,98 @@
+"""Tests of the binary node protocol (servers/protocol.py)"""
+import json
+
+import pytest
+
+from servers.protocol import (FrameSchema, MessageDecoder, SchemaError,
+                              METAKEYWORD, SCHEMA_KEYWORD, REQUEST_KEYWORD,
+                              NO_REQUEST)
+
+CHANNELS = ['ch0', 'ch1', 'ch2']
+
+
+def metadata(schema=None):
+    message = {'user': 'lab7', METAKEYWORD: {'ch0': 'temperature'}}
+    if schema is not None:
+        message[SCHEMA_KEYWORD] = schema.describe()
+    return json.dumps(message)
+
+
+def test_frame_round_trip():
+    schema = FrameSchema(CHANNELS, schema_id=3)
+    frame = schema.pack(42, 1558000000.25, False, [1.5, -2.0, 0.0])
+    assert len(frame) == schema.size
+    seq, data = schema.unpack(frame, 'lab7')
+    assert seq == 42
+    assert data == {'user': 'lab7', 'error': False, 'x': 1558000000.25,
+                    'ch0': 1.5, 'ch1': -2.0, 'ch2': 0.0}
+
+
+def test_error_frames_have_no_values():
+    schema = FrameSchema(CHANNELS)
+    seq, data = schema.unpack(schema.pack(NO_REQUEST, 1.0, True, [1, 2, 3]), 'lab7')
+    assert data == {'user': 'lab7', 'error': True, 'x': 1.0}
+
+
+def test_sequence_numbers_wrap():
+    schema = FrameSchema(CHANNELS)
+    seq, _ = schema.unpack(schema.pack(2**32 + 5, 1.0, False, [0, 0, 0]), 'lab7')
+    assert seq == 5
+
+
+def test_unpack_rejects_foreign_frames():
+    schema = FrameSchema(CHANNELS, schema_id=1)
+    frame = schema.pack(0, 1.0, False, [0, 0, 0])
+    with pytest.raises(SchemaError):
+        schema.unpack(frame[:-1], 'lab7')
+    with pytest.raises(SchemaError):
+        FrameSchema(CHANNELS, schema_id=2).unpack(frame, 'lab7')
+
+
+def test_description_round_trip():
+    schema = FrameSchema(CHANNELS, schema_id=7)
+    copy = FrameSchema.from_description(json.loads(json.dumps(schema.describe())))
+    assert (copy.id, copy.channels, copy.format) == (7, CHANNELS, schema.format)
+    description = dict(schema.describe(), format='<HIdBd')
+    with pytest.raises(SchemaError):
+        FrameSchema.from_description(description)
+
+
+def test_decoder_binary_frames_after_schema():
+    schema = FrameSchema(CHANNELS)
+    decoder = MessageDecoder()
+    with pytest.raises(SchemaError):
+        decoder.decode(schema.pack(0, 1.0, False, [0, 0, 0]))
+    meta = decoder.decode(metadata(schema))
+    assert METAKEYWORD in meta
+    data = decoder.decode(schema.pack(9, 2.0, False, [1, 2, 3]))
+    assert data['user'] == 'lab7' and data['ch2'] == 3
+    assert decoder.last_request == 9
+    decoder.decode(schema.pack(NO_REQUEST, 3.0, False, [1, 2, 3]))
+    assert decoder.last_request is None
+
+
+def test_decoder_json_messages():
+    decoder = MessageDecoder()
+    data = decoder.decode(json.dumps({'user': 'lab7', 'error': 0, 'x': 1.0,
+                                      'ch0': 1.5, REQUEST_KEYWORD: 4}))
+    assert REQUEST_KEYWORD not in data
+    assert decoder.last_request == 4
+    assert decoder.user == 'lab7'
+    # New metadata without a schema forgets the previous one
+    decoder.schema = FrameSchema(CHANNELS)
+    decoder.decode(metadata())
+    assert decoder.schema is None
+
+
+def test_decoder_invalid_schema():
+    decoder = MessageDecoder()
+    message = json.dumps({'user': 'lab7', METAKEYWORD: {},
+                          SCHEMA_KEYWORD: {'channels': CHANNELS}})
+    with pytest.raises(SchemaError):
+        decoder.decode(message)
+
+
+@pytest.mark.parametrize('message', ['{"user": "lab7", ', '[1, 2]', 'lab7,13,1'])
+def test_decoder_invalid_text(message):
+    with pytest.raises(SchemaError):
+        MessageDecoder().decode(message)
@@ -0,0 +1,108 @@
+"""Tests of the history queries (servers/queries.py)"""
+import json
+import time
+
+import numpy as np
+import pytest
+
+from database.DBHandler import DBHandler, RAW_RESOLUTION
+from servers.queries import (lttb, minmax, parse_query, HistoryQuery,
+                             HISTORY_SPAN, HISTORY_POINTS)
+
+# Recent, so the raw rows are within their retention
+NOW = float(int(time.time()))
+
+
+def arguments(**values):
+    return lambda name, default: values.get(name, default)
+
+
+def test_lttb_keeps_the_ends_and_the_peaks():
+    x = np.arange(1000, dtype=float)
+    y = np.zeros(1000)
+    y[500] = 10
+    new_x, new_y = lttb(x, y, 50)
+    assert len(new_x) == 50
+    assert new_x[0] == 0 and new_x[-1] == 999
+    assert 10 in new_y
+    assert np.all(np.diff(new_x) > 0)
+
+
+def test_lttb_short_series_unchanged():
+    x = np.arange(10, dtype=float)
+    new_x, new_y = lttb(x, x, 100)
+    assert new_x is x and new_y is x
+
+
+def test_minmax_keeps_the_extremes_of_each_bucket():
+    x = np.arange(100, dtype=float)
+    values = np.sin(x)
+    new_x, low, high = minmax(x, values, values, 10)
+    assert len(new_x) == 5
+    assert list(new_x) == [0, 20, 40, 60, 80]
+    assert low[0] == values[:20].min()
+    assert high[-1] == values[80:].max()
+
+
+def test_parse_query_defaults():
+    lab, channels, start, end, points, method = parse_query(
+        arguments(lab='lab7', channels='ch0,ch1'), now=NOW)
+    assert (lab, channels, method) == ('lab7', ['ch0', 'ch1'], 'lttb')
+    assert (start, end, points) == (NOW - HISTORY_SPAN, NOW, HISTORY_POINTS)
+
+
+@pytest.mark.parametrize('values', [
+    {'lab': 'lab7; DROP TABLE laboratories', 'channels': 'ch0'},
+    {'lab': 'lab7', 'channels': 'ch0,ch1)'},
+    {'lab': 'lab7', 'channels': ''},
+    {'lab': 'lab7', 'channels': 'ch0', 'start': '10', 'end': '5'},
+    {'lab': 'lab7', 'channels': 'ch0', 'points': '2'},
+    {'lab': 'lab7', 'channels': 'ch0', 'method': 'mean'},
+    {'lab': 'lab7', 'channels': 'ch0', 'start': 'nan'},
+    {'lab': 'lab7', 'channels': 'ch0', 'start': '-inf'},
+    {'lab': 'lab7', 'channels': 'ch0', 'end': 'inf'},
+])
+def test_parse_query_rejects_invalid_arguments(values):
+    with pytest.raises(ValueError):
+        parse_query(arguments(**values), now=NOW)
+
+
+@pytest.fixture
+def db_name(tmp_path):
+    name = str(tmp_path / 'history.db')
+    db = DBHandler(db_name=name)
+    db.add_database_entries([{'user': 'lab7', 'error': 0, 'x': NOW - 100 + t,
+                              'ch0': float(t)} for t in range(100)])
+    db.close()
+    return name
+
+
+@pytest.mark.parametrize('method', ['lttb', 'minmax'])
+def test_history_query_response(db_name, method):
+    query = HistoryQuery(db_name)
+    try:
+        chunks = list(query.run('lab7', ['ch0', 'ch9'], NOW - 100, NOW, 10, method))
+    finally:
+        query.close()
+    # Header, one chunk per channel and the footer
+    assert len(chunks) == 4
+    response = json.loads(b''.join(chunks))
+    assert response['resolution'] == RAW_RESOLUTION
+    series = response['channels']['ch0']
+    assert len(series['x']) <= 10
+    assert series['x'][0] == NOW - 100
+    # Unknown channels give empty series
+    assert response['channels']['ch9']['x'] == []
+
+
+def test_history_query_cache_expires():
+    query = HistoryQuery(':memory:', cache_size=1, cache_ttl=10)
+    try:
+        query.store('a', [b'{}'], NOW)
+        assert query.cached('a', NOW + 5) == [b'{}']
+        assert query.cached('a', NOW + 11) is None
+        query.store('b', [b'{}'], NOW)
+        assert query.cached('a', NOW) is None
+    finally:
+        query.close()
+    assert (query.hits, query.misses) == (1, 2)
@@ -0,0 +1,67 @@
+"""Tests of the rollups and retention of the database (database/DBHandler.py)"""
+import pytest
+
+from database.DBHandler import (DBHandler, RAW_RESOLUTION, choose_resolution,
+                                rollup_table)
+
+NOW = 1558000000.0 - 1558000000.0 % 86400    # Midnight (UTC)
+
+
+def entries(times, values, lab='lab7', error=0):
+    return [{'user': lab, 'error': error, 'x': t, 'ch0': value}
+            for t, value in zip(times, values)]
+
+
+@pytest.fixture
+def db(tmp_path):
+    handler = DBHandler(str(tmp_path / 'rollups.db'),
+                        retention={RAW_RESOLUTION: 86400, 60: 7*86400,
+                                   3600: 30*86400, 86400: None})
+    yield handler
+    handler.close()
+
+
+def test_rollups_aggregate_each_bucket(db):
+    db.add_database_entries(entries([NOW, NOW + 30, NOW + 90], [1.0, 3.0, 5.0]))
+    minutes = db.query('lab7', 'ch0', NOW, NOW + 120, resolution=60)
+    assert list(minutes['x']) == [NOW, NOW + 60]
+    assert list(minutes['min']) == [1.0, 5.0]
+    assert list(minutes['max']) == [3.0, 5.0]
+    assert list(minutes['mean']) == [2.0, 5.0]
+    assert list(minutes['count']) == [2, 1]
+    days = db.query('lab7', 'ch0', NOW, NOW + 120, resolution=86400)
+    assert list(days['count']) == [3]
+
+
+def test_rollups_upsert_across_batches(db):
+    db.add_database_entries(entries([NOW], [1.0]))
+    db.add_database_entries(entries([NOW + 10], [-1.0]))
+    hours = db.query('lab7', 'ch0', NOW, NOW + 10, resolution=3600)
+    assert (hours['min'][0], hours['max'][0], hours['count'][0]) == (-1.0, 1.0, 2)
+    assert len(db.read_table(rollup_table('lab7', '1h'))) == 1
+
+
+def test_error_rows_are_not_rolled_up(db):
+    db.add_database_entries(entries([NOW], [1.0], error=1))
+    assert not db.read_table(rollup_table('lab7', '1m'))
+
+
+def test_prune_follows_the_retention_of_each_resolution(db):
+    times = [NOW - 40*86400, NOW - 10*86400, NOW - 2*86400, NOW]
+    db.add_database_entries(entries(times, [1.0]*4))
+    assert db.prune(NOW) == 3
+    assert len(db.read_table('lab7')) == 1
+    assert len(db.read_table(rollup_table('lab7', '1m'))) == 2
+    assert len(db.read_table(rollup_table('lab7', '1h'))) == 3
+    assert len(db.read_table(rollup_table('lab7', '1d'))) == 4
+
+
+def test_choose_resolution():
+    retention = {RAW_RESOLUTION: 86400, 60: 7*86400}
+    # Raw rows for short ranges, rollups which still give enough points
+    assert choose_resolution(retention, NOW - 3600, NOW, 1000, now=NOW) == RAW_RESOLUTION
+    assert choose_resolution(retention, NOW - 86400, NOW, 1000, now=NOW) == 60
+    assert choose_resolution(retention, NOW - 86400, NOW, 20, now=NOW) == 3600
+    # Only the resolutions whose data still covers the start
+    assert choose_resolution(retention, NOW - 2*86400, NOW, 2000, now=NOW) == 60
+    assert choose_resolution(retention, NOW - 8*86400, NOW, 2000, now=NOW) == 3600
@@ -0,0 +1,71 @@
+"""Tests of the full-rate sample store (database/SampleStore.py)"""
+import os
+
+import numpy as np
+
+from database.SampleStore import (SampleStore, read_samples, write_block,
+                                  day_of, column_file, valid_name)
+
+MIDNIGHT = 1558051200.0    # 2019-05-17 00:00 UTC
+
+
+def sample(t, **channels):
+    data = {'user': 'lab7', 'error': 0, 'x': t}
+    data.update(channels)
+    return data
+
+
+def test_round_trip_across_blocks_and_days(tmp_path):
+    store = SampleStore(str(tmp_path), block_rows=4)
+    times = MIDNIGHT - 5 + np.arange(10)
+    for t in times:
+        store.append(sample(t, ch0=t - MIDNIGHT))
+    store.append(sample(MIDNIGHT + 20, error=1, ch0=0.0))
+    store.close()
+    assert store.samples == 10
+    assert sorted(os.listdir(str(tmp_path / 'lab7'))) == \
+        [day_of(MIDNIGHT - 1), day_of(MIDNIGHT)]
+    data = read_samples(str(tmp_path), 'lab7')
+    assert list(data['x']) == list(times)
+    assert list(data['ch0']) == list(times - MIDNIGHT)
+    data = store.read('lab7', MIDNIGHT - 1, MIDNIGHT + 1)
+    assert list(data['ch0']) == [-1, 0, 1]
+
+
+def test_new_channels_are_nan_before_they_appear(tmp_path):
+    store = SampleStore(str(tmp_path), block_rows=2)
+    store.append(sample(MIDNIGHT, ch0=1.0))
+    store.append(sample(MIDNIGHT + 1, ch0=2.0))
+    store.append(sample(MIDNIGHT + 2, ch0=3.0, ch1=30.0))
+    store.close()
+    data = read_samples(str(tmp_path), 'lab7', channels=['ch1', 'ch9'])
+    assert np.isnan(data['ch1'][:2]).all() and data['ch1'][2] == 30.0
+    assert np.isnan(data['ch9']).all()
+
+
+def test_rows_without_index_entry_are_discarded(tmp_path):
+    directory = str(tmp_path)
+    day = day_of(MIDNIGHT)
+    write_block(directory, 'lab7', day, ['ch0'], np.array([MIDNIGHT]),
+                np.array([[1.0]]))
+    # A block interrupted before its index entry was written
+    day_directory = os.path.join(directory, 'lab7', day)
+    with open(column_file(day_directory, 'x'), 'ab') as f:
+        f.write(np.array([MIDNIGHT + 1]).tobytes())
+    write_block(directory, 'lab7', day, ['ch0'], np.array([MIDNIGHT + 2]),
+                np.array([[3.0]]))
+    data = read_samples(directory, 'lab7')
+    assert list(data['x']) == [MIDNIGHT, MIDNIGHT + 2]
+    assert list(data['ch0']) == [1.0, 3.0]
+
+
+def test_invalid_names_are_not_written(tmp_path):
+    store = SampleStore(str(tmp_path / 'samples'))
+    store.append(dict(sample(MIDNIGHT, ch0=1.0), user='../lab7'))
+    store.append(sample(MIDNIGHT, ch0=1.0, **{'../../ch1': 2.0}))
+    store.close()
+    assert store.rejected == 1 and store.samples == 1
+    assert os.listdir(str(tmp_path)) == ['samples']
+    day_directory = tmp_path / 'samples' / 'lab7' / day_of(MIDNIGHT)
+    assert sorted(os.listdir(str(day_directory))) == ['ch0.f64', 'index.bin', 'x.f64']
+    assert not valid_name('a/b') and not valid_name('') and not valid_name(7)
@@ -0,0 +1,164 @@
+"""Tests of the polling scheduler and the request tracking
+(servers/scheduler.py)"""
+from types import SimpleNamespace
+
+from servers.protocol import MAX_SEQUENCE
+from servers.scheduler import (PollScheduler, RequestTracker, parse_rates,
+                               is_newer, MISSED_POLLS_LIMIT, RECOVERY_POLLS,
+                               BACKOFF_FACTOR)
+
+
+def connected(**labs):
+    return {node_id: SimpleNamespace(user=lab) for node_id, lab in labs.items()}
+
+
+def poll(scheduler, nodes, now):
+    polled = scheduler.due(now, nodes)
+    for node_id in polled:
+        scheduler.requests.issue(node_id, now)
+    return polled
+
+
+def answer(scheduler, node_id, now):
+    if scheduler.requests.reply(node_id, None, now):
+        scheduler.replied(node_id)
+
+
+def run(scheduler, nodes, start, end, step=0.01, answering=()):
+    """ Polls the nodes from start to end, the nodes in answering replying
+    at once. Returns the number of polls of each node."""
+    polls = dict.fromkeys(nodes, 0)
+    for i in range(int(round((end - start)/step))):
+        now = start + i*step
+        for node_id in poll(scheduler, nodes, now):
+            polls[node_id] += 1
+            if node_id in answering:
+                answer(scheduler, node_id, now)
+    return polls
+
+
+def test_first_polls_are_staggered():
+    scheduler = PollScheduler(1.0)
+    nodes = connected(**{'n{}'.format(i): 'lab7' for i in range(8)})
+    assert len(poll(scheduler, nodes, 0.0)) == 1
+    phases = sorted(schedule.next_due % 1.0 for schedule in scheduler.schedules.values())
+    gaps = [b - a for a, b in zip(phases, phases[1:])]
+    assert min(gaps) > 0.05
+
+
+def test_labs_are_polled_at_their_own_rate():
+    scheduler = PollScheduler(1.0, rates={'lab7': 10})
+    nodes = connected(fast='lab7', slow='lab6')
+    polls = run(scheduler, nodes, 0, 2, answering=nodes)
+    assert polls == {'fast': 20, 'slow': 2}
+
+
+def test_late_node_is_skipped_and_backs_off():
+    scheduler = PollScheduler(1.0)
+    nodes = connected(n1='lab7')
+    polls = run(scheduler, nodes, 0, MISSED_POLLS_LIMIT + 0.5)
+    schedule = scheduler.schedules['n1']
+    assert polls['n1'] == 1
+    assert schedule.skipped == MISSED_POLLS_LIMIT
+    assert schedule.period == BACKOFF_FACTOR*1.0
+    assert schedule.backoffs == 1
+
+
+def test_backed_off_node_recovers_its_rate():
+    scheduler = PollScheduler(1.0)
+    nodes = connected(n1='lab7')
+    run(scheduler, nodes, 0, MISSED_POLLS_LIMIT + 0.5)
+    schedule = scheduler.schedules['n1']
+    now = MISSED_POLLS_LIMIT + 0.5
+    answer(scheduler, 'n1', now)
+    periods = []
+    while len(periods) < RECOVERY_POLLS + 1:
+        now += 0.1
+        if poll(scheduler, nodes, now):
+            answer(scheduler, 'n1', now)
+            periods.append(schedule.period)
+    # The node speeds up after RECOVERY_POLLS replies on time (the first
+    # one answering the pending request)
+    recovered = periods.index(1.0)
+    assert recovered + 2 == RECOVERY_POLLS
+    assert set(periods[:recovered]) == {BACKOFF_FACTOR*1.0}
+
+
+def test_no_burst_after_falling_behind():
+    scheduler = PollScheduler(1.0)
+    nodes = connected(n1='lab7')
+    assert poll(scheduler, nodes, 0.0) == ['n1']
+    answer(scheduler, 'n1', 0.0)
+    assert poll(scheduler, nodes, 10.0) == ['n1']
+    assert scheduler.schedules['n1'].next_due == 11.0
+
+
+def test_disconnected_nodes_are_forgotten():
+    scheduler = PollScheduler(1.0)
+    poll(scheduler, connected(n1='lab7', n2='lab6'), 0.0)
+    poll(scheduler, connected(n2='lab6'), 0.5)
+    assert list(scheduler.schedules) == ['n2']
+
+
+def test_parse_rates():
+    assert parse_rates('lab6=1, lab7 =20') == {'lab6': 1.0, 'lab7': 20.0}
+    assert parse_rates('') == {}
+
+
+def test_replies_answer_the_earlier_requests():
+    tracker = RequestTracker()
+    first, second, third = [tracker.issue('n1', t) for t in (0.0, 0.1, 0.2)]
+    assert (first, second, third) == (1, 2, 3)
+    assert tracker.reply('n1', second, 0.25)
+    assert tracker.rtt['n1'] == 0.25 - 0.1
+    assert tracker.pending('n1') == 1
+    assert tracker.oldest('n1') == 0.2
+
+
+def test_late_replies_are_stale():
+    tracker = RequestTracker()
+    for t in (0.0, 0.1):
+        tracker.issue('n1', t)
+    assert tracker.reply('n1', 2, 0.2)
+    assert not tracker.reply('n1', 1, 0.3)
+    assert tracker.stale_replies == 1
+
+
+def test_replies_without_sequence_number_answer_everything():
+    tracker = RequestTracker()
+    tracker.issue('n1', 0.0)
+    tracker.issue('n1', 0.5)
+    assert tracker.reply('n1', None, 1.0)
+    assert tracker.pending('n1') == 0
+    assert tracker.rtt['n1'] == 0.5
+
+
+def test_sequence_numbers_wrap_around():
+    tracker = RequestTracker()
+    tracker._next_seq['n1'] = MAX_SEQUENCE - 3
+    old = [tracker.issue('n1', t) for t in (0.0, 0.1)]
+    assert old == [MAX_SEQUENCE - 2, MAX_SEQUENCE - 1]
+    new = tracker.issue('n1', 0.2)
+    assert new == 1
+    assert tracker.reply('n1', old[0], 0.3)
+    assert tracker.reply('n1', new, 0.4)
+    # A reply from before the wrap is late, and the newer ones still count
+    assert not tracker.reply('n1', old[1], 0.5)
+    assert tracker.reply('n1', tracker.issue('n1', 0.6), 0.7)
+    assert tracker.pending('n1') == 0
+
+
+def test_is_newer():
+    assert is_newer(2, 1) and not is_newer(1, 2) and not is_newer(1, 1)
+    assert is_newer(1, MAX_SEQUENCE - 1)
+    assert not is_newer(MAX_SEQUENCE - 1, 1)
+
+
+def test_expire_and_forget():
+    tracker = RequestTracker()
+    tracker.issue('n1', 0.0)
+    tracker.issue('n1', 0.1)
+    assert tracker.expire('n1') == 2
+    assert tracker.oldest('n1') is None
+    tracker.forget('n1')
+    assert tracker.issue('n1', 1.0) == 1
@@ -0,0 +1,73 @@
+"""Tests of the shard workers of the sharded mode (servers/shards.py)"""
+import json
+from types import SimpleNamespace
+
+from tornado.websocket import WebSocketClosedError
+
+from servers.protocol import MessageDecoder
+from servers.shards import ShardNodeHandler, ShardWorker
+
+
+class Coordinator(object):
+    """ Records the messages written, failing after fail_after of them."""
+    def __init__(self, fail_after=None):
+        self.messages = []
+        self.fail_after = fail_after
+
+    def write_message(self, message):
+        if self.fail_after is not None and len(self.messages) >= self.fail_after:
+            raise WebSocketClosedError()
+        self.messages.append(json.loads(message))
+
+
+def node(worker, node_id='n1', ip='10.0.0.7'):
+    handler = SimpleNamespace(id=node_id, worker=worker, decoder=MessageDecoder(),
+                              request=SimpleNamespace(remote_ip=ip))
+    worker.nodes[node_id] = handler
+    return handler
+
+
+def receive(handler, **contents):
+    ShardNodeHandler.on_message(handler, json.dumps(contents))
+
+
+def test_every_sample_is_forwarded():
+    worker = ShardWorker('ws://127.0.0.1:1/shards_ws')
+    worker.coordinator = Coordinator()
+    handler = node(worker)
+    for x in range(3):
+        receive(handler, user='lab7', error=0, x=x, ch0=x, req=x + 1)
+    worker.flush()
+    (message,) = worker.coordinator.messages
+    assert message['type'] == 'data'
+    assert [(request, data['x']) for request, data in message['samples']['n1']] == \
+        [(1, 0), (2, 1), (3, 2)]
+    assert not worker.pending
+
+
+def test_reconnection_announces_the_nodes_with_their_metadata():
+    worker = ShardWorker('ws://127.0.0.1:1/shards_ws')
+    handler = node(worker)
+    receive(handler, user='lab7', meta={'ch0': 'temperature'})
+    receive(handler, user='lab7', error=0, x=1.0, ch0=1.0)
+    # Queued while the coordinator was away: replaced by the announcements
+    worker.forward({'type': 'open', 'id': 'n1', 'ip': '10.0.0.7'})
+    worker.coordinator = Coordinator()
+    worker.announce_nodes()
+    worker._send_outbox()
+    worker.flush()
+    kinds = [message['type'] for message in worker.coordinator.messages]
+    assert kinds == ['open', 'meta', 'data']
+    assert worker.coordinator.messages[1]['meta']['meta'] == {'ch0': 'temperature'}
+
+
+def test_failed_write_does_not_duplicate_messages():
+    worker = ShardWorker('ws://127.0.0.1:1/shards_ws')
+    worker.coordinator = Coordinator(fail_after=1)
+    worker.forward({'type': 'open', 'id': 'n1', 'ip': '10.0.0.7'})
+    worker.forward({'type': 'close', 'id': 'n1'})
+    assert len(worker.outbox) == 1
+    worker.coordinator.fail_after = None
+    worker._send_outbox()
+    kinds = [message['type'] for message in worker.coordinator.messages]
+    assert kinds == ['open', 'close']
@@ -0,0 +1,66 @@
+"""Tests of the state snapshots of the master (servers/snapshot.py)"""
+import json
+import os
+
+import numpy as np
+import pytest
+
+from servers.conditions import ConditionEngine
+from servers.history import HistoryStore
+from servers.snapshot import save_snapshot, load_snapshot
+
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / 'state.npz')
+    state = {'last_data': {'1': {'user': 'lab7', 'error': 0, 'x': 1.0}},
+             'nodes': {'lab7': ['1', '10.0.0.7']}}
+    series = {('lab7', 'ch0'): (np.arange(3.0), np.array([1.0, 2.0, np.nan]))}
+    save_snapshot(path, state, series)
+    assert os.listdir(str(tmp_path)) == ['state.npz']
+    loaded, loaded_series, age = load_snapshot(path)
+    assert loaded == state
+    assert 0 <= age < 10
+    times, values = loaded_series[('lab7', 'ch0')]
+    assert list(times) == [0.0, 1.0, 2.0]
+    np.testing.assert_array_equal(values, series[('lab7', 'ch0')][1])
+
+
+def test_missing_and_old_snapshots_are_not_restored(tmp_path):
+    path = str(tmp_path / 'state.npz')
+    assert load_snapshot(path) is None
+    save_snapshot(path, {}, {})
+    assert load_snapshot(path, max_age=-1) is None
+
+
+def test_invalid_snapshot(tmp_path):
+    path = tmp_path / 'state.npz'
+    path.write_bytes(b'not a snapshot')
+    with pytest.raises(ValueError):
+        load_snapshot(str(path))
+
+
+def test_restore_conditions_and_history(tmp_path):
+    path = str(tmp_path / 'state.npz')
+    condition = {'name': 'too hot', 'obs_lab': 'lab7', 'obs_ch': 'ch2',
+                 'obs_range': (19, 23), 'obs_stat': 'mean', 'window': 10,
+                 'target_lab': 'lab7', 'target_ch': 13, 'target_val': 1}
+    engine = ConditionEngine([condition])
+    history = HistoryStore(capacity=10)
+    for t in range(5):
+        data = {'user': 'lab7', 'error': 0, 'x': float(t), 'ch2': 25.0}
+        engine.update(data)
+        history.append(data)
+    save_snapshot(path, {'conditions': engine.get_state()},
+                  {key: buffer.last() for key, buffer in history.buffers.items()})
+    state, series, _ = load_snapshot(path)
+    assert state['conditions']['conditions']['too hot']['active']
+    restored = ConditionEngine([condition])
+    restored.set_state(state['conditions'])
+    assert json.loads(json.dumps(restored.get_state())) == \
+        json.loads(json.dumps(engine.get_state()))
+    # The active condition is not actuated again
+    assert restored.update({'user': 'lab7', 'error': 0, 'x': 5.0, 'ch2': 25.0}) == []
+    restored_history = HistoryStore(capacity=10)
+    for (lab, channel), (times, values) in series.items():
+        restored_history.restore(lab, channel, times, values)
+    assert list(restored_history.series('lab7', 'ch2')[1]) == [25.0]*5